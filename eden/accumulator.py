@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+"""Provides an array based accumulator of hashed features.
+
+The vectorizers emit each feature as a record (row, block, feature, value),
+where the block groups the features that are normalized together, e.g. the
+features of a (radius, distance) pair. The records are appended to typed
+growable buffers; the sum of the duplicate features, the normalization of
+the blocks and of the rows, and the construction of the sparse matrix are
+then computed at once with array operations.
+
+The result is the same as the one of the nested dictionaries
+row -> block -> feature -> value that are filled in emission order: the
+values of a feature are summed in emission order, the blocks are
+normalized in order of first emission and, when the same feature id
+occurs in several blocks of a row, the value of the block emitted last
+is retained.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from array import array
+import numpy as np
+from scipy.sparse import csr_matrix
+import logging
+logger = logging.getLogger(__name__)
+
+
+def _lexsort(keys, bounds):
+    # same as np.lexsort(keys) for non negative keys smaller than bounds:
+    # when possible the keys are combined in a single integer key, which
+    # is much faster to sort
+    size = 1
+    for bound in bounds:
+        size *= int(bound)
+    if size >= 2 ** 63:
+        return np.lexsort(keys)
+    combined = np.zeros(len(keys[0]), dtype=np.int64)
+    for key, bound in zip(reversed(keys), reversed(bounds)):
+        combined = combined * int(bound) + key
+    return np.argsort(combined, kind='stable')
+
+
+def _segment_starts(*keys):
+    # positions where any of the (sorted) keys changes value
+    size = len(keys[0])
+    change = np.zeros(size, dtype=bool)
+    if size:
+        change[0] = True
+    for key in keys:
+        change[1:] |= key[1:] != key[:-1]
+    return np.flatnonzero(change)
+
+
+def _bound(key):
+    return int(key.max()) + 1 if len(key) else 1
+
+
+class FeatureAccumulator(object):
+    """Growable buffers of feature records.
+
+    A row is opened with new_row and all the records added afterwards
+    belong to it, until the next call to new_row.
+
+    >>> acc = FeatureAccumulator()
+    >>> acc.new_row()
+    >>> acc.add(0, 1, 3.0); acc.add(1, 2, 4.0); acc.add(0, 1, 1.0)
+    >>> acc.new_row()
+    >>> acc.n_rows, len(acc)
+    (2, 3)
+    >>> x = acc.to_csr(4, inner_normalization=False, normalization=False)
+    >>> x.toarray().tolist()
+    [[0.0, 4.0, 4.0, 0.0], [0.0, 0.0, 0.0, 0.0]]
+    >>> x = acc.to_csr(4, inner_normalization=False, normalization=False,
+    ...                offsets=[0, 2])
+    >>> x.toarray().tolist()
+    [[0.0, 4.0, 4.0, 0.0]]
+    """
+
+    def __init__(self):
+        """Constructor."""
+        self.row_starts = array('q')
+        self.blocks = array('q')
+        self.features = array('q')
+        self.values = array('d')
+
+    def __len__(self):
+        """Number of records."""
+        return len(self.values)
+
+    @property
+    def n_rows(self):
+        """Number of rows."""
+        return len(self.row_starts)
+
+    def new_row(self):
+        """Open a new row."""
+        self.row_starts.append(len(self.values))
+
+    def add(self, block, feature, value):
+        """Add a record to the current row."""
+        self.blocks.append(block)
+        self.features.append(feature)
+        self.values.append(value)
+
+    def add_many(self, blocks, features, value):
+        """Add records with the same value to the current row.
+
+        blocks and features are sequences of integers of the same length.
+        """
+        self.blocks.extend(blocks)
+        self.features.extend(features)
+        self.values.extend(array('d', [value]) * len(blocks))
+
+    def add_arrays(self, blocks, features, values):
+        """Add records given as arrays of the same length to the current row.
+        """
+        self.blocks.frombytes(
+            np.ascontiguousarray(blocks, dtype=np.int64).tobytes())
+        self.features.frombytes(
+            np.ascontiguousarray(features, dtype=np.int64).tobytes())
+        self.values.frombytes(
+            np.ascontiguousarray(values, dtype=np.float64).tobytes())
+
+    def extend(self, other):
+        """Add all the records of another accumulator to the current row."""
+        self.blocks.extend(other.blocks)
+        self.features.extend(other.features)
+        self.values.extend(other.values)
+
+    def arrays(self):
+        """Return the rows, blocks, features and values of the records."""
+        blocks = np.frombuffer(self.blocks, dtype=np.int64) \
+            if len(self) else np.zeros(0, dtype=np.int64)
+        features = np.frombuffer(self.features, dtype=np.int64) \
+            if len(self) else np.zeros(0, dtype=np.int64)
+        values = np.frombuffer(self.values, dtype=np.float64) \
+            if len(self) else np.zeros(0, dtype=np.float64)
+        starts = np.frombuffer(self.row_starts, dtype=np.int64) \
+            if self.n_rows else np.zeros(0, dtype=np.int64)
+        sizes = np.diff(np.append(starts, len(self)))
+        rows = np.repeat(np.arange(self.n_rows, dtype=np.int64), sizes)
+        return rows, blocks, features, values
+
+    def to_csr(self, n_features, inner_normalization=True,
+               normalization=True, block_weights=None, offsets=None):
+        """Return the n_rows x n_features csr_matrix of the records.
+
+        When offsets is given, the rows offsets[i]:offsets[i + 1] are merged
+        in the row i of the matrix, as if their records were added to a
+        single row. See feature_matrix for the other parameters.
+        """
+        if self.n_rows == 0 and len(self):
+            raise Exception('ERROR: records added before opening a row.')
+        rows, blocks, features, values = self.arrays()
+        n_rows = self.n_rows
+        if offsets is not None:
+            sizes = np.diff(np.asarray(offsets, dtype=np.int64))
+            n_rows = len(sizes)
+            rows = np.repeat(np.arange(n_rows, dtype=np.int64), sizes)[rows]
+        return feature_matrix(rows, blocks, features, values,
+                              n_rows=n_rows,
+                              n_features=n_features,
+                              inner_normalization=inner_normalization,
+                              normalization=normalization,
+                              block_weights=block_weights)
+
+
+def feature_matrix(rows, blocks, features, values, n_rows, n_features,
+                   inner_normalization=True, normalization=True,
+                   block_weights=None):
+    """Sum, normalize and pack the feature records in a csr_matrix.
+
+    Parameters
+    ----------
+    rows, blocks, features, values : arrays
+        The records, in emission order.
+
+    n_rows, n_features : int
+        The shape of the matrix.
+
+    inner_normalization : bool (default True)
+        Flag to normalize the features of each block of a row.
+
+    normalization : bool (default True)
+        Flag to normalize each row.
+
+    block_weights : dict (default None)
+        Block: weight; the norm of a block is divided by the square root of
+        its weight.
+
+    Rows without features contain an explicit zero in the first column.
+
+    >>> rows = np.array([0, 0, 0, 1])
+    >>> blocks = np.array([0, 0, 1, 0])
+    >>> features = np.array([2, 3, 3, 1])
+    >>> values = np.array([3.0, 4.0, 2.0, 2.0])
+    >>> x = feature_matrix(rows, blocks, features, values, 2, 4,
+    ...                    normalization=False)
+    >>> x.toarray().tolist()
+    [[0.0, 0.0, 0.6, 1.0], [0.0, 1.0, 0.0, 0.0]]
+    """
+    rows, blocks, features, values, first = group_records(
+        rows, blocks, features, values, n_rows)
+    return grouped_feature_matrix(rows, blocks, features, values, first,
+                                  n_rows=n_rows,
+                                  n_features=n_features,
+                                  inner_normalization=inner_normalization,
+                                  normalization=normalization,
+                                  block_weights=block_weights)
+
+
+def group_records(rows, blocks, features, values, n_rows):
+    """Sum the values of the records with the same row, block and feature.
+
+    The values are added one at a time in emission order.
+
+    Returns
+    -------
+    rows, blocks, features, values : arrays
+        One entry per group, sorted by row, block and feature.
+
+    first : array
+        The emission position of the first record of each group.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    blocks = np.asarray(blocks, dtype=np.int64)
+    features = np.asarray(features, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    bounds = (n_rows, _bound(blocks), _bound(features))
+    order = _lexsort((features, blocks, rows), bounds[::-1])
+    starts = _segment_starts(rows[order], blocks[order], features[order])
+    group = np.empty(len(order), dtype=np.int64)
+    group[order] = np.repeat(np.arange(len(starts)),
+                             np.diff(np.append(starts, len(order))))
+    values = np.bincount(group, weights=values, minlength=len(starts))
+    first = order[starts]
+    return rows[first], blocks[first], features[first], values, first
+
+
+def grouped_feature_matrix(rows, blocks, features, values, first, n_rows,
+                           n_features, inner_normalization=True,
+                           normalization=True, block_weights=None):
+    """Normalize and pack the output of group_records in a csr_matrix.
+
+    Any subset of the groups can be given, e.g. the groups of some of the
+    blocks: the result is the same as the one of feature_matrix for the
+    records of those groups alone.
+    """
+    rows, features, values = grouped_features(
+        rows, blocks, features, values, first, n_rows,
+        inner_normalization=inner_normalization,
+        normalization=normalization,
+        block_weights=block_weights)
+    # case of empty feature set for a specific instance
+    sizes = np.bincount(rows, minlength=n_rows)
+    empty = np.flatnonzero(sizes == 0)
+    if len(empty):
+        rows = np.concatenate((rows, empty))
+        features = np.concatenate((features,
+                                   np.zeros(len(empty), dtype=np.int64)))
+        values = np.concatenate((values, np.zeros(len(empty))))
+        order = _lexsort((features, rows), (_bound(features), n_rows))
+        rows, features, values = rows[order], features[order], \
+            values[order]
+        sizes[empty] = 1
+    indptr = np.zeros(n_rows + 1, dtype=np.int64)
+    np.cumsum(sizes, out=indptr[1:])
+    return csr_matrix((values, features, indptr),
+                      shape=(n_rows, n_features), dtype=np.float64)
+
+
+def grouped_features(rows, blocks, features, values, first, n_rows,
+                     inner_normalization=True, normalization=True,
+                     block_weights=None):
+    """Normalize the output of group_records.
+
+    Returns
+    -------
+    rows, features, values : arrays
+        The entries of the feature vectors, sorted by row and feature.
+        Rows without features have no entries.
+    """
+    # visit the blocks in order of first emission and the features of a
+    # block in order of first emission
+    block_starts = _segment_starts(rows, blocks)
+    block_id = np.repeat(np.arange(len(block_starts)),
+                         np.diff(np.append(block_starts, len(rows))))
+    block_keys = blocks[block_starts]
+    block_first = np.minimum.reduceat(first, block_starts) if \
+        len(block_starts) else np.zeros(0, dtype=np.int64)
+    order = _lexsort((first, block_first[block_id], rows),
+                     (_bound(first), _bound(first), n_rows))
+    rows, features, values, block_id = rows[order], features[order], \
+        values[order], block_id[order]
+    # inner normalization per block
+    if inner_normalization:
+        norms = np.sqrt(np.bincount(block_id, weights=values * values,
+                                    minlength=len(block_starts)))
+        if block_weights:
+            for block, weight in block_weights.items():
+                if weight is not None:
+                    selected = block_keys == block
+                    norms[selected] = norms[selected] / np.sqrt(weight)
+        values = values / norms[block_id]
+    # when a feature id occurs in several blocks only the value of the
+    # block visited last is retained, at the position of the first visit
+    position = np.arange(len(rows))
+    order = _lexsort((features, rows), (_bound(features), n_rows))
+    feature_starts = _segment_starts(rows[order], features[order])
+    feature_ends = np.append(feature_starts, len(order))[1:] - 1
+    position = position[order[feature_starts]]
+    values = values[order[feature_ends]]
+    rows, features = rows[order[feature_starts]], \
+        features[order[feature_starts]]
+    # global normalization, summing in order of position
+    if normalization:
+        visit = np.argsort(position)
+        norms = np.sqrt(np.bincount(rows[visit],
+                                    weights=(values * values)[visit],
+                                    minlength=n_rows))
+        values = values / norms[rows]
+    return rows, features, values
@@ -5,59 +5,219 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import copy
 import joblib
+import os
+import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
 import networkx as nx
-import math
 import numpy as np
 from sklearn import metrics
 from sklearn.cluster import MiniBatchKMeans
-from scipy import stats
 from scipy.sparse import csr_matrix
 from scipy.sparse import vstack
-from collections import defaultdict, deque
-from eden import fast_hash, fast_hash_vec
-from eden import fast_hash_2, fast_hash_3, fast_hash_4
+from collections import defaultdict
+from collections import deque
 from eden import AbstractVectorizer
+from eden.hashing import get_hash_functions
+from eden.hashing import HashMemo
+from eden.hashing import _mix64_array
+from eden.accumulator import FeatureAccumulator
+from eden.accumulator import _segment_starts
+from eden.accumulator import group_records
+from eden.accumulator import grouped_feature_matrix
+from eden.util import effective_n_jobs
 from eden.util import serialize_dict
-from itertools import tee
+from eden import graph_batch
+from eden import graph_cache
+from itertools import chain
+from itertools import islice
+from toolz import partition_all
 import logging
 logger = logging.getLogger(__name__)
 
+# with neighborhood_engine='auto' the sparse engine is used from this
+# number of roots, below it the breadth first visits are faster
+_SPARSE_ENGINE_MIN_ROOTS = 32
 
-def auto_label(graphs, n_clusters=16, **opts):
+
+def auto_label(graphs, n_clusters=16, block_size=100, **opts):
     """Label nodes with cluster id.
 
-    Cluster nodes using as features the output of vertex_vectorize.
+    Cluster nodes using as features the output of vertex_vectorize. The
+    vertex vectors are computed for block_size graphs at a time and the
+    clusters are updated with MiniBatchKMeans.partial_fit. If the graphs
+    are in a list or a tuple they are visited twice, to fit the clusters
+    and to assign the vertices, so that the vertex vectors of all the
+    graphs are never held at once. Otherwise the graphs are read a block
+    at a time in a single pass and the vertex vectors of the blocks are
+    kept for the assignment in place of the graphs.
+
+    >>> import networkx as nx
+    >>> g = nx.path_graph(6)
+    >>> nx.set_node_attributes(g, 'C', 'label')
+    >>> nx.set_edge_attributes(g, '1', 'label')
+    >>> label_list, vecs_list = auto_label([g, g, g], n_clusters=2,
+    ...                                    block_size=1)
+    >>> [len(labels) for labels in label_list], vecs_list[0].shape
+    ([6, 6, 6], (6, 2))
+    >>> label_list, vecs_list = auto_label(iter([g, g, g]), n_clusters=2,
+    ...                                    block_size=2)
+    >>> [len(labels) for labels in label_list], vecs_list[0].shape
+    ([6, 6, 6], (6, 2))
     """
-    data_list = Vectorizer(**opts).vertex_transform(graphs)
-    data_matrix = vstack(data_list)
-    clu = MiniBatchKMeans(n_clusters=n_clusters, n_init=10)
-    clu.fit(data_matrix)
-    preds = clu.predict(data_matrix)
-    vecs = clu.transform(data_matrix)
-    sizes = [m.shape[0] for m in data_list]
+    vectorizer = Vectorizer(**opts)
+    if isinstance(graphs, (list, tuple)):
+        clu = _fit_vertex_clusters(
+            _vertex_blocks(vectorizer, graphs, block_size), n_clusters)
+        blocks = _vertex_blocks(vectorizer, graphs, block_size)
+    else:
+        blocks = []
+        clu = _fit_vertex_clusters(
+            _kept_vertex_blocks(
+                _vertex_blocks(vectorizer, graphs, block_size), blocks),
+            n_clusters)
     label_list = []
     vecs_list = []
-    pointer = 0
-    for size in sizes:
-        label_list.append(preds[pointer: pointer + size])
-        vecs_list.append(vecs[pointer: pointer + size])
-        pointer += size
+    for graph, labels, vecs in _assign_vertex_clusters(clu, blocks):
+        label_list.append(labels)
+        vecs_list.append(vecs)
     return label_list, vecs_list
 
 
-def auto_relabel(graphs, n_clusters=16, **opts):
-    """Label nodes with cluster id."""
-    graphs, graphs_ = tee(graphs)
-    label_list, vecs_list = auto_label(graphs_, n_clusters=n_clusters, **opts)
-    relabeled_graphs = []
-    for labels, vecs, orig_graph in zip(label_list, vecs_list, graphs):
-        graph = nx.Graph(orig_graph)
+def auto_relabel(graphs, n_clusters=16, block_size=100, sample_size=1000,
+                 **opts):
+    """Label nodes with cluster id.
+
+    Return the list of relabeled graphs, see auto_relabel_iter. The
+    clusters are fit on all the graphs only if graphs is a list, a tuple
+    or a callable returning a new iterable over the graphs at each call;
+    a plain iterator is fit on its first sample_size graphs only.
+    """
+    return list(auto_relabel_iter(graphs,
+                                  n_clusters=n_clusters,
+                                  block_size=block_size,
+                                  sample_size=sample_size,
+                                  **opts))
+
+
+def auto_relabel_iter(graphs, n_clusters=16, block_size=100,
+                      sample_size=1000, inplace=False, **opts):
+    """Label nodes with cluster id, yielding the graphs one at a time.
+
+    The label of each node is replaced by the id of the cluster of its
+    vertex vector and the 'vec' attribute is set to the distances from the
+    cluster centers, see auto_label.
+
+    In a first phase the clusters are fit. If graphs is a list or a tuple
+    the fit uses all the graphs. If graphs is a callable, it is called once
+    for each phase and must return a new iterable over the same graphs,
+    e.g. lambda: load(path): the fit then streams all the graphs a block at
+    a time. Otherwise graphs is a one-shot stream and the fit uses only its
+    first sample_size graphs, which are kept to be relabeled with the rest.
+    In a second phase the graphs are vectorized and relabeled block_size
+    at a time and yielded lazily, so that the memory is bounded by
+    block_size graphs, plus sample_size graphs for a one-shot stream.
+
+    Parameters
+    ----------
+    graphs : list, callable or iterable over networkx graphs
+        The graphs to relabel, or a function returning a new iterable over
+        them at each call.
+
+    n_clusters : int (default 16)
+        The number of labels.
+
+    block_size : int (default 100)
+        The number of graphs vectorized at a time.
+
+    sample_size : int (default 1000)
+        The number of graphs of a one-shot stream used to fit the
+        clusters.
+
+    inplace : bool (default False)
+        If True the input graphs are relabeled and yielded, otherwise
+        each graph is copied to a nx.Graph before relabeling.
+
+    >>> import networkx as nx
+    >>> g = nx.path_graph(4)
+    >>> nx.set_node_attributes(g, 'C', 'label')
+    >>> nx.set_edge_attributes(g, '1', 'label')
+    >>> graphs = auto_relabel_iter(iter([g, g.copy()]), n_clusters=2)
+    >>> [len(graph.nodes[0]['vec']) for graph in graphs]
+    [2, 2]
+    >>> g.nodes[0]['label']
+    'C'
+    >>> graphs = auto_relabel_iter(lambda: iter([g, g.copy()]),
+    ...                            n_clusters=2, sample_size=1)
+    >>> [len(graph.nodes[0]['vec']) for graph in graphs]
+    [2, 2]
+    """
+    vectorizer = Vectorizer(**opts)
+    if isinstance(graphs, (list, tuple)):
+        sample = graphs
+    elif callable(graphs):
+        sample = graphs()
+    else:
+        graphs = iter(graphs)
+        sample = list(islice(graphs, sample_size))
+        graphs = chain(sample, graphs)
+    clu = _fit_vertex_clusters(
+        _vertex_blocks(vectorizer, sample, block_size), n_clusters)
+    if callable(graphs):
+        graphs = graphs()
+    for orig_graph, labels, vecs in _assign_vertex_clusters(
+            clu, _vertex_blocks(vectorizer, graphs, block_size)):
+        graph = orig_graph if inplace else nx.Graph(orig_graph)
         for label, vec, u in zip(labels, vecs, graph.nodes()):
             graph.nodes[u]['label'] = label
             graph.nodes[u]['vec'] = list(vec)
-        relabeled_graphs.append(graph)
-    return relabeled_graphs
+        yield graph
+
+
+def _vertex_blocks(vectorizer, graphs, block_size):
+    # yield each block of graphs with the stacked vertex vectors of its
+    # graphs and the offsets of the rows of each graph
+    for chunk in partition_all(block_size, graphs):
+        data_matrix, offsets = vectorizer.vertex_transform(chunk,
+                                                           stacked=True)
+        yield chunk, data_matrix, offsets
+
+
+def _kept_vertex_blocks(blocks, kept):
+    # pass the blocks through, keeping their vertex vectors but not
+    # their graphs in kept
+    for chunk, data_matrix, offsets in blocks:
+        kept.append(([None] * len(chunk), data_matrix, offsets))
+        yield chunk, data_matrix, offsets
+
+
+def _fit_vertex_clusters(blocks, n_clusters):
+    # update the clusters with the vertex vectors of a block at a time;
+    # partial_fit initializes the centers once on the first update, so
+    # more than one initialization would not be used
+    clu = MiniBatchKMeans(n_clusters=n_clusters, n_init=1)
+    # the first update needs at least n_clusters vertices
+    pending = []
+    for chunk, data_matrix, offsets in blocks:
+        pending.append(data_matrix)
+        if hasattr(clu, 'cluster_centers_') or \
+                sum(m.shape[0] for m in pending) >= n_clusters:
+            clu.partial_fit(vstack(pending, format='csr'))
+            pending = []
+    if pending:
+        clu.partial_fit(vstack(pending, format='csr'))
+    return clu
+
+
+def _assign_vertex_clusters(clu, blocks):
+    # yield each graph with the cluster ids and the distances from the
+    # cluster centers of its vertices
+    for chunk, data_matrix, offsets in blocks:
+        preds = clu.predict(data_matrix)
+        vecs = clu.transform(data_matrix)
+        for graph, start, end in zip(chunk, offsets[:-1], offsets[1:]):
+            yield graph, preds[start:end], vecs[start:end]
 
 
 def vectorize(graphs, **opts):
@@ -113,7 +273,12 @@ class Vectorizer(AbstractVectorizer):
                  key_importance='importance',
                  key_class='class',
                  key_vec='vec',
-                 key_svec='svec'):
+                 key_svec='svec',
+                 batch_size=None,
+                 neighborhood_engine='bfs',
+                 hashing='builtin',
+                 cache=None,
+                 hash_memo_size=None):
         """Constructor.
 
         Parameters
@@ -190,6 +355,61 @@ class Vectorizer(AbstractVectorizer):
         key_svec : string (default 'svec')
             The key used to indicate the sparse vector label information
             in nodes.
+
+        batch_size : int (default None)
+            If not None, the graphs are transformed in batches of batch_size
+            graphs: each batch is packed in a single disjoint union and
+            processed with array operations. This is considerably faster
+            for many small graphs. Used only if discrete is True.
+
+        neighborhood_engine : string (default 'bfs')
+            The method used to find the vertices at increasing distance
+            from each vertex. 'bfs' runs a breadth first visit from each
+            vertex, 'sparse' computes the distances from all the vertices at
+            once with sparse matrix operations (scipy.sparse.csgraph for
+            small graphs, sparse frontier products otherwise). The shells
+            are then enumerated in a different order and the feature values
+            can differ in the last digits. 'sparse' is slower than 'bfs' on
+            graphs of a few tens of nodes and faster on larger ones, about
+            3 times for the shells of graphs of hundreds of nodes, but the
+            shells are a small part of the transform. 'auto' uses 'bfs'
+            when there are fewer than 32 roots, e.g. for the graphs of small
+            molecules, and 'sparse' otherwise. The default 'bfs' gives the
+            same values in every case.
+
+        hashing : string (default 'builtin')
+            The hash functions used for the labels and the features, see
+            eden.hashing. 'builtin' uses the builtin hash of python, whose
+            values for strings change between interpreters unless
+            PYTHONHASHSEED is set. 'stable' gives the same feature ids in
+            every run and process; its scalar functions are several times
+            slower than the builtin ones, so with discrete labels transform
+            hashes the values of each graph (or batch) with the array
+            functions. The other methods, e.g. vertex_transform, pay that
+            cost.
+
+        cache : FeatureCache (default None)
+            If not None, the feature vectors computed by transform are
+            stored in this persistent cache (see eden.graph_cache) and are
+            looked up by a fingerprint of the graph and of the parameters
+            of the vectorizer instead of being recomputed. A cache with a
+            graph_keys method, as SessionFeatureCache, gives the keys
+            itself.
+
+        hash_memo_size : int (default None)
+            If not None, the neighborhood hashes of the roots and the
+            features of the pairs of neighborhoods are memoized, keeping
+            the hash_memo_size most recently stored values of each, with
+            either hashing scheme. A root is looked up by a signature made
+            of the sums of the mixed labels at each distance, computed for
+            all the roots of a graph at once, and a pair by its two tuples
+            of neighborhood hashes. The memo is kept across graphs and
+            calls, so that a recurring substructure costs a single lookup;
+            see hash_memo_stats. A miss costs more than hashing without
+            the memo, so it pays off when most of the neighborhoods recur,
+            as in molecular datasets or when the same graphs are
+            transformed again. The batched engine, that transform also
+            uses with hashing='stable', does not use the memo.
         """
         self.name = self.__class__.__name__
         self.__version__ = '1.0.1'
@@ -220,6 +440,13 @@ class Vectorizer(AbstractVectorizer):
         self.key_class = key_class
         self.key_vec = key_vec
         self.key_svec = key_svec
+        self.batch_size = batch_size
+        self.neighborhood_engine = neighborhood_engine
+        self.hashing = hashing
+        self._hash_functions = get_hash_functions(hashing)
+        self.cache = cache
+        self.hash_memo_size = hash_memo_size
+        self._init_hash_memo()
 
     def set_params(self, **args):
         """Set the parameters of the vectorizer."""
@@ -245,6 +472,61 @@ class Vectorizer(AbstractVectorizer):
             self.inner_normalization = args['inner_normalization']
         if args.get('positional', None) is not None:
             self.positional = args['positional']
+        if args.get('batch_size', None) is not None:
+            self.batch_size = args['batch_size']
+        if args.get('neighborhood_engine', None) is not None:
+            self.neighborhood_engine = args['neighborhood_engine']
+        if args.get('hashing', None) is not None:
+            self.hashing = args['hashing']
+            self._hash_functions = get_hash_functions(self.hashing)
+            self._init_hash_memo()
+        if args.get('hash_memo_size', None) is not None:
+            self.hash_memo_size = args['hash_memo_size']
+            self._init_hash_memo()
+        if args.get('cache', None) is not None:
+            self.cache = args['cache']
+
+    def _init_hash_memo(self):
+        self._neighborhood_hash_memo = None
+        self._pair_hash_memo = None
+        if self.hash_memo_size is not None:
+            self._neighborhood_hash_memo = HashMemo(self.hash_memo_size)
+            self._pair_hash_memo = HashMemo(self.hash_memo_size)
+
+    def hash_memo_stats(self):
+        """Return the hit and miss counts of the hash memos.
+
+        Returns
+        -------
+        stats : dict
+            With keys 'neighborhood', the memo of the neighborhood hashes
+            of a root, and 'pair', the memo of the features of a pair of
+            neighborhoods; each value is a dict with the hits, misses,
+            hit_rate and size. None if the memo is not used.
+
+        The memo does not change the features, with discrete or real
+        vector labels:
+
+        >>> import networkx as nx
+        >>> g = nx.cycle_graph(8)
+        >>> for n, d in g.nodes(data=True):
+        ...     d['label'] = 'CCN'[n % 3]
+        ...     d['vec'] = [n % 2, 1.0]
+        >>> nx.set_edge_attributes(g, '1', 'label')
+        >>> for discrete in [True, False]:
+        ...     v = Vectorizer(r=2, d=2, discrete=discrete,
+        ...                    hash_memo_size=1000)
+        ...     x = v.transform([g, g])
+        ...     y = Vectorizer(r=2, d=2, discrete=discrete).transform([g, g])
+        ...     hits = v.hash_memo_stats()['pair']['hits']
+        ...     print(abs(x - y).max() == 0, hits > 0)
+        True True
+        True True
+        """
+        if self._neighborhood_hash_memo is None:
+            return None
+        return dict(neighborhood=self._neighborhood_hash_memo.stats(),
+                    pair=self._pair_hash_memo.stats())
 
     def get_params(self):
         """Get parameters for teh vectorizer.
@@ -268,14 +550,35 @@ class Vectorizer(AbstractVectorizer):
         """load."""
         self.__dict__.update(joblib.load(obj).__dict__)
 
-    def transform(self, graphs):
+    def transform(self, graphs, n_jobs=1, chunk_size=100, backend='process'):
         """Transform a list of networkx graphs into a sparse matrix.
 
+        The input graphs are only read, never modified: all the
+        intermediate per vertex data are held in arrays owned by the
+        vectorizer.
+
         Parameters
         ----------
         graphs : list[graphs]
             The input list of networkx graphs.
 
+        n_jobs : int (default 1)
+            The number of workers. Negative values count back from the
+            number of cpus: -1 uses all of them, -2 all but one.
+            The graphs are read lazily in chunks and only a bounded number
+            of chunks is in flight at any time.
+
+        chunk_size : int (default 100)
+            The number of graphs sent to a worker at a time.
+            Used only if n_jobs is not 1.
+
+        backend : string (default 'process')
+            'process' uses a pool of processes, 'thread' a pool of threads
+            working on the same graph objects. When graphs is a list and
+            the processes are forked, the workers read the graphs from the
+            memory inherited from the parent and only the positions of the
+            chunks are sent to them. Used only if n_jobs is not 1.
+
         Returns
         -------
         data_matrix : array-like, shape = [n_samples, n_features]
@@ -298,143 +601,452 @@ class Vectorizer(AbstractVectorizer):
         ...     return hash(tuple(vec.data + vec.indices))
         >>> vec_to_hash(v.transform([g])) == vec_to_hash(v.transform([g2]))
         True
+
+        >>> # transforming in batches gives the same vectors
+        >>> g3 = get_path_graph(6)
+        >>> x = Vectorizer().transform([g, g3])
+        >>> xb = Vectorizer(batch_size=2).transform([g, g3])
+        >>> print(abs(x - xb).max() < 1e-12)
+        True
+
+        >>> # the sparse engine gives the same vectors up to rounding
+        >>> grid = nx.convert_node_labels_to_integers(nx.grid_2d_graph(6, 6))
+        >>> nx.set_node_attributes(grid, 'C', 'label')
+        >>> nx.set_edge_attributes(grid, '1', 'label')
+        >>> graphs = [g, grid, get_path_graph(300)]
+        >>> x_bfs = Vectorizer().transform(graphs)
+        >>> for engine in ['sparse', 'auto']:
+        ...     x_engine = Vectorizer(neighborhood_engine=engine).transform(
+        ...         graphs)
+        ...     print(abs(x_bfs - x_engine).max() < 1e-12)
+        True
+        True
+
+        >>> # transforming in parallel gives the same vectors in input order
+        >>> xp = Vectorizer().transform(iter([g, g3]), n_jobs=2, chunk_size=1)
+        >>> print(abs(x - xp).max() < 1e-12)
+        True
+        >>> xt = Vectorizer().transform([g, g3], n_jobs=2, backend='thread')
+        >>> print(abs(x - xt).max() < 1e-12)
+        True
+
+        >>> # positional labels of long graphs do not depend on batching
+        >>> long_path = get_path_graph(3000)
+        >>> xl = Vectorizer(r=2, d=3, positional=True).transform([long_path])
+        >>> xlb = Vectorizer(r=2, d=3, positional=True,
+        ...                  batch_size=1).transform([long_path])
+        >>> print(abs(xl - xlb).max() < 1e-12)
+        True
         """
-        instance_id = None
-        feature_rows = []
-        for instance_id, graph in enumerate(graphs):
+        if effective_n_jobs(n_jobs) != 1:
+            blocks = list(self.transform_iter(graphs, block_size=chunk_size,
+                                              n_jobs=n_jobs, backend=backend))
+            if len(blocks) == 0:
+                raise Exception('ERROR: something went wrong:\
+                    no graphs are present in current iterator.')
+            return vstack(blocks, format='csr')
+        if self.cache is not None:
+            return self._transform_cached(graphs)
+        return self._transform_uncached(graphs)
+
+    def _transform_uncached(self, graphs):
+        # the scalar stable hash functions are slow: with stable hashing
+        # the graphs are vectorized with the array functions, one graph at
+        # a time if batch_size is None
+        if self.discrete and (self.batch_size or self.hashing == 'stable'):
+            return self._transform_batches(graphs)
+        feature_list = FeatureAccumulator()
+        for graph in graphs:
             self._test_goodness(graph)
-            feature_rows.append(self._transform(graph))
-        if instance_id is None:
+            feature_list.new_row()
+            self._transform(graph, feature_list)
+        if feature_list.n_rows == 0:
             raise Exception('ERROR: something went wrong:\
                 no graphs are present in current iterator.')
-        data_matrix = self._convert_dict_to_sparse_matrix(feature_rows)
-        return data_matrix
+        return self._feature_matrix(feature_list)
+
+    def block_transform(self, graphs):
+        """Transform graphs into features tagged by (radius, distance) block.
+
+        The features of all the (radius, distance) pairs up to r and d are
+        computed in one pass and kept separate, so that the feature
+        vectors for any smaller range of radii and distances, or for a
+        different weights_dict, are assembled without visiting the graphs
+        again, see BlockFeatures.assemble.
+
+        Parameters
+        ----------
+        graphs : iterable over networkx graphs
+            The graphs to vectorize.
+
+        Returns
+        -------
+        block_features : BlockFeatures
+            The un-normalized features of each block; all the blocks in the
+            range are computed, also the ones with zero weight in the
+            weights_dict of the vectorizer.
+        """
+        # the weights_dict is applied by assemble
+        vectorizer = copy.copy(self)
+        vectorizer.weights_dict = None
+        feature_list = FeatureAccumulator()
+        for graph in graphs:
+            self._test_goodness(graph)
+            feature_list.new_row()
+            vectorizer._transform(graph, feature_list)
+        if feature_list.n_rows == 0:
+            raise Exception('ERROR: something went wrong:\
+                no graphs are present in current iterator.')
+        rows, blocks, features, values = feature_list.arrays()
+        groups = group_records(rows, blocks, features, values,
+                               feature_list.n_rows)
+        return BlockFeatures(self, feature_list.n_rows, *groups)
+
+    def transform_iter(self, graphs, block_size=100, n_jobs=1,
+                       backend='process'):
+        """Transform a stream of networkx graphs into a stream of sparse matrices.
+
+        The graphs are consumed lazily and each block of block_size graphs
+        is yielded as soon as it is vectorized, so that the memory does not
+        grow with the number of graphs.
+
+        Parameters
+        ----------
+        graphs : iterable of graphs
+            The input networkx graphs.
+
+        block_size : int (default 100)
+            The number of rows of each block; the last block can be smaller.
+
+        n_jobs : int (default 1)
+            The number of workers. Negative values count back from the
+            number of cpus: -1 uses all of them, -2 all but one.
+
+        backend : string (default 'process')
+            Either 'process' or 'thread', see transform.
+
+        Returns
+        -------
+        blocks : iterator over csr_matrix, shape = [block_size, n_features]
+            Vector representation of consecutive blocks of input graphs.
+
+        >>> import networkx as nx
+        >>> g = nx.path_graph(4)
+        >>> for n, d in g.nodes(data=True):
+        ...     d['label'] = 'C'
+        >>> for a, b, d in g.edges(data=True):
+        ...     d['label'] = '1'
+        >>> v = Vectorizer()
+        >>> blocks = v.transform_iter((g for i in range(5)), block_size=2)
+        >>> [block.shape[0] for block in blocks]
+        [2, 2, 1]
+        """
+        if effective_n_jobs(n_jobs) != 1:
+            for block in _parallel_map(_transform_chunk, self, graphs,
+                                       n_jobs=n_jobs, chunk_size=block_size,
+                                       backend=backend):
+                yield block
+        else:
+            for chunk in partition_all(block_size, graphs):
+                yield self.transform(chunk)
 
-    def vertex_transform(self, graphs):
+    def vertex_transform(self, graphs, n_jobs=1, chunk_size=100,
+                         backend='process', stacked=False):
         """Transform a list of networkx graphs into a list of sparse matrices.
 
         Each matrix has dimension n_nodes x n_features, i.e. each vertex is
         associated to a sparse vector that encodes the neighborhood of the
-        vertex up to radius + distance.
+        vertex up to radius + distance. With stacked=True the matrices of
+        all the graphs are returned as a single matrix, together with the
+        offsets of the rows of each graph.
 
         Parameters
         ----------
         graphs : list[graphs]
             The input list of networkx graphs.
 
+        n_jobs : int (default 1)
+            The number of workers. Negative values count back from the
+            number of cpus: -1 uses all of them, -2 all but one.
+
+        chunk_size : int (default 100)
+            The number of graphs sent to a worker at a time.
+            Used only if n_jobs is not 1.
+
+        backend : string (default 'process')
+            Either 'process' or 'thread', see transform.
+
+        stacked : bool (default False)
+            If True return the stacked matrix and the offsets instead of
+            the list of matrices.
+
         Returns
         -------
         matrix_list : array-like, shape = [n_samples, [n_nodes, n_features]]
             Vector representation of each vertex in the input graphs.
 
+        or, if stacked is True:
+
+        vertex_data_matrix : array-like, shape = [n_vertices, n_features]
+            Vector representation of the vertices of all the input graphs.
+
+        offsets : array of int64, shape = [n_samples + 1]
+            The vertices of the graph i are the rows
+            offsets[i]:offsets[i + 1] of the matrix.
+
+        >>> import networkx as nx
+        >>> g = nx.path_graph(3)
+        >>> nx.set_node_attributes(g, 'C', 'label')
+        >>> nx.set_edge_attributes(g, '1', 'label')
+        >>> vx, offsets = Vectorizer().vertex_transform([g, g], stacked=True)
+        >>> vx.shape[0], offsets.tolist()
+        (6, [0, 3, 6])
+        >>> [m.shape[0] for m in Vectorizer().vertex_transform([g, g])]
+        [3, 3]
         """
-        matrix_list = []
-        for instance_id, graph in enumerate(graphs):
-            self._test_goodness(graph)
-            graph = self._graph_preprocessing(graph)
+        if effective_n_jobs(n_jobs) != 1:
+            results = list(_parallel_map(_vertex_transform_chunk,
+                                         self, graphs,
+                                         n_jobs=n_jobs,
+                                         chunk_size=chunk_size,
+                                         backend=backend))
+            if len(results) == 0:
+                raise Exception('ERROR: something went wrong:\
+                    no graphs are present in current iterator.')
+            vertex_data_matrices, offsets_list = zip(*results)
+            vertex_data_matrix = vstack(vertex_data_matrices, format='csr')
+            offsets = _concatenate_offsets(offsets_list)
+        else:
             # extract per vertex feature representation
-            data_matrix = self._compute_vertex_based_features(graph)
-            matrix_list.append(data_matrix)
-        return matrix_list
+            feature_list, offsets = self._vertex_feature_list(graphs)
+            vertex_data_matrix = self._feature_matrix(feature_list)
+        if stacked:
+            return vertex_data_matrix, offsets
+        return [vertex_data_matrix[start:end]
+                for start, end in zip(offsets[:-1], offsets[1:])]
+
+    def transform_with_vertices(self, graphs, n_jobs=1, chunk_size=100,
+                                backend='process'):
+        """Transform graphs into the graph and the vertex sparse matrices.
+
+        The pairs of vertices are enumerated once: the features of each
+        vertex form a row of the vertex matrix and the rows of the vertices
+        of a graph are summed and normalized into the row of the graph.
+
+        Parameters
+        ----------
+        graphs : iterable over networkx graphs
+            The graphs to vectorize.
+
+        n_jobs, chunk_size, backend
+            As in transform.
+
+        Returns
+        -------
+        data_matrix : array-like, shape = [n_graphs, n_features]
+            The same as transform(graphs).
+
+        vertex_data_matrix : array-like, shape = [n_vertices, n_features]
+            The vertex matrices of all the graphs stacked, i.e. the same as
+            vstack(vertex_transform(graphs)).
+
+        offsets : array of int64, shape = [n_graphs + 1]
+            The vertices of the graph i are the rows
+            offsets[i]:offsets[i + 1] of the vertex matrix.
+
+        >>> import networkx as nx
+        >>> g = nx.path_graph(4)
+        >>> nx.set_node_attributes(g, 'C', 'label')
+        >>> nx.set_edge_attributes(g, '1', 'label')
+        >>> v = Vectorizer()
+        >>> x, vx, offsets = v.transform_with_vertices([g, g])
+        >>> vx.shape[0], offsets.tolist()
+        (8, [0, 4, 8])
+        >>> print(abs(x - v.transform([g, g])).max() < 1e-12)
+        True
+        >>> print(abs(vx[4:] - v.vertex_transform([g])[0]).max() < 1e-12)
+        True
+        """
+        if effective_n_jobs(n_jobs) != 1:
+            results = list(_parallel_map(_transform_with_vertices_chunk,
+                                         self, graphs,
+                                         n_jobs=n_jobs,
+                                         chunk_size=chunk_size,
+                                         backend=backend))
+            if len(results) == 0:
+                raise Exception('ERROR: something went wrong:\
+                    no graphs are present in current iterator.')
+            data_matrices, vertex_data_matrices, offsets_list = zip(*results)
+            return (vstack(data_matrices, format='csr'),
+                    vstack(vertex_data_matrices, format='csr'),
+                    _concatenate_offsets(offsets_list))
+        feature_list, offsets = self._vertex_feature_list(graphs)
+        data_matrix = self._feature_matrix(feature_list, offsets=offsets)
+        vertex_data_matrix = self._feature_matrix(feature_list)
+        return data_matrix, vertex_data_matrix, offsets
+
+    def _feature_records(self, graphs):
+        # the feature records of a list of graphs, in emission order
+        if self.discrete:
+            compact_graphs = []
+            for graph in graphs:
+                self._test_goodness(graph)
+                compact_graphs.append(self._compact_graph(graph))
+            return graph_batch.feature_records(compact_graphs, self)
+        feature_list = FeatureAccumulator()
+        for graph in graphs:
+            self._test_goodness(graph)
+            feature_list.new_row()
+            self._transform(graph, feature_list)
+        return feature_list.arrays()
+
+    def _transform_batches(self, graphs):
+        blocks = []
+        for batch in partition_all(self.batch_size or 1, graphs):
+            compact_graphs = []
+            for graph in batch:
+                self._test_goodness(graph)
+                compact_graphs.append(self._compact_graph(graph))
+            blocks.append(graph_batch.transform(compact_graphs, self))
+        if len(blocks) == 0:
+            raise Exception('ERROR: something went wrong:\
+                no graphs are present in current iterator.')
+        return vstack(blocks, format='csr')
+
+    def _transform_cached(self, graphs, block_size=100):
+        # look up the rows of each block of graphs in the cache and
+        # vectorize only the missing ones
+        params_fingerprint = graph_cache.vectorizer_fingerprint(self)
+        keys = [self.key_label, self.key_weight, self.key_nesting]
+        if not self.discrete:
+            keys += [self.key_vec, self.key_svec]
+        graph_keys = getattr(self.cache, 'graph_keys', None)
+        blocks = []
+        for chunk in partition_all(block_size, graphs):
+            if graph_keys is not None:
+                # the cache provides its own keys, e.g. the graph identity
+                fingerprints = graph_keys(chunk)
+            else:
+                # in positional mode the features depend on the node order
+                fingerprints = [graph_cache.graph_fingerprint(
+                    graph, keys, params_fingerprint, ordered=self.positional)
+                    for graph in chunk]
+            rows = self.cache.get_many(set(fingerprints), self.feature_size)
+            missing = [i for i, fingerprint in enumerate(fingerprints)
+                       if fingerprint not in rows]
+            if missing:
+                data_matrix = self._transform_uncached(
+                    [chunk[i] for i in missing])
+                new_rows = dict((fingerprints[i], data_matrix[j])
+                                for j, i in enumerate(missing))
+                self.cache.put_many(new_rows)
+                rows.update(new_rows)
+            blocks.append(vstack([rows[fingerprint]
+                                  for fingerprint in fingerprints],
+                                 format='csr'))
+        if len(blocks) == 0:
+            raise Exception('ERROR: something went wrong:\
+                no graphs are present in current iterator.')
+        return vstack(blocks, format='csr')
 
     def _test_goodness(self, graph):
         if graph.number_of_nodes() == 0:
             raise Exception('ERROR: something went wrong, empty graph.')
 
-    def _convert_dict_to_sparse_matrix(self, feature_rows):
-        if len(feature_rows) == 0:
-            raise Exception('ERROR: something went wrong, empty features.')
-        data, row, col = [], [], []
-        for i, feature_row in enumerate(feature_rows):
-            if len(feature_row) == 0:
-                # case of empty feature set for a specific instance
-                row.append(i)
-                col.append(0)
-                data.append(0)
-            else:
-                for feature in feature_row:
-                    row.append(i)
-                    col.append(feature)
-                    data.append(feature_row[feature])
-        shape = (max(row) + 1, self.feature_size)
-        data_matrix = csr_matrix((data, (row, col)),
-                                 shape=shape, dtype=np.float64)
-        return data_matrix
-
-    def _init_weight_preprocessing(self, graph):
-        graph.graph['weighted'] = False
-        for u in graph.nodes():
-            if graph.nodes[u].get(self.key_weight, False):
-                graph.graph['weighted'] = True
-                break
-
-    def _weight_preprocessing(self, graph):
-        # if at least one vertex or edge is weighted then ensure that all
-        # vertices and edges are weighted in this case use a default weight
-        # of 1 if the weight attribute is missing
-        self._init_weight_preprocessing(graph)
-        if graph.graph['weighted'] is True:
-            for u in graph.nodes():
-                if graph.nodes[u].get(self.key_weight, False) is False:
-                    graph.nodes[u][self.key_weight] = 1
+    def _block_weights(self):
+        # the weights_dict keyed by the block ids of the (radius, distance)
+        # pairs; only the blocks with a weight are listed
+        block_weights = dict()
+        for radius in range(self.r + 1):
+            for distance in range(self.d + 1):
+                weight = self.weights_dict.get((radius, distance), None)
+                if weight is not None:
+                    block_weights[radius * (self.d + 1) + distance] = weight
+        return block_weights
+
+    def _feature_matrix(self, feature_list, offsets=None):
+        # sum, normalize and pack the records of the accumulator
+        block_weights = None
+        if self.weights_dict is not None:
+            block_weights = self._block_weights()
+        return feature_list.to_csr(
+            self.feature_size,
+            inner_normalization=self.inner_normalization,
+            normalization=self.normalization,
+            block_weights=block_weights,
+            offsets=offsets)
+
+    def _vertex_feature_list(self, graphs):
+        # the features of each vertex of each graph in a row of its own,
+        # with the offsets of the first row of each graph
+        def compact_graphs():
+            for graph in graphs:
+                self._test_goodness(graph)
+                yield self._graph_preprocessing(graph)
+        return self._compact_vertex_feature_list(compact_graphs())
+
+    def _compact_vertex_feature_list(self, compact_graphs):
+        feature_list = FeatureAccumulator()
+        sizes = []
+        for graph in compact_graphs:
+            for v in graph.node_vertices:
+                feature_list.new_row()
+                self._transform_vertex(graph, v, feature_list)
+            sizes.append(len(graph.node_vertices))
+        if len(sizes) == 0:
+            raise Exception('ERROR: something went wrong:\
+                no graphs are present in current iterator.')
+        offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=offsets[1:])
+        return feature_list, offsets
+
+    def _compact_graph(self, original_graph):
+        # convert once to the array based representation: all the following
+        # stages operate only on the compact graph
+        return _CompactGraph(original_graph,
+                             key_label=self.key_label,
+                             key_weight=self.key_weight,
+                             key_nesting=self.key_nesting,
+                             key_vec=None if self.discrete else self.key_vec,
+                             key_svec=None if self.discrete else self.key_svec,
+                             bitmask=self.bitmask,
+                             label_hash=self._hash_functions.label)
 
     def _graph_preprocessing(self, original_graph):
-        graph = _edge_to_vertex_transform(original_graph)
-        self._weight_preprocessing(graph)
-        _label_preprocessing(graph,
-                             key_label=self.key_label,
-                             bitmask=self.bitmask)
+        graph = self._compact_graph(original_graph)
         self._compute_distant_neighbours(graph, max(self.r, self.d) * 2)
         self._compute_neighborhood_graph_hash_cache(graph)
-        if graph.graph.get('weighted', False):
+        if graph.weighted:
             self._compute_neighborhood_graph_weight_cache(graph)
         return graph
 
-    def _transform(self, original_graph):
+    def _transform(self, original_graph, feature_list):
         graph = self._graph_preprocessing(original_graph)
-        # collect all features for all vertices for each label_index
-        feature_list = defaultdict(lambda: defaultdict(float))
-        for v in graph.nodes():
+        self._transform_compact_graph(graph, feature_list)
+
+    def _transform_compact_graph(self, graph, feature_list):
+        # collect all features for all vertices in the current row
+        for v in graph.node_vertices:
             # only for vertices of type 'node', i.e. not for the 'edge' type
-            if graph.nodes[v].get('node', False):
-                self._transform_vertex(graph, v, feature_list)
-        _clean_graph(graph)
-        return self._normalization(feature_list)
+            self._transform_vertex(graph, v, feature_list)
 
     def _update_feature_list(self, node_feature_list, feature_list):
         for radius_dist_key in node_feature_list:
-            for feature in node_feature_list[radius_dist_key]:
-                val = node_feature_list[radius_dist_key][feature]
-                feature_list[radius_dist_key][feature] += val
+            features = node_feature_list[radius_dist_key]
+            for feature, val in features.items():
+                feature_list.add(radius_dist_key, feature, val)
 
     def _transform_vertex(self, graph, vertex_v, feature_list):
         if self.discrete:
             # for all distances
-            root_dist_dict = graph.nodes[vertex_v]['remote_neighbours']
-            for distance in range(self.min_d * 2, (self.d + 1) * 2, 2):
-                if distance in root_dist_dict:
-                    node_set = root_dist_dict[distance]
-                    for vertex_u in node_set:
-                        if graph.nodes[vertex_u].get('node', False):
-                            self._transform_vertex_pair(
-                                graph, vertex_v, vertex_u,
-                                distance, feature_list)
+            self._transform_vertex_distances(
+                graph, vertex_v, vertex_v, feature_list)
             self._transform_vertex_nesting(graph, vertex_v, feature_list)
         else:
-            node_feature_list = defaultdict(lambda: defaultdict(float))
+            node_feature_list = _NestedFeatures()
             # for all distances
-            root_dist_dict = graph.nodes[vertex_v]['remote_neighbours']
-            for distance in range(self.min_d * 2, (self.d + 1) * 2, 2):
-                if distance in root_dist_dict:
-                    node_set = root_dist_dict[distance]
-                    for vertex_u in node_set:
-                        if graph.nodes[vertex_u].get('node', False):
-                            self._transform_vertex_pair(
-                                graph,
-                                vertex_v,
-                                vertex_u,
-                                distance,
-                                node_feature_list)
+            self._transform_vertex_distances(
+                graph, vertex_v, vertex_v, node_feature_list)
             self._transform_vertex_nesting(
                 graph,
                 vertex_v,
@@ -456,7 +1068,7 @@ class Vectorizer(AbstractVectorizer):
 
     def _add_vector_labes(self, graph, vertex_v, node_feature_list):
         # add the vector with an offset given by the feature, multiplied by val
-        vec = graph.nodes[vertex_v].get(self.key_vec, None)
+        vec = graph.vec[vertex_v]
         if vec:
             vec_feature_list = defaultdict(lambda: defaultdict(float))
             for radius_dist_key in node_feature_list:
@@ -472,7 +1084,7 @@ class Vectorizer(AbstractVectorizer):
         # add the vector with a feature resulting from hashing
         # the discrete labeled graph sparse encoding with the sparse vector
         # feature, the val is then multiplied.
-        svec = graph.nodes[vertex_v].get(self.key_svec, None)
+        svec = graph.svec[vertex_v]
         if svec:
             vec_feature_list = defaultdict(lambda: defaultdict(float))
             for radius_dist_key in node_feature_list:
@@ -480,39 +1092,120 @@ class Vectorizer(AbstractVectorizer):
                     val = node_feature_list[radius_dist_key][feature]
                     for i in svec:
                         vec_val = svec[i]
-                        key = fast_hash_2(feature, i, self.bitmask)
+                        key = self._hash_functions.hash_2(feature, i,
+                                                          self.bitmask)
                         vec_feature_list[radius_dist_key][key] += val * vec_val
             node_feature_list = vec_feature_list
         return node_feature_list
 
+    def _transform_vertex_distances(self, graph, vertex_v, vertex_w,
+                                    feature_list, connection_weight=1):
+        # pair vertex_v with all the vertices u at distance d from vertex_w;
+        # vertex_w is vertex_v itself or the endpoint of a nesting edge
+        shells = graph.shells(vertex_w)
+        if self._pair_hash_memo is not None:
+            self._transform_vertex_distances_memoized(
+                graph, vertex_v, shells, feature_list, connection_weight)
+            return
+        is_node = graph.is_node_list
+        for distance in range(self.min_d * 2, (self.d + 1) * 2, 2):
+            if distance < len(shells):
+                for vertex_u in shells[distance]:
+                    if is_node[vertex_u]:
+                        self._transform_vertex_pair(
+                            graph, vertex_v, vertex_u,
+                            distance, feature_list,
+                            connection_weight=connection_weight)
+
+    def _transform_vertex_distances_memoized(self, graph, vertex_v, shells,
+                                             feature_list, connection_weight):
+        # the records of a pair of neighborhoods at all the radii are
+        # memoized together, keyed by the two tuples of neighborhood hashes,
+        # see hash_memo_size; without weights they are appended to the
+        # accumulator at once. The weights_dict is applied to the memoized
+        # features, so that copies of the vectorizer with other weights can
+        # share the memo
+        memo = self._pair_hash_memo
+        memo_get = memo.get
+        neigh_graph_hash = graph.neigh_graph_hash
+        is_node = graph.is_node_list
+        vertex_v_labels = neigh_graph_hash[vertex_v]
+        params = (self.min_r, self.r, self.d, self.bitmask,
+                  self.use_only_context)
+        unweighted = self.weights_dict is None and graph.weighted is False
+        hits, misses = 0, 0
+        for distance in range(self.min_d * 2,
+                              min((self.d + 1) * 2, len(shells)), 2):
+            for vertex_u in shells[distance]:
+                if not is_node[vertex_u]:
+                    continue
+                vertex_u_labels = neigh_graph_hash[vertex_u]
+                key = (vertex_v_labels, vertex_u_labels, distance, params)
+                records = memo_get(key)
+                if records is None:
+                    misses += 1
+                    records = self._vertex_pair_records(
+                        vertex_v_labels, vertex_u_labels, distance)
+                    memo.put(key, records)
+                else:
+                    hits += 1
+                if unweighted:
+                    feature_list.add_many(records[1], records[2],
+                                          connection_weight)
+                else:
+                    self._add_vertex_pair_records(
+                        graph, vertex_v, vertex_u, distance, records[0],
+                        feature_list, connection_weight)
+        memo.count(hits, misses)
+
+    def _add_vertex_pair_records(self, graph, vertex_v, vertex_u, distance,
+                                 features, feature_list, connection_weight):
+        # the records of _transform_vertex_pair_valid from the memoized
+        # (radius, feature, half feature) of each radius
+        cw = connection_weight
+        weights_dict = self.weights_dict
+        for radius, feature, half_feature in features:
+            if weights_dict is not None and \
+                    weights_dict.get((radius / 2, distance / 2), 0) == 0:
+                continue
+            radius_dist_key = (radius // 2) * (self.d + 1) + distance // 2
+            if graph.weighted is False:
+                if self.use_only_context is False:
+                    feature_list.add(radius_dist_key, feature, cw)
+                feature_list.add(radius_dist_key, half_feature, cw)
+            else:
+                weight_v = graph.neigh_graph_weight[vertex_v]
+                weight_u = graph.neigh_graph_weight[vertex_u]
+                val = cw * (weight_v[radius] + weight_u[radius])
+                # Note: add a feature only if the value is not 0
+                if val != 0:
+                    if self.use_only_context is False:
+                        feature_list.add(radius_dist_key, feature, val)
+                    feature_list.add(radius_dist_key, half_feature,
+                                     cw * weight_u[radius])
+
     def _transform_vertex_nesting(self, graph, vertex_v, feature_list):
         # find all vertices, if any, that are second point of nesting edge
         endpoints = self._find_second_endpoint_of_nesting_edge(graph, vertex_v)
         for endpoint, connection_weight in endpoints:
             # for all vertices at distance d from each such second endpoint
-            endpoint_dist_dict = graph.nodes[endpoint]['remote_neighbours']
-            for distance in range(self.min_d * 2, (self.d + 1) * 2, 2):
-                if distance in endpoint_dist_dict:
-                    node_set = endpoint_dist_dict[distance]
-                    # for all nodes u at distance distance from endpoint
-                    for vertex_u in node_set:
-                        if graph.nodes[vertex_u].get('node', False):
-                            self._transform_vertex_pair(
-                                graph, vertex_v, vertex_u,
-                                distance, feature_list,
-                                connection_weight=connection_weight)
+            self._transform_vertex_distances(
+                graph, vertex_v, endpoint, feature_list,
+                connection_weight=connection_weight)
 
     def _find_second_endpoint_of_nesting_edge(self, graph, vertex_v):
         endpoints = []
+        if not graph.has_nesting:
+            return endpoints
         # find all neighbors
         for u in graph.neighbors(vertex_v):
             # test for type
-            if graph.nodes[u].get(self.key_nesting, False):
+            if graph.is_nesting_list[u]:
                 # if type is nesting
                 # find endpoint that is not original vertex_v
                 vertices = [j for j in graph.neighbors(u) if j != vertex_v]
                 assert(len(vertices) == 1)
-                connection_weight = graph.nodes[u].get(self.key_weight, 1)
+                connection_weight = graph.connection_weight_list[u]
                 endpoints.append((vertices[0], connection_weight))
         return endpoints
 
@@ -524,8 +1217,13 @@ class Vectorizer(AbstractVectorizer):
                                feature_list,
                                connection_weight=1):
         cw = connection_weight
+        vertex_v_labels = graph.neigh_graph_hash[vertex_v]
+        vertex_u_labels = graph.neigh_graph_hash[vertex_u]
+        max_radius = min(len(vertex_v_labels), len(vertex_u_labels))
         # for all radii
         for radius in range(self.min_r * 2, (self.r + 1) * 2, 2):
+            if radius >= max_radius:
+                break
             # Note: to be compatible with external radius, distance
             # we need to revert to r/2 and d/2
             radius_dist_key = (radius / 2, distance / 2)
@@ -539,6 +1237,38 @@ class Vectorizer(AbstractVectorizer):
                                                   feature_list,
                                                   connection_weight=cw)
 
+    def _vertex_pair_records(self, vertex_v_labels, vertex_u_labels,
+                             distance):
+        # the (radius, feature, half feature) of each radius and the blocks
+        # and features of the records they give with unit weights, in the
+        # order of _transform_vertex_pair_valid
+        hash_4 = self._hash_functions.hash_4
+        hash_3 = self._hash_functions.hash_3
+        bitmask = self.bitmask
+        max_radius = min(len(vertex_v_labels), len(vertex_u_labels),
+                         (self.r + 1) * 2)
+        features = []
+        record_blocks = []
+        record_features = []
+        for radius in range(self.min_r * 2, max_radius, 2):
+            vertex_v_hash = vertex_v_labels[radius]
+            vertex_u_hash = vertex_u_labels[radius]
+            if vertex_v_hash < vertex_u_hash:
+                feature = hash_4(vertex_v_hash, vertex_u_hash, radius,
+                                 distance, bitmask)
+            else:
+                feature = hash_4(vertex_u_hash, vertex_v_hash, radius,
+                                 distance, bitmask)
+            half_feature = hash_3(vertex_u_hash, radius, distance, bitmask)
+            features.append((radius, feature, half_feature))
+            radius_dist_key = (radius // 2) * (self.d + 1) + distance // 2
+            if self.use_only_context is False:
+                record_blocks.append(radius_dist_key)
+                record_features.append(feature)
+            record_blocks.append(radius_dist_key)
+            record_features.append(half_feature)
+        return tuple(features), tuple(record_blocks), tuple(record_features)
+
     def _transform_vertex_pair_valid(self,
                                      graph,
                                      vertex_v,
@@ -548,196 +1278,222 @@ class Vectorizer(AbstractVectorizer):
                                      feature_list,
                                      connection_weight=1):
         cw = connection_weight
-        # we need to revert to r/2 and d/2
-        radius_dist_key = (radius / 2, distance / 2)
-        # reweight using external weight dictionary
-        len_v = len(graph.nodes[vertex_v]['neigh_graph_hash'])
-        len_u = len(graph.nodes[vertex_u]['neigh_graph_hash'])
-        if radius < len_v and radius < len_u:
-            # feature as a pair of neighborhoods at a radius,distance
-            # canonicalization of pair of neighborhoods
-            vertex_v_labels = graph.nodes[vertex_v]['neigh_graph_hash']
-            vertex_v_hash = vertex_v_labels[radius]
-            vertex_u_labels = graph.nodes[vertex_u]['neigh_graph_hash']
-            vertex_u_hash = vertex_u_labels[radius]
-            if vertex_v_hash < vertex_u_hash:
-                first_hash, second_hash = (vertex_v_hash, vertex_u_hash)
-            else:
-                first_hash, second_hash = (vertex_u_hash, vertex_v_hash)
-            feature = fast_hash_4(
-                first_hash, second_hash, radius, distance, self.bitmask)
-            # half features are those that ignore the central vertex v
-            # the reason to have those is to help model the context
-            # independently from the identity of the vertex itself
-            half_feature = fast_hash_3(vertex_u_hash,
-                                       radius, distance, self.bitmask)
-            if graph.graph.get('weighted', False) is False:
-                if self.use_only_context is False:
-                    feature_list[radius_dist_key][feature] += cw
-                feature_list[radius_dist_key][half_feature] += cw
-            else:
-                weight_v = graph.nodes[vertex_v]['neigh_graph_weight']
-                weight_u = graph.nodes[vertex_u]['neigh_graph_weight']
-                weight_vu_radius = weight_v[radius] + weight_u[radius]
-                val = cw * weight_vu_radius
-                # Note: add a feature only if the value is not 0
-                if val != 0:
-                    if self.use_only_context is False:
-                        feature_list[radius_dist_key][feature] += val
-                    half_val = cw * weight_u[radius]
-                    feature_list[radius_dist_key][half_feature] += half_val
-
-    def _normalization(self, feature_list):
-        # inner normalization per radius-distance
-        feature_vector = {}
-        for r_d_key in feature_list:
-            features = feature_list[r_d_key]
-            norm = 0
-            for count in features.values():
-                norm += count * count
-            sqrt_norm = math.sqrt(norm)
-            if self.weights_dict is not None:
-                # reweight using external weight dictionary
-                if self.weights_dict.get(r_d_key, None) is not None:
-                    sqrtw = math.sqrt(self.weights_dict[r_d_key])
-                    sqrt_norm = sqrt_norm / sqrtw
-            for feature_id, count in features.items():
-                if self.inner_normalization:
-                    feature_vector_value = float(count) / sqrt_norm
-                else:
-                    feature_vector_value = count
-                feature_vector[feature_id] = feature_vector_value
-        # global normalization
-        if self.normalization:
-            normalized_feature_vector = {}
-            total_norm = 0.0
-            for value in feature_vector.values():
-                total_norm += value * value
-            sqrt_total_norm = math.sqrt(float(total_norm))
-            for feature_id, value in list(feature_vector.items()):
-                feature_vector_value = value / sqrt_total_norm
-                normalized_feature_vector[feature_id] = feature_vector_value
-            return normalized_feature_vector
+        # the block of the pair (r/2, d/2), normalized as a whole
+        radius_dist_key = (radius // 2) * (self.d + 1) + distance // 2
+        # feature as a pair of neighborhoods at a radius,distance
+        # canonicalization of pair of neighborhoods
+        vertex_v_hash = graph.neigh_graph_hash[vertex_v][radius]
+        vertex_u_hash = graph.neigh_graph_hash[vertex_u][radius]
+        if vertex_v_hash < vertex_u_hash:
+            first_hash, second_hash = (vertex_v_hash, vertex_u_hash)
         else:
-            return feature_vector
+            first_hash, second_hash = (vertex_u_hash, vertex_v_hash)
+        hash_functions = self._hash_functions
+        feature = hash_functions.hash_4(
+            first_hash, second_hash, radius, distance, self.bitmask)
+        # half features are those that ignore the central vertex v
+        # the reason to have those is to help model the context
+        # independently from the identity of the vertex itself
+        half_feature = hash_functions.hash_3(
+            vertex_u_hash, radius, distance, self.bitmask)
+        if graph.weighted is False:
+            if self.use_only_context is False:
+                feature_list.add(radius_dist_key, feature, cw)
+            feature_list.add(radius_dist_key, half_feature, cw)
+        else:
+            weight_v = graph.neigh_graph_weight[vertex_v]
+            weight_u = graph.neigh_graph_weight[vertex_u]
+            weight_vu_radius = weight_v[radius] + weight_u[radius]
+            val = cw * weight_vu_radius
+            # Note: add a feature only if the value is not 0
+            if val != 0:
+                if self.use_only_context is False:
+                    feature_list.add(radius_dist_key, feature, val)
+                half_val = cw * weight_u[radius]
+                feature_list.add(radius_dist_key, half_feature, half_val)
 
-    def _compute_neighborhood_graph_hash_cache(self, graph):
+    def _compute_neighborhood_graph_hash_cache(self, graph, roots=None,
+                                               max_r=None):
+        # the hashes are computed up to the radius max_r, by default r
         assert (len(graph) > 0), 'ERROR: Empty graph'
-        for u in graph.nodes():
-            if graph.nodes[u].get('node', False):
-                self._compute_neighborhood_graph_hash(u, graph)
-
-    def _compute_neighborhood_graph_hash(self, root, graph):
+        if roots is None:
+            roots = graph.node_vertices
+        if max_r is None:
+            max_r = self.r
+        # the hashed label of a vertex is combined with its degree; this
+        # does not depend on the root so it is computed once per vertex
+        hlabels = graph.hlabel.tolist()
+        fast_hash_2 = self._hash_functions.hash_2
+        if self.positional:
+            ids = graph.ids
+            vertex_hlabels = None
+        else:
+            degrees = graph.degree.tolist()
+            vertex_hlabels = [fast_hash_2(hlabel, degree)
+                              for hlabel, degree in zip(hlabels, degrees)]
+        neigh_graph_hash = [None] * len(graph)
+        # with the memo, a root whose signature was seen before costs a
+        # single lookup, see hash_memo_size
+        memo = self._neighborhood_hash_memo
+        signatures = None
+        if memo is not None:
+            signatures = self._neighborhood_signatures(graph, roots, max_r)
+        misses = 0
+        for i, u in enumerate(roots):
+            if signatures is not None:
+                neigh_graph_hash[u] = memo.get(signatures[i])
+                if neigh_graph_hash[u] is not None:
+                    continue
+                misses += 1
+            # only the hashes up to the largest radius are used
+            shells = graph.shells(u)[:max_r * 2 + 1]
+            if self.positional:
+                # use the relative position of the vertex v w.r.t. the root,
+                # only for the vertices within the neighborhood of the root
+                vertex_hlabels = dict(
+                    (v, fast_hash_2(hlabels[v], ids[u] - ids[v]))
+                    for node_set in shells for v in node_set)
+            neigh_graph_hash[u] = self._compute_neighborhood_graph_hash(
+                shells, vertex_hlabels)
+            if signatures is not None:
+                # a tuple, so that it can be part of the keys of the memo
+                # of the pair features
+                neigh_graph_hash[u] = tuple(neigh_graph_hash[u])
+                memo.put(signatures[i], neigh_graph_hash[u])
+        if signatures is not None:
+            memo.count(len(roots) - misses, misses)
+        graph.neigh_graph_hash = neigh_graph_hash
+
+    def _neighborhood_signatures(self, graph, roots, max_r):
+        # the signature of a rooted neighborhood lists, for each distance up
+        # to the largest radius, the sum of the mixed (label, degree) pairs
+        # of the vertices at that distance; the distance 0 entry is the root
+        # label. Equal multisets of labels give equal sums without sorting
+        # them. The neighborhood hashes are running hashes, so the ones up
+        # to the largest radius depend only on these shells
+        if len(roots) == 0:
+            return []
+        size = max_r * 2 + 1
+        if self.positional:
+            # the labels depend on the position relative to the root
+            roots = np.asarray(roots, dtype=np.int64)
+            root_pos, vertex, dist, n_shells = graph_batch.stored_shells(
+                graph, roots)
+            ids = np.asarray(graph.ids, dtype=np.int64)
+            offsets = (ids[roots[root_pos]] - ids[vertex]).view(np.uint64)
+            labels = _mix64_array(graph.hlabel[vertex].view(np.uint64))
+            values = _mix64_array(labels + offsets)
+            sums = np.add.reduceat(values,
+                                   _segment_starts(root_pos, dist)).tolist()
+            ends = np.cumsum(n_shells).tolist()
+            return [tuple(sums[end - n:end - n + size])
+                    for n, end in zip(n_shells.tolist(), ends)]
+        # the sums of all the stored shells at once
+        labels = _mix64_array(graph.hlabel.view(np.uint64))
+        values = _mix64_array(labels + graph.degree.astype(np.uint64))
+        sums = np.add.reduceat(values[graph.shell_vertex],
+                               graph.shell_offsets[:-1]).tolist()
+        first_shell = graph._first_shell
+        n_shells = graph._n_shells
+        return [tuple(sums[first_shell[u]:
+                           first_shell[u] + min(n_shells[u], size)])
+                for u in roots]
+
+    def _compute_neighborhood_graph_hash(self, shells, vertex_hlabels):
         # list all hashed labels at increasing distances
         hash_list = []
         # for all distances
-        root_dist_dict = graph.nodes[root]['remote_neighbours']
-        for node_set in root_dist_dict.keys():
-            # create a list of hashed labels
-            hash_label_list = []
-            for v in root_dist_dict[node_set]:
-                # compute the vertex hashed label by hashing the hlabel
-                # field
-                # with the degree of the vertex (obtained as the size of
-                # the adjacency dictionary for the vertex v)
-                # or, in case positional is set, using the relative
-                # position of the vertex v w.r.t. the root vertex
-                if self.positional:
-                    vhlabel = fast_hash_2(
-                        graph.nodes[v]['hlabel'], root - v)
-                else:
-                    vhlabel = fast_hash_2(
-                        graph.nodes[v]['hlabel'], len(graph[v]))
-                hash_label_list.append(vhlabel)
-            # sort it
-            hash_label_list.sort()
+        for node_set in shells:
+            # create a sorted list of hashed labels
+            hash_label_list = sorted([vertex_hlabels[v] for v in node_set])
             # hash it
-            hashed_nodes_at_distance_d_in_neighborhood = fast_hash(
-                hash_label_list)
+            hashed_nodes_at_distance_d_in_neighborhood = \
+                self._hash_functions.hash(hash_label_list)
             hash_list.append(hashed_nodes_at_distance_d_in_neighborhood)
         # hash the sequence of hashes of the node set at increasing
         # distances into a list of features
-        hash_neighborhood = fast_hash_vec(hash_list)
-        graph.nodes[root]['neigh_graph_hash'] = hash_neighborhood
+        return self._hash_functions.hash_vec(hash_list)
 
-    def _compute_neighborhood_graph_weight_cache(self, graph):
+    def _compute_neighborhood_graph_weight_cache(self, graph, roots=None):
         assert (len(graph) > 0), 'ERROR: Empty graph'
-        for u in graph.nodes():
-            if graph.nodes[u].get('node', False):
-                self._compute_neighborhood_graph_weight(u, graph)
-
-    def _compute_neighborhood_graph_weight(self, root, graph):
-        # list all nodes at increasing distances
-        # at each distance
-        # compute the arithmetic mean weight on nodes
-        # compute the geometric mean weight on edges
-        # compute the product of the two
-        # make a list of the neighborhood_graph_weight at every distance
-        neighborhood_graph_weight_list = []
-        w = graph.nodes[root][self.key_weight]
-        node_weight_list = np.array([w], dtype=np.float64)
-        node_average = node_weight_list[0]
-        edge_weight_list = np.array([1], dtype=np.float64)
-        edge_average = edge_weight_list[0]
-        # for all distances
-        root_dist_dict = graph.nodes[root]['remote_neighbours']
-        for dist in root_dist_dict.keys():
-            # extract array of weights at given dist
-            weight_array_at_d = np.array([graph.nodes[v][self.key_weight]
-                                          for v in root_dist_dict[dist]],
-                                         dtype=np.float64)
-            if dist % 2 == 0:  # nodes
-                node_weight_list = np.concatenate(
-                    (node_weight_list, weight_array_at_d))
-                node_average = np.mean(node_weight_list)
-            else:  # edges
-                edge_weight_list = np.concatenate(
-                    (edge_weight_list, weight_array_at_d))
-                edge_average = stats.gmean(edge_weight_list)
-            weight = node_average * edge_average
-            neighborhood_graph_weight_list.append(weight)
-        graph.nodes[root]['neigh_graph_weight'] = \
-            neighborhood_graph_weight_list
-
-    def _single_vertex_breadth_first_visit(self, graph, root, max_depth):
-        # the map associates to each distance value ( from 1:max_depth )
+        if roots is None:
+            roots = graph.node_vertices
+        # at each distance the weight is the product of the arithmetic mean
+        # weight on nodes and of the geometric mean weight on edges up to
+        # that distance; the means are computed for all the roots at once
+        # as running sums over the flat shells
+        shells = graph_batch.stored_shells(graph, roots)
+        n_shells = shells[3].tolist()
+        weights = graph_batch.neighborhood_weights(graph, roots, shells)
+        neigh_graph_weight = [None] * len(graph)
+        for i, u in enumerate(roots):
+            neigh_graph_weight[u] = weights[i, :n_shells[i]].tolist()
+        graph.neigh_graph_weight = neigh_graph_weight
+
+    def _single_vertex_breadth_first_visit(self, indptr, indices, is_nesting,
+                                           root, max_depth):
+        # the list associates to each distance value ( from 0:max_depth )
         # the list of ids of the vertices at that distance from the root
-        dist_list = {}
+        dist_list = [[root]]
         visited = set()  # use a set as we can end up exploring few nodes
-        # q is the queue containing the frontier to be expanded in the BFV
-        q = deque()
-        q.append(root)
-        # the map associates to each vertex id the distance from the root
-        dist = {}
-        dist[root] = 0
         visited.add(root)
-        # add vertex at distance 0
-        dist_list[0] = set()
-        dist_list[0].add(root)
-        while len(q) > 0:
-            # extract the current vertex
-            u = q.popleft()
-            d = dist[u] + 1
-            if d <= max_depth:
-                # iterate over the neighbors of the current vertex
-                for v in graph.neighbors(u):
+        # the frontier contains the vertices at the current distance
+        frontier = [root]
+        for d in range(1, max_depth + 1):
+            next_frontier = []
+            # iterate over the neighbors of the vertices in the frontier
+            for u in frontier:
+                for v in indices[indptr[u]:indptr[u + 1]]:
                     if v not in visited:
                         # skip nesting edge-nodes
-                        if not graph.nodes[v].get(self.key_nesting, False):
-                            dist[v] = d
+                        if not is_nesting[v]:
                             visited.add(v)
-                            q.append(v)
-                            if d in dist_list:
-                                dist_list[d].add(v)
-                            else:
-                                dist_list[d] = set()
-                                dist_list[d].add(v)
-        graph.nodes[root]['remote_neighbours'] = dist_list
-
-    def _compute_distant_neighbours(self, graph, max_depth):
-        for n in graph.nodes():
-            if graph.nodes[n].get('node', False):
-                self._single_vertex_breadth_first_visit(graph, n, max_depth)
+                            next_frontier.append(v)
+            if len(next_frontier) == 0:
+                break
+            dist_list.append(next_frontier)
+            frontier = next_frontier
+        return dist_list
+
+    def _compute_distant_neighbours(self, graph, max_depth, roots=None):
+        if roots is None:
+            roots = graph.node_vertices
+        engine = self.neighborhood_engine
+        if engine == 'auto':
+            large = len(roots) >= _SPARSE_ENGINE_MIN_ROOTS
+            engine = 'sparse' if large else 'bfs'
+        if engine == 'sparse':
+            self._compute_distant_neighbours_sparse(graph, max_depth, roots)
+            return
+        indptr = graph.indptr.tolist()
+        indices = graph.indices.tolist()
+        ids = graph.ids
+        index = {u: i for i, u in enumerate(ids)}
+        n_shells, shell_sizes, shell_vertex = [], [], []
+        for n in roots:
+            dist_list = self._single_vertex_breadth_first_visit(
+                indptr, indices, graph.is_nesting_list, n, max_depth)
+            n_shells.append(len(dist_list))
+            for node_set in dist_list:
+                # list the vertices of each shell in the iteration order of
+                # the set of their ids: floating point accumulations over
+                # the shells are then carried out in the same order as in
+                # the networkx based implementation and give identical
+                # results
+                shell_sizes.append(len(node_set))
+                shell_vertex.extend(index[u]
+                                    for u in set(ids[v] for v in node_set))
+        graph.set_shells(roots, n_shells, shell_sizes, shell_vertex)
+
+    def _compute_distant_neighbours_sparse(self, graph, max_depth, roots):
+        # compute the shells of all the roots at once with sparse matrix
+        # operations
+        root_pos, vertex, dist, n_shells = graph_batch.distance_shells(
+            graph, roots, max_depth)
+        first_shell = np.cumsum(n_shells) - n_shells
+        shell_sizes = np.bincount(first_shell[root_pos] + dist,
+                                  minlength=int(n_shells.sum()))
+        graph.set_shells(roots, n_shells, shell_sizes, vertex)
 
     def annotate(self,
                  graphs,
@@ -745,7 +1501,9 @@ class Vectorizer(AbstractVectorizer):
                  reweight=1.0,
                  threshold=None,
                  scale=1,
-                 vertex_features=False):
+                 vertex_features=False,
+                 block_size=1,
+                 inplace=False):
         """Return graphs with extra attributes: importance and features.
 
         Given a list of networkx graphs, if the given estimator is not None and
@@ -762,6 +1520,11 @@ class Vectorizer(AbstractVectorizer):
         estimator : scikit-learn estimator
             Scikit-learn predictor trained on data sampled from the same
             distribution. If None the vertex weights are set by default 1.
+            A dict name: estimator or a list of estimators annotates the
+            graphs with several models from a single vectorization: each
+            model writes the attributes 'importance_<name>' and
+            'class_<name>' (the name of a model in a list is its index)
+            and the weight is updated with the first model.
 
         reweight : float (default 1.0)
             The  coefficient used to weight the linear combination of the
@@ -786,144 +1549,1047 @@ class Vectorizer(AbstractVectorizer):
             created for each node that contains a CRS scipy sparse vector,
             and an attribute with key 'vector' is created that contains a
             python dictionary to store the key, values pairs.
+
+        block_size : int (default 1)
+            The number of graphs annotated together: the vertex matrices of
+            a block are stacked and scored with a single call of the
+            estimator. For linear classifiers the margins are computed
+            directly as the product of the matrix with coef_.
+
+        inplace : bool (default False)
+            If True the attributes are written in the nodes of the input
+            graphs, which are yielded, and the edges are left untouched.
+            For undirected simple graphs no copy of the graph is made; for
+            the others the annotation is computed on a copy and the node
+            attributes are copied back.
+
+        >>> import networkx as nx
+        >>> from sklearn.linear_model import SGDClassifier
+        >>> graphs = [nx.path_graph(n) for n in range(3, 9)]
+        >>> for g in graphs:
+        ...     nx.set_node_attributes(g, 'C', 'label')
+        ...     nx.set_edge_attributes(g, '1', 'label')
+        >>> v = Vectorizer()
+        >>> y = [1, -1, 1, -1, 1, -1]
+        >>> estimator = SGDClassifier(random_state=1).fit(v.transform(graphs), y)
+        >>> one = list(v.annotate(graphs, estimator=estimator))
+        >>> many = list(v.annotate(graphs, estimator=estimator, block_size=4))
+        >>> [one[i].nodes[0]['importance'] == many[i].nodes[0]['importance']
+        ...  for i in range(6)] == [True] * 6
+        True
+        >>> models = {'a': estimator, 'b': None}
+        >>> graph = next(v.annotate(graphs, estimator=models))
+        >>> print(graph.nodes[0]['importance_a'] ==
+        ...       one[0].nodes[0]['importance'])
+        True
+        >>> sorted(key for key in graph.nodes[0] if key.startswith('class'))
+        ['class_a', 'class_b']
+        >>> g = graphs[0].copy()
+        >>> g is next(v.annotate([g], estimator=estimator, inplace=True))
+        True
+        >>> print(g.nodes[0]['importance'] == one[0].nodes[0]['importance'])
+        True
         """
         self.estimator = estimator
         self.reweight = reweight
         self.threshold = threshold
         self.scale = scale
         self.vertex_features = vertex_features
+        self.inplace = inplace
 
-        for graph in graphs:
-            annotated_graph = self._annotate(graph)
-            yield annotated_graph
+        for chunk in partition_all(block_size, graphs):
+            for annotated_graph in self._annotate(chunk):
+                yield annotated_graph
 
-    def _annotate(self, original_graph):
+    def _annotate(self, original_graphs):
         # pre-processing phase: compute caches
+        items = [self._annotate_preprocessing(original_graph)
+                 for original_graph in original_graphs]
+        # extract per vertex feature representation of all the graphs
+        compact_graphs = [item[1] for item in items]
+        feature_list, offsets = self._compact_vertex_feature_list(
+            compact_graphs)
+        data_matrix = self._feature_matrix(feature_list)
+        # score all the vertices at once
+        graph_sizes = np.repeat([len(compact_graph)
+                                 for compact_graph in compact_graphs],
+                                np.diff(offsets))
+        scores = []
+        for suffix, estimator in self._named_estimators():
+            predictions, margins = self._compute_predictions_and_margins(
+                estimator, graph_sizes, data_matrix)
+            if self.threshold is not None:
+                margins[margins < self.threshold] = self.threshold
+            scores.append((suffix, predictions, margins))
+        annotated_graphs = []
+        for i, (original_graph, compact_graph, vertex_dicts, graph) in \
+                enumerate(items):
+            start, end = offsets[i], offsets[i + 1]
+            # add or update weight and importance information; the weight
+            # is updated with the first model
+            for j, (suffix, predictions, margins) in enumerate(scores):
+                self._annotate_importance(vertex_dicts, compact_graph,
+                                          predictions[start:end],
+                                          margins[start:end],
+                                          suffix=suffix,
+                                          update_weight=j == 0)
+            # add or update label information
+            if self.vertex_features:
+                self._annotate_vector(vertex_dicts, compact_graph,
+                                      data_matrix[start:end])
+            annotated_graphs.append(self._annotated_graph(
+                original_graph, compact_graph, vertex_dicts, graph))
+        return annotated_graphs
+
+    def _annotate_preprocessing(self, original_graph):
+        self._test_goodness(original_graph)
+        graph = None
+        if _is_implicitly_expandable(original_graph) and self.inplace:
+            compact_graph = self._graph_preprocessing(original_graph)
+            # write directly in the attributes of the nodes and of the edges
+            vertex_dicts = [data for u, data in
+                            original_graph.nodes(data=True)]
+            vertex_dicts += [data for u, v, data in compact_graph.edges]
+        elif _is_implicitly_expandable(original_graph):
+            compact_graph = self._graph_preprocessing(original_graph)
+            # the attributes of the vertices of the expanded graph are
+            # copies of the attributes of the nodes and of the edges
+            vertex_dicts = []
+            for u, data in original_graph.nodes(data=True):
+                vertex_dict = dict(data)
+                vertex_dict['node'] = True
+                vertex_dicts.append(vertex_dict)
+            for u, v, data in compact_graph.edges:
+                vertex_dict = {'edge': True}
+                vertex_dict.update(data)
+                vertex_dicts.append(vertex_dict)
+        else:
+            # work on a copy so that the input graph is not modified
+            graph = _edge_to_vertex_transform(original_graph.copy())
+            compact_graph = self._graph_preprocessing(graph)
+            vertex_dicts = [graph.nodes[u] for u in graph.nodes()]
+        return original_graph, compact_graph, vertex_dicts, graph
+
+    def _annotated_graph(self, original_graph, compact_graph, vertex_dicts,
+                         graph):
+        # graph is the expanded graph, if it was built explicitly
+        if self.inplace:
+            if graph is not None:
+                # copy back the attributes of the nodes
+                keys = self._annotation_keys()
+                for u, vertex_dict, is_node in zip(
+                        compact_graph.ids, vertex_dicts,
+                        compact_graph.is_node_list):
+                    if is_node:
+                        node_dict = original_graph.nodes[u]
+                        for key in keys:
+                            if key in vertex_dict:
+                                node_dict[key] = vertex_dict[key]
+            return original_graph
         graph_dict = original_graph.graph
-        graph = self._graph_preprocessing(original_graph)
-        # extract per vertex feature representation
-        data_matrix = self._compute_vertex_based_features(graph)
-        # add or update weight and importance information
-        graph = self._annotate_importance(graph, data_matrix)
-        # add or update label information
-        if self.vertex_features:
-            graph = self._annotate_vector(graph, data_matrix)
-        annotated_graph = _revert_edge_to_vertex_transform(graph)
+        if graph is not None:
+            annotated_graph = _revert_edge_to_vertex_transform(graph)
+        else:
+            # build the annotated graph directly from the vertex attributes
+            annotated_graph = nx.Graph()
+            n_nodes = original_graph.number_of_nodes()
+            for u, vertex_dict in zip(compact_graph.ids[:n_nodes],
+                                      vertex_dicts[:n_nodes]):
+                annotated_graph.add_node(u)
+                annotated_graph.nodes[u].update(vertex_dict)
+            for (u, v, data), vertex_dict in zip(compact_graph.edges,
+                                                 vertex_dicts[n_nodes:]):
+                annotated_graph.add_edge(u, v)
+                annotated_graph.edges[u, v].update(vertex_dict)
         annotated_graph.graph = graph_dict
         return annotated_graph
 
-    def _annotate_vector(self, graph, data_matrix):
+    def _annotate_vector(self, vertex_dicts, compact_graph, data_matrix):
         # annotate graph structure with vertex importance
         vertex_id = 0
-        for v in graph.nodes():
-            if graph.nodes[v].get('node', False):
+        for vertex_dict, is_node in zip(vertex_dicts,
+                                        compact_graph.is_node_list):
+            if is_node:
                 # annotate 'vector' information
                 row = data_matrix.getrow(vertex_id)
-                graph.nodes[v]['features'] = row
+                vertex_dict['features'] = row
                 vec_dict = {str(index): value
                             for index, value in zip(row.indices, row.data)}
-                graph.nodes[v]['vector'] = vec_dict
+                vertex_dict['vector'] = vec_dict
                 vertex_id += 1
-        return graph
 
-    def _compute_predictions_and_margins(self, graph, data_matrix):
-        def _null_estimator_case(graph, data_matrix):
+    def _annotation_keys(self):
+        # the node attributes written by the annotation
+        keys = [self.key_weight]
+        for suffix, estimator in self._named_estimators():
+            keys += [self.key_class + suffix, self.key_importance + suffix]
+        if self.vertex_features:
+            keys += ['features', 'vector']
+        return keys
+
+    def _named_estimators(self):
+        # list of (attribute suffix, estimator) of the models to apply
+        if isinstance(self.estimator, dict):
+            return [('_%s' % name, estimator)
+                    for name, estimator in self.estimator.items()]
+        if isinstance(self.estimator, (list, tuple)):
+            return [('_%d' % i, estimator)
+                    for i, estimator in enumerate(self.estimator)]
+        return [('', self.estimator)]
+
+    def _compute_predictions_and_margins(self, estimator, graph_sizes,
+                                         data_matrix):
+        # graph_sizes: the number of vertices (nodes and edges) of the
+        # graph of each row of the data_matrix
+        def _null_estimator_case(graph_sizes, data_matrix):
             # if we do not provide an estimator then consider default margin of
             # 1/float(len(graph)) for all vertices
-            n = len(graph)
             m = data_matrix.shape[0]
-            importances = np.array([1 / n] * m, dtype=np.float64)
+            importances = 1 / graph_sizes.astype(np.float64)
             predictions = np.array([1] * m)
             return predictions, importances
 
-        def _binary_classifier_case(graph, data_matrix):
-            predictions = self.estimator.predict(data_matrix)
-            importances = self.estimator.decision_function(data_matrix)
+        def _binary_classifier_case(graph_sizes, data_matrix):
+            if _is_linear_classifier(estimator):
+                # the margin of a linear model is a matrix vector product
+                importances = data_matrix.dot(estimator.coef_[0]) + \
+                    estimator.intercept_[0]
+                ids = (importances > 0).astype(int)
+                predictions = estimator.classes_[ids]
+            else:
+                predictions = estimator.predict(data_matrix)
+                importances = estimator.decision_function(data_matrix)
             return predictions, importances
 
-        def _regression_case(graph, data_matrix):
-            predicted_score = self.estimator.predict(data_matrix)
+        def _regression_case(graph_sizes, data_matrix):
+            predicted_score = estimator.predict(data_matrix)
             p = [1 if v >= 0 else -1 for v in predicted_score]
             predictions = np.array(p)
             return predictions, predicted_score
 
-        def _multiclass_case(graph, data_matrix):
+        def _multiclass_case(graph_sizes, data_matrix):
             # when prediction is multiclass, use as importance the max
             # prediction
-            n = len(graph)
-            predictions = self.estimator.predict(data_matrix)
-            predicted_score = self.estimator.decision_function(data_matrix)
+            predictions = estimator.predict(data_matrix)
+            predicted_score = estimator.decision_function(data_matrix)
             ids = np.argmax(predicted_score, axis=1)
-            s = [row[col] for row, col in zip(predicted_score, ids)]
-            scores = np.array(s)
-            b = [self.estimator.intercept_[id] for id in ids]
-            intercepts = np.array(b)
-            importances = scores - intercepts + intercepts / n
+            scores = predicted_score[np.arange(len(ids)), ids]
+            intercepts = np.asarray(estimator.intercept_)[ids]
+            importances = scores - intercepts + intercepts / graph_sizes
             return predictions, importances
 
-        if self.estimator is None:
-            return _null_estimator_case(graph, data_matrix)
-        if self.estimator.__class__.__name__ in ['SGDRegressor']:
-            return _regression_case(graph, data_matrix)
+        if estimator is None:
+            return _null_estimator_case(graph_sizes, data_matrix)
+        if estimator.__class__.__name__ in ['SGDRegressor']:
+            return _regression_case(graph_sizes, data_matrix)
         else:
-            data_dim = self.estimator.intercept_.shape[0]
+            data_dim = estimator.intercept_.shape[0]
             if data_dim > 1:
-                return _multiclass_case(graph, data_matrix)
+                return _multiclass_case(graph_sizes, data_matrix)
             else:
-                return _binary_classifier_case(graph, data_matrix)
+                return _binary_classifier_case(graph_sizes, data_matrix)
 
-    def _annotate_importance(self, graph, data_matrix):
-        predictions, margins = self._compute_predictions_and_margins(
-            graph, data_matrix)
-        if self.threshold is not None:
-            margins[margins < self.threshold] = self.threshold
+    def _annotate_importance(self, vertex_dicts, compact_graph,
+                             predictions, margins, suffix='',
+                             update_weight=True):
         # annotate graph structure with vertex importance
+        key_class = self.key_class + suffix
+        key_importance = self.key_importance + suffix
         vertex_id = 0
-        for v in graph.nodes():
-            if graph.nodes[v].get('node', False):
-                graph.nodes[v][self.key_class] = predictions[vertex_id]
+        for u, vertex_dict in enumerate(vertex_dicts):
+            if compact_graph.is_node_list[u]:
+                vertex_dict[key_class] = predictions[vertex_id]
                 # annotate the 'importance' attribute with the margin
-                graph.nodes[v][self.key_importance] = margins[vertex_id]
+                vertex_dict[key_importance] = margins[vertex_id]
+                if not update_weight:
+                    vertex_id += 1
+                    continue
                 # update the self.key_weight information as a linear
                 # combination of the previous weight and the absolute margin
-                if self.key_weight in graph.nodes[v] and self.reweight != 0:
-                    graph.nodes[v][self.key_weight] = self.reweight * \
+                # (in weighted graphs a missing weight defaults to 1)
+                has_weight = compact_graph.weighted or \
+                    self.key_weight in vertex_dict
+                if has_weight and self.reweight != 0:
+                    vertex_dict[self.key_weight] = self.reweight * \
                         abs(margins[vertex_id]) +\
                         (1 - self.reweight) * \
-                        graph.nodes[v][self.key_weight]
+                        compact_graph.connection_weight_list[u]
                 # in case the original graph was not weighted then instantiate
                 # the self.key_weight with the absolute margin
                 else:
-                    graph.nodes[v][self.key_weight] = abs(margins[vertex_id])
+                    vertex_dict[self.key_weight] = abs(margins[vertex_id])
                 # in all cases, rescale the weight by the scale factor
-                graph.nodes[v][self.key_weight] *= self.scale
+                vertex_dict[self.key_weight] *= self.scale
                 vertex_id += 1
-            if graph.nodes[v].get('edge', False):  # keep the weight of edges
+            elif not self.inplace:  # keep the weight of edges
                 # ..unless they were unweighted, in this case add unit weight
-                if self.key_weight not in graph.nodes[v]:
-                    graph.nodes[v][self.key_weight] = 1
-        return graph
+                if self.key_weight not in vertex_dict:
+                    vertex_dict[self.key_weight] = 1
 
-    def _compute_vertex_based_features(self, graph):
-        feature_rows = []
-        for v in graph.nodes():
-            # only for vertices of type 'node', i.e. not for the 'edge' type
-            if graph.nodes[v].get('node', False):
-                feature_list = defaultdict(lambda: defaultdict(float))
-                self._transform_vertex(graph, v, feature_list)
-                feature_rows.append(self._normalization(feature_list))
-        data_matrix = self._convert_dict_to_sparse_matrix(feature_rows)
-        return data_matrix
+    def incremental_transform(self, graph):
+        """Return an IncrementalGraph to update the vector of graph after edits.
+
+        Parameters
+        ----------
+        graph : networkx graph
+            The graph to edit; it is copied and not modified.
+
+        Returns
+        -------
+        incremental_graph : IncrementalGraph
+        """
+        return IncrementalGraph(graph, self)
+
+
+class IncrementalGraph(object):
+    """Feature vector of a graph maintained under local edits.
+
+    The contribution of each vertex to the feature vector is kept. After an
+    edit only the vertices within distance 2 * (r + d) + 2 of the edited
+    vertices in the edge to vertex expanded graph (before or after the edit)
+    can change their contribution, so only their distance shells,
+    neighborhood hashes and pair features are recomputed. The feature
+    vector is equal to the one computed by Vectorizer.transform on the
+    edited graph, up to the rounding of the floating point sums.
+
+    In positional mode the ids of the edge-vertices depend on the whole
+    graph, so all the vertices are recomputed.
+
+    >>> import networkx as nx
+    >>> g = nx.path_graph(8)
+    >>> for n, d in g.nodes(data=True):
+    ...     d['label'] = 'C'
+    >>> for a, b, d in g.edges(data=True):
+    ...     d['label'] = '1'
+    >>> v = Vectorizer(r=1, d=1)
+    >>> inc = v.incremental_transform(g)
+    >>> data_matrix, vertex_data_matrix = inc.set_node_attributes(7, label='N')
+    >>> inc.n_updated_vertices
+    4
+    >>> g.nodes[7]['label'] = 'N'
+    >>> print(abs(data_matrix - v.transform([g])).max() < 1e-12)
+    True
+    >>> data_matrix, vertex_data_matrix = inc.add_edge(0, 7, label='2')
+    >>> g.add_edge(0, 7, label='2')
+    >>> print(abs(data_matrix - v.transform([g])).max() < 1e-12)
+    True
+    >>> print(abs(vertex_data_matrix - v.vertex_transform([g])[0]).max() < 1e-12)
+    True
+    """
+
+    def __init__(self, graph, vectorizer):
+        """Vectorize the graph and keep the contribution of each vertex."""
+        self.vectorizer = vectorizer
+        self.graph = graph.copy()
+        self.n_updated_vertices = 0
+        # per node id: raw feature contribution and normalized vertex row
+        self._contributions = dict()
+        self._vertex_rows = dict()
+        self._compact_graph = None
+        self._update(None)
+
+    def transform(self):
+        """Return the feature vector of the current graph."""
+        feature_list = FeatureAccumulator()
+        feature_list.new_row()
+        for u in self._node_ids():
+            feature_list.extend(self._contributions[u])
+        return self.vectorizer._feature_matrix(feature_list)
+
+    def vertex_transform(self):
+        """Return the n_nodes x n_features matrix of the vertex features."""
+        return vstack([self._vertex_rows[u] for u in self._node_ids()],
+                      format='csr')
+
+    def set_node_attributes(self, u, **attributes):
+        """Update the attributes (e.g. the label) of node u."""
+        self.graph.nodes[u].update(attributes)
+        return self._edit([u])
+
+    def set_edge_attributes(self, u, v, **attributes):
+        """Update the attributes (e.g. the label) of the edge u, v."""
+        self.graph.edges[u, v].update(attributes)
+        return self._edit([u, v])
+
+    def add_edge(self, u, v, **attributes):
+        """Add the edge u, v."""
+        self.graph.add_edge(u, v, **attributes)
+        return self._edit([u, v])
+
+    def remove_edge(self, u, v):
+        """Remove the edge u, v."""
+        self.graph.remove_edge(u, v)
+        return self._edit([u, v])
+
+    def _edit(self, node_ids):
+        self._update(node_ids)
+        return self.transform(), self.vertex_transform()
+
+    def _node_ids(self):
+        graph = self._compact_graph
+        return [graph.ids[v] for v in graph.node_vertices]
+
+    def _update(self, edited_ids):
+        vec = self.vectorizer
+        old_graph = self._compact_graph
+        graph = vec._compact_graph(self.graph)
+        self._compact_graph = graph
+        index = {u: i for i, u in enumerate(graph.ids)}
+        recompute_all = edited_ids is None or vec.positional or \
+            old_graph.weighted != graph.weighted
+        if recompute_all:
+            roots = graph.node_vertices
+        else:
+            max_depth = 2 * (vec.r + vec.d) + 2
+            old_index = {u: i for i, u in enumerate(old_graph.ids)}
+            affected = set(graph.ids[v] for v in _vertices_within(
+                graph, [index[u] for u in edited_ids], max_depth))
+            affected.update(old_graph.ids[v] for v in _vertices_within(
+                old_graph, [old_index[u] for u in edited_ids
+                            if u in old_index], max_depth))
+            affected.update(u for u in graph.ids
+                            if u not in self._contributions)
+            roots = [v for v in graph.node_vertices
+                     if graph.ids[v] in affected]
+        # the shells are needed for the roots and for the second endpoints
+        # of their nesting edges
+        shell_roots = set(roots)
+        for v in roots:
+            shell_roots.update(endpoint for endpoint, _ in
+                               vec._find_second_endpoint_of_nesting_edge(
+                                   graph, v))
+        max_depth = max(vec.r, vec.d) * 2
+        vec._compute_distant_neighbours(graph, max_depth,
+                                        roots=sorted(shell_roots))
+        vec._compute_neighborhood_graph_hash_cache(graph, roots=roots)
+        if graph.weighted:
+            vec._compute_neighborhood_graph_weight_cache(graph, roots=roots)
+        if not recompute_all:
+            # the hashes and weights of the other vertices are unchanged
+            root_set = set(roots)
+            for v in graph.node_vertices:
+                if v not in root_set:
+                    old_v = old_index[graph.ids[v]]
+                    graph.neigh_graph_hash[v] = old_graph.neigh_graph_hash[
+                        old_v]
+                    if graph.weighted:
+                        graph.neigh_graph_weight[v] = \
+                            old_graph.neigh_graph_weight[old_v]
+        node_ids = set(self._node_ids())
+        for u in list(self._contributions):
+            if u not in node_ids:
+                del self._contributions[u]
+                del self._vertex_rows[u]
+        for v in roots:
+            feature_list = FeatureAccumulator()
+            feature_list.new_row()
+            vec._transform_vertex(graph, v, feature_list)
+            self._contributions[graph.ids[v]] = feature_list
+            self._vertex_rows[graph.ids[v]] = vec._feature_matrix(feature_list)
+        self.n_updated_vertices = len(roots)
+
+
+class MultiVectorizer(object):
+    """Vectorize graphs with several configurations of the Vectorizer at once.
+
+    The edge to vertex expansion, the distance shells and the neighborhood
+    hashes do not depend on the radius and the distance: they are computed
+    once per graph, up to the largest radius and distance, and shared by
+    all the configurations. Only the configurations that hash the labels in
+    the same way (key_label, key_weight, key_nesting, nbits, hashing,
+    positional, discrete, key_vec, key_svec) share the hashes; the shells
+    are shared by all the configurations with the same key_nesting. The
+    pair features and the normalization are specific to each configuration.
+
+    >>> import networkx as nx
+    >>> g = nx.path_graph(6)
+    >>> nx.set_node_attributes(g, 'C', 'label')
+    >>> nx.set_edge_attributes(g, '1', 'label')
+    >>> configurations = [dict(r=1, d=2), dict(r=3, d=1, nbits=12),
+    ...                   dict(r=2, d=2, normalization=False)]
+    >>> matrices = MultiVectorizer(configurations).transform([g, g])
+    >>> [bool(abs(x - Vectorizer(**c).transform([g, g])).max() < 1e-12)
+    ...  for x, c in zip(matrices, configurations)]
+    [True, True, True]
+    """
+
+    def __init__(self, configurations):
+        """Constructor.
+
+        Parameters
+        ----------
+        configurations : list of dicts or Vectorizers
+            The parameters of each Vectorizer.
+        """
+        self.vectorizers = [config if isinstance(config, Vectorizer)
+                            else Vectorizer(**config)
+                            for config in configurations]
+        if len(self.vectorizers) == 0:
+            raise Exception('ERROR: no configurations.')
+        self.max_depth = max(max(v.r, v.d) for v in self.vectorizers) * 2
+        # the first vectorizer of each group of configurations that share
+        # the hashes computes the compact graph of the group
+        self._preprocessors = []
+        self._groups = []
+        keys = []
+        for vectorizer in self.vectorizers:
+            key = _preprocessing_key(vectorizer)
+            if key not in keys:
+                keys.append(key)
+                self._preprocessors.append(vectorizer)
+            self._groups.append(keys.index(key))
+        # the hashes of each group are computed up to its largest radius
+        self._max_r = [max(v.r for v, group in zip(self.vectorizers,
+                                                   self._groups)
+                           if group == i)
+                       for i in range(len(self._preprocessors))]
+
+    def transform(self, graphs, n_jobs=1, chunk_size=100, backend='process'):
+        """Transform a list of networkx graphs into one matrix per configuration.
+
+        Parameters
+        ----------
+        graphs : iterable over networkx graphs
+            The graphs to vectorize.
+
+        n_jobs, chunk_size, backend
+            As in Vectorizer.transform.
+
+        Returns
+        -------
+        data_matrices : list of array-like, shape = [n_graphs, n_features]
+            The matrix of each configuration, in the order of the
+            configurations.
+        """
+        if effective_n_jobs(n_jobs) != 1:
+            results = list(_parallel_map(_multi_transform_chunk,
+                                         self, graphs,
+                                         n_jobs=n_jobs,
+                                         chunk_size=chunk_size,
+                                         backend=backend))
+            if len(results) == 0:
+                raise Exception('ERROR: something went wrong:\
+                    no graphs are present in current iterator.')
+            return [vstack(blocks, format='csr') for blocks in zip(*results)]
+        feature_lists = [FeatureAccumulator() for _ in self.vectorizers]
+        for original_graph in graphs:
+            self.vectorizers[0]._test_goodness(original_graph)
+            compact_graphs = self._compact_graphs(original_graph)
+            for vectorizer, group, feature_list in zip(self.vectorizers,
+                                                       self._groups,
+                                                       feature_lists):
+                feature_list.new_row()
+                vectorizer._transform_compact_graph(compact_graphs[group],
+                                                    feature_list)
+        if feature_lists[0].n_rows == 0:
+            raise Exception('ERROR: something went wrong:\
+                no graphs are present in current iterator.')
+        return [vectorizer._feature_matrix(feature_list)
+                for vectorizer, feature_list in zip(self.vectorizers,
+                                                    feature_lists)]
+
+    def _compact_graphs(self, original_graph):
+        # the compact graph of each group, with the shells computed once
+        # for each way of marking the nesting edges
+        compact_graphs = []
+        shells = dict()
+        for vectorizer, max_r in zip(self._preprocessors, self._max_r):
+            graph = vectorizer._compact_graph(original_graph)
+            if vectorizer.key_nesting in shells:
+                graph.copy_shells(shells[vectorizer.key_nesting])
+            else:
+                vectorizer._compute_distant_neighbours(graph, self.max_depth)
+                shells[vectorizer.key_nesting] = graph
+            vectorizer._compute_neighborhood_graph_hash_cache(graph,
+                                                              max_r=max_r)
+            if graph.weighted:
+                vectorizer._compute_neighborhood_graph_weight_cache(graph)
+            compact_graphs.append(graph)
+        return compact_graphs
+
+
+class BlockFeatures(object):
+    """Un-normalized features of graphs, tagged by (radius, distance) block.
+
+    Computed by Vectorizer.block_transform. The feature vectors of a sub
+    range of radii and distances are assembled by selecting the blocks and
+    normalizing again, and are the same as the ones computed by transform
+    with the corresponding parameters.
+
+    >>> import networkx as nx
+    >>> g = nx.path_graph(6)
+    >>> nx.set_node_attributes(g, 'C', 'label')
+    >>> nx.set_edge_attributes(g, '1', 'label')
+    >>> block_features = Vectorizer(r=3, d=3).block_transform([g, g])
+    >>> x = block_features.assemble(min_r=1, r=2, d=1)
+    >>> print(abs(x - Vectorizer(min_r=1, r=2, d=1).transform([g, g])).max())
+    0.0
+    >>> weights_dict = {(1, 1): 2.0, (2, 0): 1.0}
+    >>> x = block_features.assemble(weights_dict=weights_dict)
+    >>> v = Vectorizer(r=3, d=3, weights_dict=weights_dict)
+    >>> print(abs(x - v.transform([g, g])).max())
+    0.0
+    >>> # the blocks with zero weight are computed too
+    >>> block_features = v.block_transform([g, g])
+    >>> x = block_features.assemble(weights_dict={(0, 2): 1.0, (1, 1): 1.0})
+    >>> v = Vectorizer(r=3, d=3, weights_dict={(0, 2): 1.0, (1, 1): 1.0})
+    >>> print(abs(x - v.transform([g, g])).max())
+    0.0
+    """
+
+    def __init__(self, vectorizer, n_rows, rows, blocks, features, values,
+                 first):
+        """Constructor; see Vectorizer.block_transform."""
+        v = vectorizer
+        self.r, self.d, self.min_r, self.min_d = v.r, v.d, v.min_r, v.min_d
+        self.weights_dict = v.weights_dict
+        self.normalization = v.normalization
+        self.inner_normalization = v.inner_normalization
+        self.feature_size = v.feature_size
+        self.n_rows = n_rows
+        # one entry per (row, block, feature), see group_records
+        self.rows = rows
+        self.blocks = blocks
+        self.features = features
+        self.values = values
+        self.first = first
+
+    @property
+    def block_keys(self):
+        """The (radius, distance) of each block id."""
+        return [(radius, distance)
+                for radius in range(self.r + 1)
+                for distance in range(self.d + 1)]
+
+    def block_matrix(self):
+        """Return the tagged matrix of the un-normalized features.
+
+        The column block * feature_size + feature holds the value of the
+        feature in the block with (radius, distance) = block_keys[block].
+        """
+        columns = self.blocks * self.feature_size + self.features
+        shape = (self.n_rows, len(self.block_keys) * self.feature_size)
+        return csr_matrix((self.values, (self.rows, columns)), shape=shape)
+
+    def assemble(self, min_r=None, r=None, min_d=None, d=None,
+                 weights_dict=None, normalization=None,
+                 inner_normalization=None):
+        """Return the feature vectors for a sub range of radii and distances.
+
+        Parameters
+        ----------
+        min_r, r, min_d, d : int (default: the values of the vectorizer)
+            The range of radii and distances, within the one computed.
+
+        weights_dict : dict (default: the one of the vectorizer)
+            The (radius, distance): weight of the blocks; blocks with no or
+            zero weight are discarded.
+
+        normalization, inner_normalization : bool (default: the values of
+            the vectorizer)
+            The normalization flags.
+
+        Returns
+        -------
+        data_matrix : array-like, shape = [n_graphs, n_features]
+        """
+        min_r = self.min_r if min_r is None else min_r
+        r = self.r if r is None else r
+        min_d = self.min_d if min_d is None else min_d
+        d = self.d if d is None else d
+        if weights_dict is None:
+            weights_dict = self.weights_dict
+        if normalization is None:
+            normalization = self.normalization
+        if inner_normalization is None:
+            inner_normalization = self.inner_normalization
+        if min_r < self.min_r or r > self.r or min_d < self.min_d or \
+                d > self.d:
+            raise Exception('ERROR: the range r=%d..%d d=%d..%d is not '
+                            'within the computed one r=%d..%d d=%d..%d' %
+                            (min_r, r, min_d, d, self.min_r, self.r,
+                             self.min_d, self.d))
+        selected_blocks = np.zeros(len(self.block_keys), dtype=bool)
+        block_weights = dict()
+        for block, (radius, distance) in enumerate(self.block_keys):
+            if min_r <= radius <= r and min_d <= distance <= d:
+                if weights_dict is None:
+                    selected_blocks[block] = True
+                elif weights_dict.get((radius, distance), 0) != 0:
+                    selected_blocks[block] = True
+                    block_weights[block] = weights_dict[(radius, distance)]
+        selected = selected_blocks[self.blocks]
+        return grouped_feature_matrix(
+            self.rows[selected], self.blocks[selected],
+            self.features[selected], self.values[selected],
+            self.first[selected],
+            n_rows=self.n_rows,
+            n_features=self.feature_size,
+            inner_normalization=inner_normalization,
+            normalization=normalization,
+            block_weights=block_weights)
+
+
+def _preprocessing_key(vectorizer):
+    # the parameters that determine the compact graph and the hashes
+    v = vectorizer
+    vec_keys = None if v.discrete else (v.key_vec, v.key_svec)
+    return (v.key_label, v.key_weight, v.key_nesting, v.nbits, v.hashing,
+            v.positional, v.discrete, vec_keys)
+
+
+def _vertices_within(graph, sources, max_depth):
+    # all the vertices at distance at most max_depth from the sources,
+    # following also the nesting edges
+    indptr = graph.indptr.tolist()
+    indices = graph.indices.tolist()
+    visited = set(sources)
+    frontier = list(visited)
+    for d in range(max_depth):
+        next_frontier = []
+        for u in frontier:
+            for v in indices[indptr[u]:indptr[u + 1]]:
+                if v not in visited:
+                    visited.add(v)
+                    next_frontier.append(v)
+        frontier = next_frontier
+    return visited
 
 
 # -------------------------------------------------------------------
 
-def _label_preprocessing(graph,
-                         key_label='label',
-                         bitmask=2 ** 20 - 1):
-    for n in graph.nodes():
-        label = graph.nodes[n][key_label]
-        graph.nodes[n]['hlabel'] = int(hash(label) & bitmask) + 1
+# vectorizer and shared graphs installed in each worker process by
+# _init_worker
+_worker_state = dict()
+
+
+def _init_worker(vectorizer, graphs):
+    _worker_state['vectorizer'] = vectorizer
+    _worker_state['graphs'] = graphs
+
+
+def _run_chunk(func, chunk, vectorizer=None, graphs=None):
+    if vectorizer is None:
+        vectorizer = _worker_state['vectorizer']
+        graphs = _worker_state['graphs']
+    # a chunk is either a list of graphs or the slice of the shared graphs
+    if isinstance(chunk, slice):
+        chunk = graphs[chunk]
+    return func(vectorizer, chunk)
+
+
+def _transform_chunk(vectorizer, graphs):
+    return vectorizer.transform(graphs)
+
+
+def _multi_transform_chunk(multi_vectorizer, graphs):
+    return multi_vectorizer.transform(graphs)
+
+
+def _vertex_transform_chunk(vectorizer, graphs):
+    return vectorizer.vertex_transform(graphs, stacked=True)
+
+
+def _transform_with_vertices_chunk(vectorizer, graphs):
+    return vectorizer.transform_with_vertices(graphs)
+
+
+def _concatenate_offsets(offsets_list):
+    # join the row offsets of consecutive blocks of graphs
+    offsets, shift = [np.zeros(1, dtype=np.int64)], 0
+    for block_offsets in offsets_list:
+        offsets.append(block_offsets[1:] + shift)
+        shift += block_offsets[-1]
+    return np.concatenate(offsets)
+
+
+def _check_worker_hashing(obj, start_method, hash_seed=None):
+    """Raise if worker processes would hash strings differently.
+
+    The builtin hash of strings is salted per interpreter: processes that
+    are not forked get their own salt, and so different feature ids, unless
+    PYTHONHASHSEED (read from the environment if hash_seed is None) fixes
+    it in the environment they inherit.
+
+    >>> _check_worker_hashing(Vectorizer(), 'spawn', hash_seed='random')
+    Traceback (most recent call last):
+    ...
+    Exception: ERROR: with the spawn start method worker processes hash strings differently: set PYTHONHASHSEED, use hashing='stable' or backend='thread'.
+    >>> _check_worker_hashing(Vectorizer(), 'spawn', hash_seed='0')
+    >>> _check_worker_hashing(Vectorizer(), 'fork', hash_seed='random')
+    >>> _check_worker_hashing(Vectorizer(hashing='stable'), 'spawn',
+    ...                       hash_seed='random')
+    """
+    if hash_seed is None:
+        hash_seed = os.environ.get('PYTHONHASHSEED', 'random')
+    if start_method == 'fork' or hash_seed != 'random':
+        return
+    vectorizers = [obj] + list(getattr(obj, 'vectorizers', [])) + \
+        [getattr(obj, 'vectorizer', None)]
+    for vectorizer in vectorizers:
+        if getattr(vectorizer, 'hashing', None) == 'builtin':
+            raise Exception('ERROR: with the %s start method worker '
+                            'processes hash strings differently: set '
+                            'PYTHONHASHSEED, use hashing=\'stable\' or '
+                            'backend=\'thread\'.' % start_method)
+
+
+def _parallel_map(func, vectorizer, graphs, n_jobs=-1, chunk_size=100,
+                  backend='process', mp_context=None):
+    """Apply func(vectorizer, chunk) to chunks of graphs in parallel.
+
+    The results are yielded in input order. The graphs are consumed lazily:
+    at most 2 * n_jobs chunks are in flight at any time. The vectorizer is
+    sent once to each worker process rather than with each chunk. When the
+    graphs are in a list that the workers can read directly (threads, or
+    processes created by fork) only slices are sent, so that the graphs are
+    never copied.
+
+    Every call creates its own pool, which lives until the results are
+    consumed: transform_iter calls this function once for the whole stream
+    of graphs, not once per block.
+
+    The worker processes are created with mp_context, by default the
+    context of the global start method. Worker processes that are not
+    forked hash strings with their own salt: with the builtin hashing
+    scheme they are used only if PYTHONHASHSEED is set (see
+    _check_worker_hashing).
+
+    >>> import networkx as nx
+    >>> g = nx.path_graph(4)
+    >>> for n, d in g.nodes(data=True):
+    ...     d['label'] = 'CNO'[n % 3]
+    >>> for a, b, d in g.edges(data=True):
+    ...     d['label'] = '1'
+    >>> v = Vectorizer(r=2, d=2, hashing='stable')
+    >>> blocks = _parallel_map(_transform_chunk, v, [g, g, g], n_jobs=2,
+    ...                        chunk_size=1,
+    ...                        mp_context=mp.get_context('spawn'))
+    >>> x = vstack(list(blocks))
+    >>> print(abs(x - v.transform([g, g, g])).max() < 1e-12)
+    True
+    """
+    context = mp_context if mp_context is not None else mp.get_context()
+    n_jobs = effective_n_jobs(n_jobs)
+    if backend not in ('process', 'thread'):
+        raise Exception('ERROR: unknown backend: %s' % backend)
+    if backend == 'process':
+        _check_worker_hashing(vectorizer, context.get_start_method())
+    shared = isinstance(graphs, (list, tuple)) and \
+        (backend == 'thread' or context.get_start_method() == 'fork')
+    if shared:
+        chunks = (slice(start, start + chunk_size)
+                  for start in range(0, len(graphs), chunk_size))
+    else:
+        chunks = (list(chunk) for chunk in partition_all(chunk_size, graphs))
+    if backend == 'thread':
+        pool = ThreadPool(n_jobs)
+        extra_args = (vectorizer, graphs)
+    else:
+        # with fork the initializer arguments are inherited, not pickled
+        pool = context.Pool(n_jobs, initializer=_init_worker,
+                            initargs=(vectorizer,
+                                      graphs if shared else None))
+        extra_args = ()
+    try:
+        results = deque()
+        for chunk in chunks:
+            if len(results) >= 2 * n_jobs:
+                yield results.popleft().get()
+            results.append(pool.apply_async(_run_chunk,
+                                            (func, chunk) + extra_args))
+        while results:
+            yield results.popleft().get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+class _NestedFeatures(defaultdict):
+    # block -> feature -> value, with the add method of FeatureAccumulator;
+    # it collects the features of a single vertex before they are combined
+    # with the vector labels
+
+    def __init__(self):
+        super(_NestedFeatures, self).__init__(lambda: defaultdict(float))
+
+    def add(self, block, feature, value):
+        self[block][feature] += value
+
+    def add_many(self, blocks, features, value):
+        for block, feature in zip(blocks, features):
+            self[block][feature] += value
+
+
+class _CompactGraph(object):
+    """Array based representation of an edge to vertex expanded graph.
+
+    The adjacency is stored in compressed sparse row format
+    (indptr, indices), the hashed labels, weights and vertex types are
+    stored in arrays. The caches computed by the vectorizer (distance
+    shells, neighborhood hashes and weights) are attached to this object
+    so that the networkx graph is not used after the conversion.
+
+    For an undirected simple graph the expansion is implicit: the nodes are
+    the vertices 0..n_nodes-1 in the node order of the networkx graph and
+    the edge-vertex of the k-th edge (self loops excluded) is the vertex
+    n_nodes + k; the edges are listed in the edges attribute. No expanded
+    networkx graph is built. Otherwise the graph is expanded with
+    _edge_to_vertex_transform (if not already expanded), the vertices follow
+    its node order and edges is None.
+    """
+
+    def __init__(self,
+                 graph,
+                 key_label='label',
+                 key_weight='weight',
+                 key_nesting='nesting',
+                 key_vec=None,
+                 key_svec=None,
+                 bitmask=2 ** 20 - 1,
+                 label_hash=hash):
+        """Convert a networkx graph."""
+        if _is_implicitly_expandable(graph):
+            nodes = list(graph.nodes(data=True))
+            self.ids = [u for u, data in nodes]
+            index = {u: i for i, u in enumerate(self.ids)}
+            self.edges = [(u, v, data) for u, v, data in graph.edges(data=True)
+                          if u != v]
+            n_nodes = len(nodes)
+            # the edge-vertices are numbered after the largest node id as in
+            # _edge_to_vertex_transform
+            w = 1 + max(self.ids)
+            self.ids.extend(range(w, w + len(self.edges)))
+            adjacency = [[] for u in range(n_nodes)]
+            for k, (u, v, data) in enumerate(self.edges):
+                adjacency[index[u]].append(n_nodes + k)
+                adjacency[index[v]].append(n_nodes + k)
+            adjacency.extend([index[u], index[v]] for u, v, data in self.edges)
+            vertex_data = [data for u, data in nodes] + \
+                [data for u, v, data in self.edges]
+            is_node = [True] * n_nodes + \
+                [bool(data.get('node', False)) for u, v, data in self.edges]
+        else:
+            graph = _edge_to_vertex_transform(graph)
+            self.ids = list(graph.nodes())
+            index = {u: i for i, u in enumerate(self.ids)}
+            self.edges = None
+            adj = graph.adj
+            adjacency = [[index[v] for v in adj[u]] for u in self.ids]
+            vertex_data = [data for u, data in graph.nodes(data=True)]
+            is_node = [bool(data.get('node', False)) for data in vertex_data]
+        indptr, indices = [0], []
+        hlabel, is_nesting, weight = [], [], []
+        self.weighted = False
+        for neighbors, data in zip(adjacency, vertex_data):
+            indices.extend(neighbors)
+            indptr.append(len(indices))
+            hlabel.append(int(label_hash(data[key_label]) & bitmask) + 1)
+            is_nesting.append(bool(data.get(key_nesting, False)))
+            # if at least one vertex or edge is weighted then all vertices
+            # and edges are weighted using a default weight of 1 if the
+            # weight attribute is missing
+            w = data.get(key_weight, False)
+            if w:
+                self.weighted = True
+            weight.append(1 if w is False else w)
+        self.indptr = np.array(indptr, dtype=np.int64)
+        self.indices = np.array(indices, dtype=np.int64)
+        self.degree = np.diff(self.indptr)
+        self.hlabel = np.array(hlabel, dtype=np.int64)
+        self.is_node = np.array(is_node, dtype=bool)
+        self.is_nesting = np.array(is_nesting, dtype=bool)
+        self.weight = np.array(weight, dtype=np.float64)
+        self.node_vertices = np.flatnonzero(self.is_node).tolist()
+        self.has_nesting = bool(self.is_nesting.any())
+        # plain lists for the scalar accesses in the inner loops
+        self.is_node_list = is_node
+        self.is_nesting_list = is_nesting
+        self.connection_weight_list = weight
+        # vector labels are needed only for the non discrete case
+        self.vec = [None] * len(self.ids)
+        if key_vec:
+            self.vec = [data.get(key_vec, None) for data in vertex_data]
+        self.svec = [None] * len(self.ids)
+        if key_svec:
+            self.svec = [data.get(key_svec, None) for data in vertex_data]
+        # caches filled by the vectorizer
+        self.n_shells = None
+        self.first_shell = None
+        self.shell_offsets = None
+        self.shell_vertex = None
+        self.neigh_graph_hash = None
+        self.neigh_graph_weight = None
+
+    def __len__(self):
+        """Number of vertices."""
+        return len(self.ids)
+
+    def set_shells(self, roots, n_shells, shell_sizes, shell_vertex):
+        """Store the distance shells as flat arrays.
+
+        Parameters
+        ----------
+        roots : list of int
+            The vertices for which the shells are given.
+
+        n_shells : list of int
+            The number of shells (distances 0, 1, ...) of each root.
+
+        shell_sizes : list of int
+            The number of vertices of each shell, for all the shells of the
+            first root, then for all the shells of the second root, etc.
+
+        shell_vertex : list of int
+            The vertices of all the shells in the same order.
+        """
+        n_shells = np.asarray(n_shells, dtype=np.int64)
+        self.n_shells = np.zeros(len(self), dtype=np.int64)
+        self.n_shells[roots] = n_shells
+        self.first_shell = np.zeros(len(self), dtype=np.int64)
+        self.first_shell[roots] = np.cumsum(n_shells) - n_shells
+        self.shell_offsets = np.zeros(len(shell_sizes) + 1, dtype=np.int64)
+        self.shell_offsets[1:] = np.cumsum(shell_sizes)
+        self.shell_vertex = np.asarray(shell_vertex, dtype=np.int64)
+        # plain lists for the scalar accesses in the inner loops
+        self._n_shells = self.n_shells.tolist()
+        self._first_shell = self.first_shell.tolist()
+        self._shell_offsets = self.shell_offsets.tolist()
+        self._shell_vertex = self.shell_vertex.tolist()
+
+    def copy_shells(self, graph):
+        """Use the shells of another compact graph of the same graph."""
+        for name in ['n_shells', 'first_shell', 'shell_offsets',
+                     'shell_vertex', '_n_shells', '_first_shell',
+                     '_shell_offsets', '_shell_vertex']:
+            setattr(self, name, getattr(graph, name))
+
+    def shells(self, root):
+        """List the vertices at distance 0, 1, ... from the root."""
+        first = self._first_shell[root]
+        offsets = self._shell_offsets[first:first + self._n_shells[root] + 1]
+        vertex = self._shell_vertex
+        return [vertex[start:end] for start, end in zip(offsets[:-1],
+                                                        offsets[1:])]
+
+    def neighbors(self, u):
+        """List the indices of the vertices adjacent to u."""
+        return self.indices[self.indptr[u]:self.indptr[u + 1]].tolist()
+
+
+def _is_linear_classifier(estimator):
+    # binary classifiers whose decision function is X coef_^T + intercept_
+    coef = getattr(estimator, 'coef_', None)
+    return isinstance(coef, np.ndarray) and coef.ndim == 2 and \
+        coef.shape[0] == 1 and hasattr(estimator, 'classes_') and \
+        hasattr(estimator, 'intercept_') and \
+        not hasattr(estimator, 'support_vectors_')
+
+
+def _is_implicitly_expandable(graph):
+    return 'expanded' not in graph.graph and not graph.is_directed() and \
+        not graph.is_multigraph()
 
 
 def _edge_to_vertex_transform(original_graph):
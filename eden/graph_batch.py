@@ -0,0 +1,474 @@
+#!/usr/bin/env python
+"""Provides batched vectorization of graphs.
+
+A batch of graphs is packed into a single disjoint union, i.e. a block
+diagonal sparse adjacency matrix where each graph occupies a contiguous
+range of vertex indices. The distance shells, the neighborhood hashes, the
+pair features and the normalization are then computed for all the graphs
+of the batch at once with numpy and scipy array operations.
+
+The hashes are computed with the array functions of eden.hashing and are
+the same as the ones computed by the scalar functions one value at a
+time, so the feature vectors are the same as the ones computed one graph
+at a time (up to the rounding of the floating point sums).
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import shortest_path
+from eden import _bitmask_
+from eden.hashing import get_hash_functions
+from eden.accumulator import _lexsort, _segment_starts, feature_matrix
+import logging
+logger = logging.getLogger(__name__)
+
+# largest number of (root, vertex) distances computed in a dense matrix:
+# beyond about 250 vertices the frontier products are faster
+_DENSE_SHELLS_MAX_SIZE = 2 ** 16
+
+
+def _ragged_arange(starts, sizes):
+    # concatenation of the ranges [start, start + size)
+    sizes = np.asarray(sizes, dtype=np.int64)
+    total = int(sizes.sum())
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    ends = np.cumsum(sizes)
+    shifts = np.repeat(np.asarray(starts, dtype=np.int64) - ends + sizes,
+                       sizes)
+    return np.arange(total, dtype=np.int64) + shifts
+
+
+class DisjointUnion(object):
+    """Disjoint union of compact graphs.
+
+    The vertices of the i-th graph have indices in the range
+    offsets[i]:offsets[i + 1] and all the per vertex arrays of the compact
+    graphs are concatenated.
+    """
+
+    def __init__(self, graphs, positional=False):
+        """Pack the list of compact graphs."""
+        sizes = [len(graph) for graph in graphs]
+        self.offsets = np.concatenate(([0], np.cumsum(sizes))).astype(
+            np.int64)
+        self.n_graphs = len(graphs)
+        self.graph_id = np.repeat(np.arange(self.n_graphs), sizes)
+        n_edges = np.cumsum([0] + [graph.indices.shape[0]
+                                   for graph in graphs])
+        self.indptr = np.concatenate(
+            [[0]] + [graph.indptr[1:] + shift
+                     for graph, shift in zip(graphs, n_edges)]).astype(
+                         np.int64)
+        self.indices = np.concatenate(
+            [graph.indices + offset
+             for graph, offset in zip(graphs, self.offsets)])
+        self.degree = np.diff(self.indptr)
+        self.hlabel = np.concatenate([graph.hlabel for graph in graphs])
+        self.is_node = np.concatenate([graph.is_node for graph in graphs])
+        self.is_nesting = np.concatenate(
+            [graph.is_nesting for graph in graphs])
+        self.weight = np.concatenate([graph.weight for graph in graphs])
+        self.weighted = np.array([graph.weighted for graph in graphs],
+                                 dtype=bool)
+        self.ids = None
+        if positional:
+            self.ids = np.concatenate(
+                [np.array(graph.ids, dtype=np.int64) for graph in graphs])
+
+    def __len__(self):
+        """Number of vertices."""
+        return self.indptr.shape[0] - 1
+
+
+def adjacency_matrix(graph, skip_nesting=False):
+    """Return the adjacency matrix of a compact graph in CSR format.
+
+    If skip_nesting is True the columns of the nesting edge-vertices are
+    left empty, i.e. they cannot be reached.
+    """
+    data = np.ones(graph.indices.shape[0], dtype=np.int32)
+    if skip_nesting:
+        data[graph.is_nesting[graph.indices]] = 0
+    size = graph.indptr.shape[0] - 1
+    adjacency = csr_matrix((data, graph.indices, graph.indptr),
+                           shape=(size, size))
+    adjacency.eliminate_zeros()
+    return adjacency
+
+
+def distance_shells(graph, roots, max_depth, method='auto'):
+    """Compute the distance shells of all the roots at once.
+
+    The nesting edge-vertices are skipped, i.e. they do not belong to any
+    shell and paths cannot go through them.
+
+    Parameters
+    ----------
+    graph : compact graph or disjoint union of compact graphs
+
+    roots : array of int
+        The vertices from which distances are measured.
+
+    max_depth : int
+        The largest distance considered.
+
+    method : string (default 'auto')
+        'dense' computes all the distances with scipy.sparse.csgraph,
+        'frontier' expands the frontiers of all the roots with sparse
+        matrix products, 'auto' selects 'dense' for small graphs.
+
+    Returns
+    -------
+    root_pos, vertex, dist : arrays of the shell memberships, sorted by
+        root position, then by distance, then by vertex.
+
+    n_shells : array with the number of non empty shells for each root.
+    """
+    roots = np.asarray(roots, dtype=np.int64)
+    adjacency = adjacency_matrix(graph, skip_nesting=True)
+    if method == 'auto':
+        size = len(roots) * adjacency.shape[0]
+        method = 'dense' if size <= _DENSE_SHELLS_MAX_SIZE else 'frontier'
+    if method == 'dense':
+        return _dense_distance_shells(adjacency, roots, max_depth)
+    elif method == 'frontier':
+        return _frontier_distance_shells(adjacency, roots, max_depth)
+    else:
+        raise Exception('Unknown method: %s' % method)
+
+
+def _shells_from_memberships(root_pos, vertex, dist, n_roots):
+    n_shells = np.zeros(n_roots, dtype=np.int64)
+    np.maximum.at(n_shells, root_pos, dist + 1)
+    return root_pos, vertex, dist, n_shells
+
+
+def _dense_distance_shells(adjacency, roots, max_depth):
+    dist_matrix = shortest_path(adjacency, method='D', directed=True,
+                                unweighted=True, indices=roots)
+    root_pos, vertex = np.nonzero(dist_matrix <= max_depth)
+    dist = dist_matrix[root_pos, vertex].astype(np.int64)
+    order = _lexsort((vertex, dist, root_pos),
+                     (adjacency.shape[0], max_depth + 1, len(roots)))
+    return _shells_from_memberships(root_pos[order], vertex[order],
+                                    dist[order], len(roots))
+
+
+def _frontier_distance_shells(adjacency, roots, max_depth):
+    n_roots = len(roots)
+    frontier = csr_matrix((np.ones(n_roots, dtype=np.int32),
+                           (np.arange(n_roots), roots)),
+                          shape=(n_roots, adjacency.shape[0]))
+    visited = frontier.copy()
+    root_pos_list = [np.arange(n_roots, dtype=np.int64)]
+    vertex_list = [np.asarray(roots, dtype=np.int64)]
+    dist_list = [np.zeros(n_roots, dtype=np.int64)]
+    for d in range(1, max_depth + 1):
+        reached = frontier.dot(adjacency)
+        reached = reached - reached.multiply(visited)
+        reached.eliminate_zeros()
+        if reached.nnz == 0:
+            break
+        reached.data[:] = 1
+        reached.sort_indices()
+        visited = visited + reached
+        sizes = np.diff(reached.indptr)
+        root_pos_list.append(np.repeat(np.arange(n_roots), sizes))
+        vertex_list.append(reached.indices.astype(np.int64))
+        dist_list.append(np.full(reached.nnz, d, dtype=np.int64))
+        frontier = reached
+    root_pos = np.concatenate(root_pos_list)
+    vertex = np.concatenate(vertex_list)
+    dist = np.concatenate(dist_list)
+    order = np.argsort(root_pos, kind='stable')
+    return _shells_from_memberships(root_pos[order], vertex[order],
+                                    dist[order], n_roots)
+
+
+def stored_shells(graph, roots):
+    """Return the shells stored in a compact graph in the flat format.
+
+    Parameters
+    ----------
+    graph : compact graph
+        With the shells set by the vectorizer for the given roots.
+
+    roots : array of int
+
+    Returns
+    -------
+    root_pos, vertex, dist, n_shells : the shell memberships and the number
+        of shells of each root, as returned by distance_shells.
+    """
+    roots = np.asarray(roots, dtype=np.int64)
+    n_shells = graph.n_shells[roots]
+    first_shell = graph.first_shell[roots]
+    shell_ids = _ragged_arange(first_shell, n_shells)
+    shell_root_pos = np.repeat(np.arange(len(roots)), n_shells)
+    shell_dist = shell_ids - np.repeat(first_shell, n_shells)
+    starts = graph.shell_offsets[shell_ids]
+    sizes = graph.shell_offsets[shell_ids + 1] - starts
+    vertex = graph.shell_vertex[_ragged_arange(starts, sizes)]
+    return np.repeat(shell_root_pos, sizes), vertex, \
+        np.repeat(shell_dist, sizes), n_shells
+
+
+def neighborhood_hashes(union, roots, shells, positional=False,
+                        hashing='builtin'):
+    """Compute the neighborhood hash of each root at each radius.
+
+    Returns a matrix with one row per root, where the first n_shells
+    entries are the same values of fast_hash_vec (or of its counterpart in
+    the given hashing scheme) on the sorted hashed labels of each shell.
+    """
+    hash_functions = get_hash_functions(hashing)
+    hash_array = hash_functions.hash_array
+    root_pos, vertex, dist, n_shells = shells
+    if positional:
+        relative_position = union.ids[roots[root_pos]] - union.ids[vertex]
+        vertex_hlabels = hash_array(union.hlabel[vertex], relative_position)
+    else:
+        vertex_hlabels = hash_array(union.hlabel, union.degree)[vertex]
+    order = _lexsort((vertex_hlabels, dist, root_pos),
+                     (_bitmask_ + 2, n_shells.max() + 1, len(roots)))
+    starts = _segment_starts(root_pos[order], dist[order])
+    sizes = np.diff(np.append(starts, len(order)))
+    shell_hashes = hash_functions.hash_segments(vertex_hlabels[order], starts,
+                                                sizes)
+    width = int(n_shells.max()) if len(n_shells) else 0
+    hash_rows = np.zeros((len(roots), width), dtype=np.int64)
+    hash_rows[root_pos[order][starts], dist[order][starts]] = shell_hashes
+    return hash_functions.hash_vec_rows(hash_rows, n_shells)
+
+
+def neighborhood_weights(union, roots, shells):
+    """Compute the neighborhood weight of each root at each radius.
+
+    At each distance the weight is the product of the arithmetic mean of
+    the weights of the nodes and of the geometric mean of the weights of
+    the edges up to that distance. The means are computed as running sums,
+    the geometric one in log space.
+
+    The vectors agree within rounding with the weights computed from the
+    breadth first shells of one root at a time:
+
+    >>> import networkx as nx
+    >>> from scipy import stats
+    >>> from eden.graph import Vectorizer
+    >>> class Reference(Vectorizer):
+    ...     def _compute_neighborhood_graph_weight_cache(self, graph,
+    ...                                                  roots=None):
+    ...         if roots is None:
+    ...             roots = graph.node_vertices
+    ...         cache = [None] * len(graph)
+    ...         for u in roots:
+    ...             nodes, edges, cache[u] = [graph.weight[u]], [1.0], []
+    ...             for dist, shell in enumerate(graph.shells(u)):
+    ...                 if dist % 2 == 0:
+    ...                     nodes.extend(graph.weight[shell])
+    ...                 else:
+    ...                     edges.extend(graph.weight[shell])
+    ...                 cache[u].append(np.mean(nodes) * stats.gmean(edges))
+    ...         graph.neigh_graph_weight = cache
+    >>> g = nx.cycle_graph(7)
+    >>> g.add_edge(0, 3)
+    >>> for n, d in g.nodes(data=True):
+    ...     d['label'] = 'CN'[n % 2]
+    ...     d['weight'] = 0.5 + n / 4.0
+    >>> for a, b, d in g.edges(data=True):
+    ...     d['label'] = '1'
+    ...     d['weight'] = 1.0 + (a + b) / 10.0
+    >>> opts = dict(r=3, d=3, normalization=False, inner_normalization=False)
+    >>> x = Reference(**opts).transform([g])
+    >>> for batch_size in [None, 2]:
+    ...     xw = Vectorizer(batch_size=batch_size, **opts).transform([g])
+    ...     print(abs(x - xw).max() < 1e-10)
+    True
+    True
+    >>> ref, = Reference(**opts).annotate([g], vertex_features=True)
+    >>> ann, = Vectorizer(**opts).annotate([g], vertex_features=True)
+    >>> print(max(abs(ref.nodes[n]['features'] -
+    ...               ann.nodes[n]['features']).max() for n in g) < 1e-10)
+    True
+    """
+    root_pos, vertex, dist, n_shells = shells
+    width = int(n_shells.max()) if len(n_shells) else 0
+    n_roots = len(roots)
+    weights = union.weight[vertex]
+    is_edge_shell = dist % 2 == 1
+    with np.errstate(divide='ignore'):
+        values = np.where(is_edge_shell, np.log(weights), weights)
+    sums = np.zeros((n_roots, width), dtype=np.float64)
+    counts = np.zeros((n_roots, width), dtype=np.float64)
+    np.add.at(sums, (root_pos, dist), values)
+    np.add.at(counts, (root_pos, dist), 1)
+    odd = np.arange(width) % 2 == 1
+    node_sums = np.cumsum(np.where(odd, 0, sums), axis=1)
+    node_counts = np.cumsum(np.where(odd, 0, counts), axis=1)
+    edge_sums = np.cumsum(np.where(odd, sums, 0), axis=1)
+    edge_counts = np.cumsum(np.where(odd, counts, 0), axis=1)
+    # the root weight is accounted for twice, the edges start from a
+    # unit weight
+    node_average = (union.weight[roots][:, None] + node_sums) / \
+        (1 + node_counts)
+    edge_average = np.exp(edge_sums / (1 + edge_counts))
+    return node_average * edge_average
+
+
+def _vertex_pairs(union, roots, shells, min_d, d):
+    # all pairs root - node at an even distance between 2*min_d and 2*d,
+    # both directly and via the second endpoint of nesting edges
+    root_pos, vertex, dist, n_shells = shells
+    root_index = np.full(len(union), -1, dtype=np.int64)
+    root_index[roots] = np.arange(len(roots))
+    selected = (dist % 2 == 0) & (dist >= min_d * 2) & (dist <= d * 2) & \
+        union.is_node[vertex]
+    pair_v = root_pos[selected]
+    pair_u = root_index[vertex[selected]]
+    pair_dist = dist[selected]
+    pair_cw = np.ones(len(pair_v), dtype=np.float64)
+    pair_phase = np.zeros(len(pair_v), dtype=np.int64)
+    # nesting edges: for each (root, nesting edge-vertex) adjacency find the
+    # other endpoint and pair the root with the shells of the endpoint
+    source = np.repeat(np.arange(len(union)), union.degree)
+    nesting = union.is_node[source] & union.is_nesting[union.indices]
+    if nesting.any():
+        v = source[nesting]
+        n = union.indices[nesting]
+        first = union.indices[union.indptr[n]]
+        second = union.indices[union.indptr[n] + 1]
+        endpoint = np.where(first == v, second, first)
+        # rank of the nesting edge among the ones of the same root
+        starts = _segment_starts(v)
+        rank = np.arange(len(v)) - np.repeat(starts,
+                                             np.diff(np.append(starts,
+                                                               len(v))))
+        shell_starts = np.searchsorted(root_pos, np.arange(len(roots)))
+        shell_sizes = np.bincount(root_pos, minlength=len(roots))
+        e = root_index[endpoint]
+        positions = _ragged_arange(shell_starts[e], shell_sizes[e])
+        owner = np.repeat(np.arange(len(v)), shell_sizes[e])
+        in_range = selected[positions]
+        positions, owner = positions[in_range], owner[in_range]
+        pair_v = np.concatenate((pair_v, root_index[v][owner]))
+        pair_u = np.concatenate((pair_u, root_index[vertex[positions]]))
+        pair_dist = np.concatenate((pair_dist, dist[positions]))
+        pair_cw = np.concatenate((pair_cw, union.weight[n][owner]))
+        pair_phase = np.concatenate((pair_phase, 1 + rank[owner]))
+    return pair_v, pair_u, pair_dist, pair_cw, pair_phase
+
+
+def transform(graphs, vectorizer):
+    """Transform a list of compact graphs into a sparse matrix.
+
+    Parameters
+    ----------
+    graphs : list of compact graphs
+        The edge to vertex expanded graphs in compact form, without caches.
+
+    vectorizer : Vectorizer
+        The graph vectorizer whose parameters are used.
+
+    Returns
+    -------
+    data_matrix : CSR matrix, shape = [len(graphs), feature_size]
+    """
+    v = vectorizer
+    rows, blocks, features, values = feature_records(graphs, v)
+    block_weights = None
+    if v.weights_dict is not None:
+        block_weights = v._block_weights()
+    return feature_matrix(rows, blocks, features, values,
+                          n_rows=len(graphs),
+                          n_features=v.feature_size,
+                          inner_normalization=v.inner_normalization,
+                          normalization=v.normalization,
+                          block_weights=block_weights)
+
+
+def feature_records(graphs, vectorizer):
+    """Return the feature records of a list of compact graphs.
+
+    Returns
+    -------
+    rows, blocks, features, values : arrays
+        The records in emission order, see eden.accumulator; the rows are
+        the positions of the graphs in the list.
+    """
+    v = vectorizer
+    union = DisjointUnion(graphs, positional=v.positional)
+    roots = np.flatnonzero(union.is_node)
+    shells = distance_shells(union, roots, max(v.r, v.d) * 2)
+    n_shells = shells[3]
+    hashes = neighborhood_hashes(union, roots, shells,
+                                 positional=v.positional, hashing=v.hashing)
+    weights = None
+    if union.weighted.any():
+        weights = neighborhood_weights(union, roots, shells)
+    pair_v, pair_u, pair_dist, pair_cw, pair_phase = _vertex_pairs(
+        union, roots, shells, v.min_d, v.d)
+
+    # expand each pair over all the admissible radii
+    radii = np.arange(v.min_r * 2, (v.r + 1) * 2, 2)
+    admissible = np.ones((len(radii), v.d * 2 + 1), dtype=bool)
+    if v.weights_dict is not None:
+        for i, radius in enumerate(radii):
+            for distance in range(0, v.d * 2 + 1, 2):
+                key = (radius / 2, distance / 2)
+                admissible[i, distance] = v.weights_dict.get(key, 0) != 0
+    max_radius = np.minimum(n_shells[pair_v], n_shells[pair_u])
+    valid = (radii[None, :] < max_radius[:, None]) & \
+        admissible[:, pair_dist].T
+    pair_id, radius_id = np.nonzero(valid)
+    radius = radii[radius_id]
+    root_v, root_u = pair_v[pair_id], pair_u[pair_id]
+    distance = pair_dist[pair_id]
+    cw = pair_cw[pair_id]
+    hash_v = hashes[root_v, radius]
+    hash_u = hashes[root_u, radius]
+    hash_array = get_hash_functions(v.hashing).hash_array
+    features = hash_array(np.minimum(hash_v, hash_u),
+                          np.maximum(hash_v, hash_u),
+                          radius, distance, bitmask=v.bitmask)
+    half_features = hash_array(hash_u, radius, distance, bitmask=v.bitmask)
+    values = cw.copy()
+    half_values = cw.copy()
+    graph_id = union.graph_id[roots[root_v]]
+    if weights is not None:
+        weighted = union.weighted[graph_id]
+        weight_v = weights[root_v, radius]
+        weight_u = weights[root_u, radius]
+        values = np.where(weighted, cw * (weight_v + weight_u), values)
+        half_values = np.where(weighted, cw * weight_u, half_values)
+        # Note: add a feature only if the value is not 0
+        keep = ~weighted | (values != 0)
+        pair_id, radius, distance = pair_id[keep], radius[keep], \
+            distance[keep]
+        features, half_features = features[keep], half_features[keep]
+        values, half_values = values[keep], half_values[keep]
+        graph_id, root_v = graph_id[keep], root_v[keep]
+    block = (radius // 2) * (v.d + 1) + distance // 2
+    # emission order of the one graph at a time implementation: it decides
+    # which (radius, distance) block wins when the same feature id is
+    # produced in different blocks
+    n_phases = int(pair_phase.max()) + 1 if len(pair_phase) else 1
+    emission = root_v * n_phases + pair_phase[pair_id]
+    emission = (emission * (v.d * 2 + 1) + distance) * (v.r * 2 + 1) + radius
+    if not v.use_only_context:
+        features = np.concatenate((features, half_features))
+        values = np.concatenate((values, half_values))
+        graph_id = np.concatenate((graph_id, graph_id))
+        block = np.concatenate((block, block))
+        emission = np.concatenate((emission, emission))
+    else:
+        features, values = half_features, half_values
+    # the records are visited in emission order; the ties are the
+    # features of the same (root, radius, distance) that end in the
+    # same block anyway
+    order = np.argsort(emission, kind='stable')
+    return graph_id[order], block[order], features[order], values[order]
@@ -0,0 +1,518 @@
+#!/usr/bin/env python
+"""Provides caches of graph feature vectors.
+
+The sparse rows computed by eden.graph.Vectorizer are stored, keyed by a
+fingerprint of the graph content together with the parameters of the
+vectorizer, either on disk in a sqlite database (FeatureCache) or in the
+memory of the process (MemoryFeatureCache). SessionFeatureCache keys the
+rows by the identity of the graph objects for the duration of a single
+call, e.g. the fit of an estimator. The caches are bounded in
+size: when they grow beyond max_size bytes the least recently used rows
+are evicted.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+from scipy.sparse import csr_matrix
+from eden import __magic__
+import logging
+logger = logging.getLogger(__name__)
+
+# parameters of the vectorizer that determine the feature vectors
+_VECTORIZER_PARAMS = ['r', 'd', 'min_r', 'min_d', 'nbits', 'normalization',
+                      'inner_normalization', 'weights_dict', 'positional',
+                      'discrete', 'use_only_context', 'key_label',
+                      'key_weight', 'key_nesting', 'key_vec', 'key_svec',
+                      'hashing']
+
+
+def _canonical(value):
+    # deterministic text representation of (nested) attribute values
+    if isinstance(value, dict):
+        items = sorted((_canonical(k), _canonical(v))
+                       for k, v in value.items())
+        return '{%s}' % ','.join('%s:%s' % item for item in items)
+    if isinstance(value, (list, tuple)):
+        return '[%s]' % ','.join(_canonical(item) for item in value)
+    if isinstance(value, np.ndarray):
+        return _canonical(value.tolist())
+    if isinstance(value, np.generic):
+        return _canonical(value.item())
+    return '%s:%r' % (type(value).__name__, value)
+
+
+def vectorizer_fingerprint(vectorizer):
+    """Return a digest of the parameters that determine the features.
+
+    With the builtin hashing scheme the feature ids depend on the salt of
+    the interpreter, so the digest includes the hash of a fixed value.
+    """
+    params = [(name, getattr(vectorizer, name, None))
+              for name in _VECTORIZER_PARAMS]
+    if getattr(vectorizer, 'hashing', 'builtin') == 'builtin':
+        params.append(('salt', hash(__magic__)))
+    return hashlib.sha1(_canonical(params).encode('utf-8')).hexdigest()
+
+
+def graph_fingerprint(graph, keys, params_fingerprint='', ordered=False):
+    """Return a digest of the content of a networkx graph.
+
+    Only the node and edge attributes listed in keys are considered. Nodes
+    and edges are listed in a canonical order so that the fingerprint does
+    not depend on the order in which they were inserted, unless ordered is
+    True.
+
+    Parameters
+    ----------
+    graph : networkx graph
+
+    keys : list of strings
+        The attributes that determine the feature vector.
+
+    params_fingerprint : string
+        The fingerprint of the vectorizer, prepended to the content.
+
+    ordered : bool (default False)
+        If True nodes and edges are listed in the order of the graph, e.g.
+        because in positional mode the features depend on it.
+
+    >>> import networkx as nx
+    >>> g1, g2 = nx.Graph(), nx.Graph()
+    >>> g1.add_node(0, label='C'); g1.add_node(1, label='O')
+    >>> g1.add_edge(0, 1, label='1')
+    >>> g2.add_node(1, label='O'); g2.add_node(0, label='C')
+    >>> g2.add_edge(1, 0, label='1')
+    >>> graph_fingerprint(g1, ['label']) == graph_fingerprint(g2, ['label'])
+    True
+    >>> f1 = graph_fingerprint(g1, ['label'], ordered=True)
+    >>> f2 = graph_fingerprint(g2, ['label'], ordered=True)
+    >>> f1 == f2
+    False
+    """
+    def attributes(data):
+        return [(key, data[key]) for key in keys if key in data]
+
+    def edge(u, v, data):
+        return _canonical(sorted([u, v], key=repr) + [attributes(data)])
+
+    if ordered:
+        nodes = [_canonical([u, attributes(data)])
+                 for u, data in graph.nodes(data=True)]
+        edges = [_canonical([u, v, attributes(data)])
+                 for u, v, data in graph.edges(data=True)]
+    else:
+        nodes = sorted(_canonical([u, attributes(data)])
+                       for u, data in graph.nodes(data=True))
+        edges = sorted(edge(u, v, data)
+                       for u, v, data in graph.edges(data=True))
+    content = '%s|%s|%s|%s' % (params_fingerprint,
+                               graph.is_directed(),
+                               '|'.join(nodes),
+                               '|'.join(edges))
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+class FeatureCache(object):
+    """Size bounded on disk store of sparse feature rows with LRU eviction.
+
+    The connection to the database is opened lazily, so that the cache can
+    be pickled and used from worker processes, and it is shared by the
+    threads of a process under a lock. Hit and miss counts refer to the
+    current process.
+
+    >>> import tempfile
+    >>> from scipy.sparse import csr_matrix
+    >>> cache = FeatureCache(tempfile.mkdtemp(), max_size=10 ** 6)
+    >>> cache.put_many({'a': csr_matrix([[0, 1.5, 0, 2]])})
+    >>> rows = cache.get_many(['a', 'b'], n_features=4)
+    >>> rows['a'].toarray().tolist()
+    [[0.0, 1.5, 0.0, 2.0]]
+    >>> 'b' in rows
+    False
+    >>> stats = cache.stats()
+    >>> stats['hits'], stats['misses']
+    (1, 1)
+    """
+
+    def __init__(self, directory, max_size=2 ** 30):
+        """Constructor.
+
+        Parameters
+        ----------
+        directory : string
+            The directory containing the database; it is created if missing.
+
+        max_size : int (default 2^30)
+            The largest size in bytes of the stored rows.
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.path = os.path.join(directory, 'eden_feature_cache.sqlite')
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._connection = None
+        self._lock = threading.RLock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_connection'] = None
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    def _connect(self):
+        if self._connection is None:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            self._connection = sqlite3.connect(self.path, timeout=60,
+                                               check_same_thread=False)
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS rows ('
+                'key TEXT PRIMARY KEY, '
+                'row BLOB NOT NULL, '
+                'size INTEGER NOT NULL, '
+                'last_access REAL NOT NULL)')
+            self._connection.execute(
+                'CREATE INDEX IF NOT EXISTS rows_last_access '
+                'ON rows (last_access)')
+            # running total of the size of the rows, so that it is not
+            # summed over the whole table at each insertion
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS meta ('
+                'name TEXT PRIMARY KEY, '
+                'value INTEGER NOT NULL)')
+            self._connection.execute(
+                "INSERT OR IGNORE INTO meta (name, value) "
+                "SELECT 'size', COALESCE(SUM(size), 0) FROM rows")
+            self._connection.commit()
+        return self._connection
+
+    def get_many(self, keys, n_features):
+        """Return a dict key: 1 x n_features csr_matrix of the stored keys."""
+        with self._lock:
+            return self._get_many(keys, n_features)
+
+    def _get_many(self, keys, n_features):
+        connection = self._connect()
+        keys = list(keys)
+        rows = dict()
+        for chunk in _chunks(keys):
+            query = 'SELECT key, row FROM rows WHERE key IN (%s)' % \
+                ','.join('?' * len(chunk))
+            for key, blob in connection.execute(query, chunk):
+                rows[key] = _decode_row(blob, n_features)
+        self.hits += len(rows)
+        self.misses += len(keys) - len(rows)
+        if rows:
+            now = time.time()
+            connection.executemany(
+                'UPDATE rows SET last_access = ? WHERE key = ?',
+                [(now, key) for key in rows])
+            connection.commit()
+        return rows
+
+    def put_many(self, rows):
+        """Store a dict key: 1 x n_features csr_matrix and evict if needed."""
+        with self._lock:
+            self._put_many(rows)
+
+    def _put_many(self, rows):
+        connection = self._connect()
+        now = time.time()
+        records = []
+        for key, row in rows.items():
+            blob = _encode_row(row)
+            records.append((key, sqlite3.Binary(blob), len(blob), now))
+        # the write lock is taken before reading the sizes of the rows that
+        # are replaced, so that another process cannot change them before
+        # the running total is updated
+        if connection.in_transaction:
+            connection.commit()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            # the rows that are replaced do not count anymore
+            replaced = 0
+            for chunk in _chunks(list(rows)):
+                query = 'SELECT COALESCE(SUM(size), 0) FROM rows ' \
+                    'WHERE key IN (%s)' % ','.join('?' * len(chunk))
+                replaced += connection.execute(query, chunk).fetchone()[0]
+            connection.executemany(
+                'INSERT OR REPLACE INTO rows (key, row, size, last_access) '
+                'VALUES (?, ?, ?, ?)', records)
+            added = sum(record[2] for record in records)
+            connection.execute(
+                "UPDATE meta SET value = value + ? WHERE name = 'size'",
+                (added - replaced,))
+            evicted = self._evict()
+        except BaseException:
+            connection.rollback()
+            raise
+        connection.commit()
+        self.evictions += evicted
+
+    def _evict(self):
+        # delete the least recently accessed rows until the size fits, in
+        # the transaction of the caller; return the number of rows deleted
+        connection = self._connect()
+        total = self._size()
+        if total <= self.max_size:
+            return 0
+        excess = total - self.max_size
+        evicted = []
+        freed = 0
+        for key, size in connection.execute(
+                'SELECT key, size FROM rows ORDER BY last_access'):
+            evicted.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        connection.executemany('DELETE FROM rows WHERE key = ?', evicted)
+        connection.execute(
+            "UPDATE meta SET value = value - ? WHERE name = 'size'",
+            (freed,))
+        return len(evicted)
+
+    def _size(self):
+        return self._connect().execute(
+            "SELECT value FROM meta WHERE name = 'size'").fetchone()[0]
+
+    def __len__(self):
+        """Number of stored rows."""
+        with self._lock:
+            return self._connect().execute(
+                'SELECT COUNT(*) FROM rows').fetchone()[0]
+
+    def size(self):
+        """Size in bytes of the stored rows."""
+        with self._lock:
+            return self._size()
+
+    def clear(self):
+        """Remove all the stored rows and reset the statistics."""
+        with self._lock:
+            connection = self._connect()
+            connection.execute('DELETE FROM rows')
+            connection.execute("UPDATE meta SET value = 0 WHERE name = 'size'")
+            connection.commit()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        """Return the hit and miss counts and the occupancy of the cache."""
+        with self._lock:
+            n_requests = self.hits + self.misses
+            hit_rate = self.hits / float(n_requests) if n_requests else 0.0
+            return dict(hits=self.hits,
+                        misses=self.misses,
+                        hit_rate=hit_rate,
+                        evictions=self.evictions,
+                        n_rows=len(self),
+                        size=self.size(),
+                        max_size=self.max_size)
+
+
+class MemoryFeatureCache(object):
+    """Size bounded in memory store of sparse feature rows with LRU eviction.
+
+    It has the same interface as FeatureCache and it is meant to avoid the
+    repeated vectorization of the same graphs within a session, e.g. the
+    decision_function and the predict calls of an estimator on the same
+    instances. The rows are not pickled: a copy sent to a worker process
+    starts empty.
+
+    >>> from scipy.sparse import csr_matrix
+    >>> cache = MemoryFeatureCache(max_size=40)
+    >>> cache.put_many({'a': csr_matrix([[0, 1.5, 0, 2]])})
+    >>> cache.put_many({'b': csr_matrix([[1.0, 0, 0, 0]])})
+    >>> rows = cache.get_many(['a', 'b'], n_features=4)
+    >>> rows['b'].toarray().tolist()
+    [[1.0, 0.0, 0.0, 0.0]]
+    >>> 'a' in rows
+    False
+    >>> stats = cache.stats()
+    >>> stats['hits'], stats['misses'], stats['evictions']
+    (1, 1, 1)
+    """
+
+    def __init__(self, max_size=2 ** 28):
+        """Constructor.
+
+        Parameters
+        ----------
+        max_size : int (default 2^28)
+            The largest size in bytes of the stored rows.
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._rows = OrderedDict()
+        self._size = 0
+        self._lock = threading.RLock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_rows'] = OrderedDict()
+        state['_size'] = 0
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    def get_many(self, keys, n_features):
+        """Return a dict key: 1 x n_features csr_matrix of the stored keys."""
+        rows = dict()
+        with self._lock:
+            for key in keys:
+                row = self._rows.pop(key, None)
+                if row is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+                    # reinsert as most recently used
+                    self._rows[key] = row
+                    rows[key] = row
+        return rows
+
+    def put_many(self, rows):
+        """Store a dict key: 1 x n_features csr_matrix and evict if needed."""
+        with self._lock:
+            for key, row in rows.items():
+                row = csr_matrix(row, copy=True)
+                old = self._rows.pop(key, None)
+                if old is not None:
+                    self._size -= _row_size(old)
+                self._rows[key] = row
+                self._size += _row_size(row)
+            while self._size > self.max_size and self._rows:
+                key, row = self._rows.popitem(last=False)
+                self._size -= _row_size(row)
+                self.evictions += 1
+
+    def __len__(self):
+        """Number of stored rows."""
+        return len(self._rows)
+
+    def size(self):
+        """Size in bytes of the stored rows."""
+        return self._size
+
+    def clear(self):
+        """Remove all the stored rows and reset the statistics."""
+        with self._lock:
+            self._rows = OrderedDict()
+            self._size = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        """Return the hit and miss counts and the occupancy of the cache."""
+        n_requests = self.hits + self.misses
+        hit_rate = self.hits / float(n_requests) if n_requests else 0.0
+        return dict(hits=self.hits,
+                    misses=self.misses,
+                    hit_rate=hit_rate,
+                    evictions=self.evictions,
+                    n_rows=len(self),
+                    size=self.size(),
+                    max_size=self.max_size)
+
+
+class SessionFeatureCache(MemoryFeatureCache):
+    """In memory store of the rows of the graph objects seen in a session.
+
+    The rows are keyed by the identity of the graph objects instead of a
+    fingerprint of their content, so that a lookup costs no more than a
+    dict access. The graphs are therefore assumed not to change while the
+    cache is in use, and they are referenced by the cache until it is
+    cleared, so that their ids cannot be reused. It is meant to live for a
+    single call, e.g. EdenEstimator.fit, and to be cleared at its end, or
+    to be set on a vectorizer to reuse the rows of the same graphs across
+    a few calls.
+
+    >>> import networkx as nx
+    >>> from scipy.sparse import csr_matrix
+    >>> g = nx.Graph()
+    >>> cache = SessionFeatureCache()
+    >>> key, = cache.graph_keys([g])
+    >>> cache.put_many({key: csr_matrix([[0, 1.5]])})
+    >>> cache.graph_keys([g]) == [key]
+    True
+    >>> cache.clear()
+    >>> len(cache), len(cache._graphs)
+    (0, 0)
+    """
+
+    def __init__(self, max_size=2 ** 28):
+        """Constructor.
+
+        Parameters
+        ----------
+        max_size : int (default 2^28)
+            The largest size in bytes of the stored rows.
+        """
+        super(SessionFeatureCache, self).__init__(max_size=max_size)
+        self._graphs = dict()
+
+    def __getstate__(self):
+        state = super(SessionFeatureCache, self).__getstate__()
+        state['_graphs'] = dict()
+        return state
+
+    def graph_keys(self, graphs):
+        """Return the keys of the graphs, keeping a reference to them."""
+        with self._lock:
+            keys = []
+            for graph in graphs:
+                key = id(graph)
+                self._graphs[key] = graph
+                keys.append(key)
+            return keys
+
+    def clear(self):
+        """Remove all the stored rows and graphs and reset the statistics."""
+        with self._lock:
+            super(SessionFeatureCache, self).clear()
+            self._graphs = dict()
+
+
+def _row_size(row):
+    # same accounting as the encoded rows of FeatureCache
+    return 16 * row.nnz
+
+
+def _chunks(keys, size=500):
+    # the number of parameters of a sqlite query is limited
+    for start in range(0, len(keys), size):
+        yield keys[start:start + size]
+
+
+def _encode_row(row):
+    indices = row.indices.astype('<i8')
+    data = row.data.astype('<f8')
+    return indices.tobytes() + data.tobytes()
+
+
+def _decode_row(blob, n_features):
+    blob = bytes(blob)
+    n = len(blob) // 16
+    indices = np.frombuffer(blob[:8 * n], dtype='<i8').astype(np.int64)
+    data = np.frombuffer(blob[8 * n:], dtype='<f8').astype(np.float64)
+    return csr_matrix((data, indices, [0, n]), shape=(1, n_features))
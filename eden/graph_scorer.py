@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+"""Provides a linear scorer of graphs that does not build feature vectors.
+
+The score of a linear model on a graph is the dot product of the
+coefficients with the feature vector of the graph. LinearScorer computes
+it directly from the feature records emitted by eden.graph.Vectorizer
+(see eden.accumulator): without normalization the records of the features
+with a zero coefficient are discarded at once and the products of the
+others are summed per graph, so that neither the feature vectors nor a
+sparse matrix are materialized. With normalization the feature values are
+normalized first, as in the vectorizer, and then multiplied by the
+coefficients.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+from toolz import partition_all
+from eden.accumulator import _lexsort
+from eden.accumulator import _segment_starts
+from eden.accumulator import _bound
+from eden.accumulator import group_records
+from eden.accumulator import grouped_features
+from eden.graph import _parallel_map
+import logging
+logger = logging.getLogger(__name__)
+
+
+class LinearScorer(object):
+    """Score graphs with the coefficients of a linear model.
+
+    The scores are the same as the ones of the dot product of the output
+    of vectorizer.transform with the coefficients, up to rounding.
+
+    >>> import networkx as nx
+    >>> from eden.graph import Vectorizer
+    >>> g = nx.path_graph(4)
+    >>> for u in g.nodes():
+    ...     g.nodes[u]['label'] = 'CNCO'[u]
+    >>> for u, v in g.edges():
+    ...     g.edges[u, v]['label'] = '-'
+    >>> vec = Vectorizer(r=2, d=2, nbits=10)
+    >>> coef = np.random.RandomState(1).randn(vec.feature_size)
+    >>> scorer = LinearScorer(vec, coef, intercept=0.5, sparse=True)
+    >>> x = vec.transform([g, g.subgraph([0, 1, 2])])
+    >>> scores = scorer.decision_function([g, g.subgraph([0, 1, 2])])
+    >>> print(np.allclose(scores, x.dot(coef) + 0.5))
+    True
+    """
+
+    def __init__(self, vectorizer, coef, intercept=0.0, sparse=False):
+        """Constructor.
+
+        Parameters
+        ----------
+        vectorizer : Vectorizer
+            The vectorizer whose feature vectors the model was fit on.
+
+        coef : array, shape = [feature_size]
+            The coefficients of the linear model.
+
+        intercept : float (default 0.0)
+            The intercept of the linear model.
+
+        sparse : bool (default False)
+            If True only the non zero coefficients are stored, in sorted
+            arrays of feature ids and weights, instead of a dense vector
+            of size 2^nbits.
+        """
+        coef = np.asarray(coef, dtype=np.float64).ravel()
+        if len(coef) != vectorizer.feature_size:
+            raise Exception('ERROR: expected %d coefficients, got %d.' %
+                            (vectorizer.feature_size, len(coef)))
+        self.vectorizer = vectorizer
+        self.intercept = float(intercept)
+        self.sparse = sparse
+        if sparse:
+            self.ids = np.flatnonzero(coef)
+            self.weights = coef[self.ids]
+            self.coef = None
+        else:
+            self.coef = coef
+
+    @property
+    def n_nonzero(self):
+        """Number of non zero coefficients."""
+        if self.sparse:
+            return len(self.ids)
+        return int(np.count_nonzero(self.coef))
+
+    def lookup(self, features):
+        """Return the coefficients of an array of feature ids."""
+        if not self.sparse:
+            return self.coef[features]
+        if len(self.ids) == 0:
+            return np.zeros(len(features))
+        pos = np.minimum(np.searchsorted(self.ids, features),
+                         len(self.ids) - 1)
+        return np.where(self.ids[pos] == features, self.weights[pos], 0.0)
+
+    def decision_function(self, graphs, n_jobs=1, chunk_size=1000,
+                          backend='process'):
+        """Return the scores of the graphs.
+
+        Parameters
+        ----------
+        graphs : iterable over networkx graphs
+            The graphs are consumed lazily, chunk_size at a time.
+
+        n_jobs : int (default 1)
+            The number of workers; -1 for all the cores.
+
+        chunk_size : int (default 1000)
+            The number of graphs scored at once.
+
+        backend : string (default 'process')
+            'process' or 'thread', see Vectorizer.transform.
+
+        Returns
+        -------
+        scores : array, shape = [n_graphs]
+        """
+        if n_jobs != 1:
+            scores = list(_parallel_map(_score_chunk, self, graphs,
+                                        n_jobs=n_jobs,
+                                        chunk_size=chunk_size,
+                                        backend=backend))
+        else:
+            scores = [self._score(list(chunk))
+                      for chunk in partition_all(chunk_size, graphs)]
+        if len(scores) == 0:
+            return np.zeros(0)
+        return np.concatenate(scores)
+
+    def _score(self, graphs):
+        v = self.vectorizer
+        n_rows = len(graphs)
+        rows, blocks, features, values = v._feature_records(graphs)
+        if v.normalization or v.inner_normalization:
+            block_weights = None
+            if v.weights_dict is not None:
+                block_weights = v._block_weights()
+            rows, features, values = grouped_features(
+                *group_records(rows, blocks, features, values, n_rows),
+                n_rows=n_rows,
+                inner_normalization=v.inner_normalization,
+                normalization=v.normalization,
+                block_weights=block_weights)
+            return self.intercept + np.bincount(
+                rows, weights=values * self.lookup(features),
+                minlength=n_rows)
+        # the features with a zero coefficient do not contribute
+        weights = self.lookup(features)
+        keep = np.flatnonzero(weights != 0)
+        scores = np.bincount(rows[keep],
+                             weights=values[keep] * weights[keep],
+                             minlength=n_rows)
+        return self.intercept + scores - _overwritten(
+            rows, blocks, features, values * weights, keep, n_rows)
+
+
+def _overwritten(rows, blocks, features, products, keep, n_rows):
+    # when the same feature id occurs in several blocks of a row only the
+    # value of the block visited last, i.e. the one emitted first last, is
+    # retained: return the per row sum of the products of the other blocks
+    n_blocks = _bound(blocks)
+    # the visiting order depends on all the records, not only on the kept
+    block_first = np.full(n_rows * n_blocks, len(rows), dtype=np.int64)
+    np.minimum.at(block_first, rows * n_blocks + blocks,
+                  np.arange(len(rows)))
+    rows, blocks, features, products = rows[keep], blocks[keep], \
+        features[keep], products[keep]
+    # only the records of the (row, feature) pairs that hash to a bucket
+    # with more than one block can be overwritten: sort just those
+    candidate = _multi_block_buckets(rows * _bound(features) + features,
+                                     blocks)
+    rows, blocks, features, products = rows[candidate], blocks[candidate], \
+        features[candidate], products[candidate]
+    order = _lexsort((blocks, features, rows),
+                     (n_blocks, _bound(features), n_rows))
+    rows, blocks, features, products = rows[order], blocks[order], \
+        features[order], products[order]
+    feature_starts = _segment_starts(rows, features)
+    block_starts = _segment_starts(rows, features, blocks)
+    if len(feature_starts) == len(block_starts):
+        return np.zeros(n_rows)
+    # one entry per (row, feature, block)
+    sums = np.add.reduceat(products, block_starts)
+    rows, blocks = rows[block_starts], blocks[block_starts]
+    rank = block_first[rows * n_blocks + blocks]
+    is_feature_start = np.zeros(len(products), dtype=np.int64)
+    is_feature_start[feature_starts] = 1
+    feature_id = np.cumsum(is_feature_start[block_starts]) - 1
+    last = np.maximum.reduceat(rank, np.flatnonzero(
+        is_feature_start[block_starts]))
+    lost = rank != last[feature_id]
+    return np.bincount(rows[lost], weights=sums[lost], minlength=n_rows)
+
+
+def _multi_block_buckets(keys, blocks):
+    # flags the keys that share a hash bucket with a different block
+    n_bits = max(int(np.ceil(np.log2(len(keys) + 1))) + 2, 10)
+    buckets = (keys.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)) >> \
+        np.uint64(64 - n_bits)
+    buckets = buckets.astype(np.int64)
+    low = np.full(2 ** n_bits, np.iinfo(np.int64).max, dtype=np.int64)
+    high = np.full(2 ** n_bits, -1, dtype=np.int64)
+    np.minimum.at(low, buckets, blocks)
+    np.maximum.at(high, buckets, blocks)
+    return np.flatnonzero(low[buckets] != high[buckets])
+
+
+def _score_chunk(scorer, graphs):
+    return scorer._score(graphs)
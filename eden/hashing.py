@@ -0,0 +1,421 @@
+#!/usr/bin/env python
+"""Provides the hash functions used to compute the feature ids.
+
+Two hashing schemes are available:
+
+'builtin'
+    fast_hash_* from eden, based on the builtin hash of python. The hash of
+    strings is salted per interpreter unless PYTHONHASHSEED is set, so the
+    feature ids can differ between runs and between spawned processes.
+
+'stable'
+    stable_hash_*, based on the splitmix64 finalizer for integers and on
+    md5 for strings. The feature ids depend only on the input.
+
+Each scheme has scalar functions, used one value at a time, and array
+functions that hash whole columns of integers in one call and give the
+same values. The array functions of the builtin scheme call hash on each
+tuple; the ones of the stable scheme mix whole columns with numpy. The
+scalar stable functions are written in pure python and are several times
+slower than the builtin ones, so the vectorizers use the array functions
+wherever the values can be hashed in batches.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import struct
+import threading
+from collections import namedtuple
+import numpy as np
+from eden import _bitmask_
+from eden import fast_hash, fast_hash_vec
+from eden import fast_hash_2, fast_hash_3, fast_hash_4
+import logging
+logger = logging.getLogger(__name__)
+
+
+def _tuple_hash(*columns):
+    # builtin hash of the tuple at each position across the columns
+    columns = [np.asarray(column, dtype=np.int64).tolist()
+               for column in columns]
+    return np.array([hash(item) for item in zip(*columns)], dtype=np.int64)
+
+
+def fast_hash_array(*columns, **kwargs):
+    """Array version of fast_hash_2, fast_hash_3 and fast_hash_4.
+
+    Each position across the columns is a tuple to hash.
+
+    >>> from eden import fast_hash_2
+    >>> hashes = fast_hash_array([1, 2], [3, -4], bitmask=1023)
+    >>> list(hashes) == [fast_hash_2(1, 3, 1023), fast_hash_2(2, -4, 1023)]
+    True
+    """
+    bitmask = kwargs.get('bitmask', _bitmask_)
+    return (_tuple_hash(*columns) & bitmask) + 1
+
+
+def fast_hash_segments(values, starts, sizes, bitmask=_bitmask_):
+    """Array version of fast_hash applied to contiguous segments of values.
+
+    >>> from eden import fast_hash
+    >>> hashes = fast_hash_segments([5, 6, 7], [0, 1], [1, 2])
+    >>> list(hashes) == [fast_hash([5]), fast_hash([6, 7])]
+    True
+    """
+    values = np.asarray(values, dtype=np.int64).tolist()
+    hashes = [hash(tuple(values[start:start + size]))
+              for start, size in zip(starts, sizes)]
+    return (np.array(hashes, dtype=np.int64) & bitmask) + 1
+
+
+def fast_hash_vec_rows(rows, sizes, bitmask=_bitmask_):
+    """Array version of fast_hash_vec applied to the rows of a matrix.
+
+    Only the first sizes[i] elements of the i-th row are considered; the
+    result is a matrix with the same shape.
+
+    >>> from eden import fast_hash_vec
+    >>> hashes = fast_hash_vec_rows([[3, 4, 5], [6, 0, 0]], [3, 1])
+    >>> list(hashes[0]) == fast_hash_vec([3, 4, 5])
+    True
+    >>> int(hashes[1, 0]) == fast_hash_vec([6])[0]
+    True
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    sizes = np.asarray(sizes, dtype=np.int64)
+    hash_rows = np.zeros(rows.shape, dtype=np.int64)
+    running_hash = np.full(rows.shape[0], 0xAAAAAAAA, dtype=np.int64)
+    for i in range(rows.shape[1]):
+        active = np.flatnonzero(sizes > i)
+        running_hash[active] ^= _tuple_hash(running_hash[active],
+                                            rows[active, i],
+                                            np.full(len(active), i))
+        hash_rows[active, i] = (running_hash[active] & bitmask) + 1
+    return hash_rows
+
+
+# constants of the splitmix64 generator
+_MASK64 = 2 ** 64 - 1
+_GOLDEN = 0x9e3779b97f4a7c15
+_MIX_1 = 0xbf58476d1ce4e5b9
+_MIX_2 = 0x94d049bb133111eb
+_SEED = 0x243f6a8885a308d3
+_RUNNING_SEED = 0xAAAAAAAA
+
+
+def _mix64(value):
+    # splitmix64 finalizer on a python integer in [0, 2^64)
+    value = ((value ^ (value >> 30)) * _MIX_1) & _MASK64
+    value = ((value ^ (value >> 27)) * _MIX_2) & _MASK64
+    return value ^ (value >> 31)
+
+
+def _mix64_array(values):
+    # splitmix64 finalizer on an array of uint64, the products wrap around
+    values = (values ^ (values >> np.uint64(30))) * np.uint64(_MIX_1)
+    values = (values ^ (values >> np.uint64(27))) * np.uint64(_MIX_2)
+    return values ^ (values >> np.uint64(31))
+
+
+def stable_label_hash(label):
+    """Deterministic 64 bit hash of a label.
+
+    Integers (and floats with an integer value) are mixed with splitmix64,
+    strings are hashed with md5, tuples combine the hashes of their items;
+    any other label is hashed through its repr.
+
+    >>> stable_label_hash('C') == stable_label_hash(u'C')
+    True
+    >>> stable_label_hash(1) == stable_label_hash(1.0)
+    True
+    """
+    if isinstance(label, (bool, int, np.integer)):
+        return _mix64((int(label) + _GOLDEN) & _MASK64)
+    if isinstance(label, (float, np.floating)) and float(label).is_integer():
+        return _mix64((int(label) + _GOLDEN) & _MASK64)
+    if isinstance(label, tuple):
+        return _stable_combine([stable_label_hash(item) for item in label])
+    if isinstance(label, bytes):
+        data = label
+    elif isinstance(label, type(u'')):
+        data = label.encode('utf-8')
+    else:
+        data = repr(label).encode('utf-8')
+    return struct.unpack('<Q', hashlib.md5(data).digest()[:8])[0]
+
+
+def _stable_value(value):
+    if isinstance(value, (int, np.integer)):
+        return int(value) & _MASK64
+    return stable_label_hash(value)
+
+
+def _stable_combine(values):
+    # order dependent combination of a sequence of 64 bit values
+    acc = _SEED
+    for value in values:
+        acc = _mix64(acc ^ ((value + _GOLDEN) & _MASK64))
+    return _mix64(acc ^ len(values))
+
+
+def stable_hash_2(dat_1, dat_2, bitmask=_bitmask_):
+    """Stable version of fast_hash_2."""
+    return (_stable_combine([_stable_value(dat_1),
+                             _stable_value(dat_2)]) & bitmask) + 1
+
+
+def stable_hash_3(dat_1, dat_2, dat_3, bitmask=_bitmask_):
+    """Stable version of fast_hash_3."""
+    return (_stable_combine([_stable_value(dat_1),
+                             _stable_value(dat_2),
+                             _stable_value(dat_3)]) & bitmask) + 1
+
+
+def stable_hash_4(dat_1, dat_2, dat_3, dat_4, bitmask=_bitmask_):
+    """Stable version of fast_hash_4."""
+    return (_stable_combine([_stable_value(dat_1),
+                             _stable_value(dat_2),
+                             _stable_value(dat_3),
+                             _stable_value(dat_4)]) & bitmask) + 1
+
+
+def stable_hash(vec, bitmask=_bitmask_):
+    """Stable version of fast_hash."""
+    hashed = _stable_combine([_stable_value(value) for value in vec])
+    return (hashed & bitmask) + 1
+
+
+def stable_hash_vec(vec, bitmask=_bitmask_):
+    """Stable version of fast_hash_vec.
+
+    >>> stable_hash_vec('ACG', 1023) == stable_hash_vec(['A', 'C', 'G'], 1023)
+    True
+    """
+    hash_vec = []
+    running_hash = _RUNNING_SEED
+    for i, vec_item in enumerate(vec):
+        running_hash ^= _stable_combine([running_hash,
+                                         _stable_value(vec_item), i])
+        hash_vec.append(int(running_hash & bitmask) + 1)
+    return hash_vec
+
+
+def _stable_combine_step(acc, column):
+    column = np.asarray(column, dtype=np.int64).view(np.uint64)
+    return _mix64_array(acc ^ (column + np.uint64(_GOLDEN)))
+
+
+def _stable_combine_end(acc, size):
+    return _mix64_array(acc ^ np.asarray(size, dtype=np.uint64))
+
+
+def _stable_combine_array(*columns):
+    acc = np.full(len(columns[0]), _SEED, dtype=np.uint64)
+    for column in columns:
+        acc = _stable_combine_step(acc, column)
+    return _stable_combine_end(acc, len(columns))
+
+
+def _mask(hashes, bitmask):
+    # the bitmask fits in 63 bits so that the result is a valid int64
+    return (hashes & np.uint64(bitmask)).astype(np.int64) + 1
+
+
+def stable_hash_array(*columns, **kwargs):
+    """Array version of stable_hash_2, stable_hash_3 and stable_hash_4.
+
+    Each position across the columns is a tuple of integers to hash.
+
+    >>> hashes = stable_hash_array([1, 2], [3, -4], bitmask=1023)
+    >>> list(hashes) == [stable_hash_2(1, 3, 1023), stable_hash_2(2, -4, 1023)]
+    True
+    """
+    bitmask = kwargs.get('bitmask', _bitmask_)
+    return _mask(_stable_combine_array(*columns), bitmask)
+
+
+def stable_hash_segments(values, starts, sizes, bitmask=_bitmask_):
+    """Array version of stable_hash applied to contiguous segments of values.
+
+    >>> hashes = stable_hash_segments([5, 6, 7], [0, 1], [1, 2])
+    >>> list(hashes) == [stable_hash([5]), stable_hash([6, 7])]
+    True
+    """
+    values = np.asarray(values, dtype=np.int64)
+    starts = np.asarray(starts, dtype=np.int64)
+    sizes = np.asarray(sizes, dtype=np.int64)
+    acc = np.full(len(starts), _SEED, dtype=np.uint64)
+    for i in range(int(sizes.max()) if len(sizes) else 0):
+        active = np.flatnonzero(sizes > i)
+        acc[active] = _stable_combine_step(acc[active],
+                                           values[starts[active] + i])
+    return _mask(_stable_combine_end(acc, sizes), bitmask)
+
+
+def stable_hash_vec_rows(rows, sizes, bitmask=_bitmask_):
+    """Array version of stable_hash_vec applied to the rows of a matrix.
+
+    >>> hashes = stable_hash_vec_rows([[3, 4, 5], [6, 0, 0]], [3, 1])
+    >>> list(hashes[0]) == stable_hash_vec([3, 4, 5])
+    True
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    sizes = np.asarray(sizes, dtype=np.int64)
+    hash_rows = np.zeros(rows.shape, dtype=np.int64)
+    running_hash = np.full(rows.shape[0], _RUNNING_SEED, dtype=np.uint64)
+    for i in range(rows.shape[1]):
+        active = np.flatnonzero(sizes > i)
+        running_hash[active] ^= _stable_combine_array(
+            running_hash[active], rows[active, i], np.full(len(active), i))
+        hash_rows[active, i] = _mask(running_hash[active], bitmask)
+    return hash_rows
+
+
+def _builtin_label_hash(label):
+    return hash(label)
+
+
+HashFunctions = namedtuple('HashFunctions', ['label',
+                                             'hash',
+                                             'hash_2',
+                                             'hash_3',
+                                             'hash_4',
+                                             'hash_vec',
+                                             'hash_array',
+                                             'hash_segments',
+                                             'hash_vec_rows'])
+
+_HASH_FUNCTIONS = {
+    'builtin': HashFunctions(label=_builtin_label_hash,
+                             hash=fast_hash,
+                             hash_2=fast_hash_2,
+                             hash_3=fast_hash_3,
+                             hash_4=fast_hash_4,
+                             hash_vec=fast_hash_vec,
+                             hash_array=fast_hash_array,
+                             hash_segments=fast_hash_segments,
+                             hash_vec_rows=fast_hash_vec_rows),
+    'stable': HashFunctions(label=stable_label_hash,
+                            hash=stable_hash,
+                            hash_2=stable_hash_2,
+                            hash_3=stable_hash_3,
+                            hash_4=stable_hash_4,
+                            hash_vec=stable_hash_vec,
+                            hash_array=stable_hash_array,
+                            hash_segments=stable_hash_segments,
+                            hash_vec_rows=stable_hash_vec_rows)}
+
+
+def get_hash_functions(hashing='builtin'):
+    """Return the hash functions of a hashing scheme.
+
+    Parameters
+    ----------
+    hashing : string (default 'builtin')
+        Either 'builtin' or 'stable'.
+
+    Returns
+    -------
+    hash_functions : HashFunctions
+        The label hash (64 bit, not masked), the scalar functions with the
+        signatures of fast_hash, fast_hash_2/3/4 and fast_hash_vec, and the
+        array functions hash_array, hash_segments and hash_vec_rows.
+
+    >>> hash_functions = get_hash_functions('stable')
+    >>> hash_functions.hash_2(3, 4) == stable_hash_2(3, 4)
+    True
+    """
+    if hashing not in _HASH_FUNCTIONS:
+        raise Exception('ERROR: unknown hashing scheme: %s' % hashing)
+    return _HASH_FUNCTIONS[hashing]
+
+
+class HashMemo(object):
+    """Bounded memo of the values of a hash function.
+
+    The keys are hashable values, e.g. tuples of integers; when more than
+    max_size keys are stored the oldest one is discarded. A lookup is a
+    plain dict access, so that it costs less than the hash it saves; the
+    callers that look up many keys report their hits and misses in bulk
+    with count. The memo can be shared by threads. It is not pickled: a
+    copy sent to another process starts empty.
+
+    >>> memo = HashMemo(max_size=2)
+    >>> memo(stable_hash, (1, 2)) == stable_hash((1, 2))
+    True
+    >>> memo(stable_hash, (1, 2)) == stable_hash((1, 2))
+    True
+    >>> memo.stats()['hits'], memo.stats()['misses']
+    (1, 1)
+    """
+
+    def __init__(self, max_size=2 ** 16):
+        """Constructor."""
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self.clear()
+
+    def __call__(self, function, key):
+        """Return function(key), computing it only if not memoized."""
+        value = self.get(key)
+        if value is None:
+            # the value is computed outside of the lock: at worst another
+            # thread computes it too
+            value = function(key)
+            self.put(key, value)
+            self.count(0, 1)
+        else:
+            self.count(1, 0)
+        return value
+
+    def get(self, key):
+        """Return the memoized value of key, None if it is not memoized.
+
+        The lookup is not counted in the statistics, see count.
+        """
+        return self._items.get(key)
+
+    def put(self, key, value):
+        """Memoize the value of key."""
+        with self._lock:
+            items = self._items
+            items[key] = value
+            if len(items) > self.max_size:
+                # dicts keep the insertion order: discard the oldest key
+                del items[next(iter(items))]
+
+    def count(self, hits, misses):
+        """Add hits and misses to the statistics."""
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    def __len__(self):
+        """Number of memoized keys."""
+        return len(self._items)
+
+    def __getstate__(self):
+        return dict(max_size=self.max_size)
+
+    def __setstate__(self, state):
+        self.max_size = state['max_size']
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """Discard the memoized values and reset the statistics."""
+        with self._lock:
+            self._items = dict()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Return the hit and miss counts."""
+        n_requests = self.hits + self.misses
+        hit_rate = self.hits / float(n_requests) if n_requests else 0.0
+        return dict(hits=self.hits, misses=self.misses, hit_rate=hit_rate,
+                    size=len(self), max_size=self.max_size)
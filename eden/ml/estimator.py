@@ -5,8 +5,12 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import copy
 import numpy as np
 from eden.graph import Vectorizer
+from eden.graph_cache import SessionFeatureCache
+from eden.graph_scorer import LinearScorer
+from eden.util import effective_n_jobs
 from eden.util import timeit
 from sklearn.base import BaseEstimator, ClassifierMixin, RegressorMixin
 from sklearn.linear_model import SGDClassifier
@@ -20,27 +24,42 @@ from sklearn.model_selection import cross_val_predict
 import multiprocessing as mp
 from eden.ml.estimator_utils import balance, subsample, paired_shuffle
 import random
+import time
+from collections import Counter
+from toolz import partition_all
 import logging
 
 logger = logging.getLogger()
 
 
 class EdenEstimator(BaseEstimator, ClassifierMixin):
-    """Build an estimator for graphs."""
+    """Build an estimator for graphs.
+
+    When fit balances the classes with a model trained on a subsample
+    (balance=True, randomize=False) the feature vectors are kept in
+    memory for the duration of the call, keyed by the identity of the
+    graphs, so that the graphs scored by balance are not vectorized again
+    when the balanced set is learned. cache_size bounds the size in bytes
+    of the stored vectors, see eden.graph_cache.SessionFeatureCache. The
+    other calls transform each graph once and use no cache; to reuse the
+    vectors across calls on the same graphs, e.g. decision_function and
+    then predict, set a cache on the vectorizer:
+    self.vectorizer.cache = SessionFeatureCache().
+    """
 
     def __init__(self, r=3, d=8, nbits=16, discrete=True,
                  balance=False, subsample_size=200, ratio=2,
                  normalization=False, inner_normalization=False,
-                 penalty='elasticnet'):
+                 penalty='elasticnet', cache_size=2 ** 28):
         """construct."""
         self.set_params(r, d, nbits, discrete, balance, subsample_size,
                         ratio, normalization, inner_normalization,
-                        penalty)
+                        penalty, cache_size)
 
     def set_params(self, r=3, d=8, nbits=16, discrete=True,
                    balance=False, subsample_size=200, ratio=2,
                    normalization=False, inner_normalization=False,
-                   penalty='elasticnet'):
+                   penalty='elasticnet', cache_size=2 ** 28):
         """setter."""
         self.r = r
         self.d = d
@@ -48,9 +67,11 @@ class EdenEstimator(BaseEstimator, ClassifierMixin):
         self.normalization = normalization
         self.inner_normalization = inner_normalization
         self.discrete = discrete
+        self.cache_size = cache_size
         self.balance = balance
         self.subsample_size = subsample_size
         self.ratio = ratio
+        self._reset_stream()
         if penalty == 'perceptron':
             self.model = Perceptron(max_iter=5, tol=None)
         else:
@@ -76,28 +97,150 @@ class EdenEstimator(BaseEstimator, ClassifierMixin):
         x = self.transform(graphs)
         return metrics.pairwise.pairwise_kernels(x, metric='linear')
 
+    def _reset_stream(self):
+        # the state of partial_fit; the class weights of the model, that
+        # partial_fit replaces with sample weights, are restored for fit
+        if getattr(self, '_stream_balanced', False):
+            self.model.set_params(class_weight='balanced')
+        self._stream_classes = None
+        self._stream_balanced = False
+        self._class_counts = None
+
     def fit(self, graphs, targets, randomize=True):
         """fit."""
+        self._reset_stream()
         if self.balance:
             if randomize:
                 bal_graphs, bal_targets = balance(
                     graphs, targets, None, ratio=self.ratio)
+                x = self.transform(bal_graphs)
             else:
-                samp_graphs, samp_targets = subsample(
-                    graphs, targets, subsample_size=self.subsample_size)
-                x = self.transform(samp_graphs)
-                self.model.fit(x, samp_targets)
-                bal_graphs, bal_targets = balance(
-                    graphs, targets, self, ratio=self.ratio)
+                # the session cache is set on a copy of the vectorizer, so
+                # that concurrent calls on self.vectorizer are not affected
+                vectorizer = _session_vectorizer(self.vectorizer,
+                                                 self.cache_size)
+                try:
+                    samp_graphs, samp_targets = subsample(
+                        graphs, targets, subsample_size=self.subsample_size)
+                    x = vectorizer.transform(samp_graphs)
+                    self.model.fit(x, samp_targets)
+                    bal_graphs, bal_targets = balance(
+                        graphs, targets,
+                        _VectorizedModel(vectorizer, self.model),
+                        ratio=self.ratio)
+                    x = vectorizer.transform(bal_graphs)
+                finally:
+                    if vectorizer.cache is not self.vectorizer.cache:
+                        vectorizer.cache.clear()
             size = len(bal_targets)
             logger.debug('Dataset size=%d' % (size))
-            x = self.transform(bal_graphs)
             self.model = self.model.fit(x, bal_targets)
         else:
             x = self.transform(graphs)
             self.model = self.model.fit(x, targets)
         return self
 
+    def partial_fit(self, graphs, targets, classes=None):
+        """Update the model with one chunk of instances.
+
+        Parameters
+        ----------
+        graphs : list of networkx graphs
+
+        targets : list of class labels
+
+        classes : list (default None)
+            All the class labels; it is required in the first call.
+
+        self.model is trained in place, as in EdenRegressor.partial_fit.
+        The default class_weight='balanced' of the model is not supported
+        by partial_fit: it is switched off until the next call to fit and
+        the instances are weighted by n / (n_classes * n_y) instead, where
+        n and n_y are the counts of all the instances and of the ones of
+        class y seen so far.
+
+        The feature cache is bypassed: the instances of a stream are
+        usually seen once and caching them would only grow the memory.
+
+        >>> import networkx as nx
+        >>> def labeled_path(label):
+        ...     g = nx.path_graph(4)
+        ...     nx.set_node_attributes(g, label, 'label')
+        ...     nx.set_edge_attributes(g, '-', 'label')
+        ...     return g
+        >>> graphs = [labeled_path('ab'[i % 2]) for i in range(40)]
+        >>> targets = [i % 2 for i in range(40)]
+        >>> est = EdenEstimator(r=1, d=1)
+        >>> est.partial_fit(graphs[:10], targets[:10])
+        Traceback (most recent call last):
+        ...
+        Exception: ERROR: classes are required in the first call to partial_fit.
+        >>> for start in range(0, 40, 10):
+        ...     est = est.partial_fit(graphs[start:start + 10],
+        ...                           targets[start:start + 10],
+        ...                           classes=[0, 1])
+        >>> est.predict(graphs[:4]).tolist(), est.model.class_weight
+        ([0, 1, 0, 1], None)
+        >>> est.fit(graphs, targets).model.class_weight
+        'balanced'
+        >>> est = EdenEstimator(r=1, d=1).fit_stream(
+        ...     zip(graphs, targets), classes=[0, 1], chunk_size=10)
+        >>> est.predict(graphs[:4]).tolist()
+        [0, 1, 0, 1]
+        """
+        if self._stream_classes is None:
+            if classes is None:
+                raise Exception('ERROR: classes are required in the first '
+                                'call to partial_fit.')
+            self._stream_classes = list(classes)
+            self._class_counts = Counter()
+            if getattr(self.model, 'class_weight', None) == 'balanced':
+                self.model.set_params(class_weight=None)
+                self._stream_balanced = True
+        x = _stream_transform(self.vectorizer, graphs)
+        self._class_counts.update(targets)
+        sample_weight = None
+        if self._stream_balanced:
+            sample_weight = _balanced_sample_weight(
+                targets, self._class_counts, len(self._stream_classes))
+        self.model.partial_fit(x, targets,
+                               classes=self._stream_classes,
+                               sample_weight=sample_weight)
+        return self
+
+    @timeit
+    def fit_stream(self, iterable, classes, epochs=1, chunk_size=500,
+                   buffer_size=None):
+        """Fit the model on a stream of (graph, target) pairs.
+
+        The stream is vectorized and learned chunk by chunk with
+        partial_fit, so that only chunk_size instances (or buffer_size,
+        if larger) are held in memory at any time; the feature cache is
+        not used.
+
+        Parameters
+        ----------
+        iterable : iterable over pairs (graph, target)
+            When epochs > 1 it must be possible to iterate over it several
+            times, e.g. a list or a callable returning a new iterator.
+
+        classes : list
+            All the class labels.
+
+        epochs : int (default 1)
+            The number of passes over the stream.
+
+        chunk_size : int (default 500)
+            The number of instances vectorized and learned at once.
+
+        buffer_size : int (default None)
+            If not None, the pairs are shuffled in a buffer of this size.
+        """
+        for graphs, targets in _stream_chunks(iterable, epochs, chunk_size,
+                                              buffer_size):
+            self.partial_fit(graphs, targets, classes=classes)
+        return self
+
     def predict(self, graphs):
         """predict."""
         x = self.transform(graphs)
@@ -110,6 +253,15 @@ class EdenEstimator(BaseEstimator, ClassifierMixin):
         preds = self.model.decision_function(x)
         return preds
 
+    def scorer(self, sparse=False):
+        """Return a LinearScorer with the coefficients of the fit model.
+
+        Its decision_function gives the same scores as the one of the
+        estimator without building the feature vectors, see
+        eden.graph_scorer.
+        """
+        return _linear_scorer(self.vectorizer, self.model, sparse)
+
     @timeit
     def cross_val_score(self, graphs, targets,
                         scoring='roc_auc', cv=5):
@@ -137,21 +289,98 @@ class EdenEstimator(BaseEstimator, ClassifierMixin):
 
     @timeit
     def model_selection(self, graphs, targets,
-                        n_iter=30, subsample_size=None):
-        """model_selection_randomized."""
-        param_distr = {"r": list(range(1, 5)), "d": list(range(0, 10))}
-        if subsample_size:
-            graphs, targets = subsample(
-                graphs, targets, subsample_size=subsample_size)
+                        n_iter=30, subsample_size=None,
+                        min_size=None, eta=3, cv=5, n_jobs=-1):
+        """Select r and d with a successive halving search.
 
-        pool = mp.Pool()
-        scores = pool.map(_eval, [(graphs, targets, param_distr)] * n_iter)
-        pool.close()
-        pool.join()
+        n_iter configurations are sampled and cross validated on a small
+        stratified subsample of the instances; only the best 1/eta of them
+        are promoted to the next round, where the subsample is eta times
+        larger, until a single round on all the instances is left.
+        The graphs are sent once to each worker process.
 
-        best_params = max(scores)[1]
+        Parameters
+        ----------
+        graphs : list of networkx graphs
+
+        targets : list of class labels
+
+        n_iter : int (default 30)
+            The number of configurations sampled in the first round.
+
+        subsample_size : int (default None)
+            If given, the search uses at most subsample_size instances.
+
+        min_size : int (default None)
+            The size of the subsample of the first round; by default it is
+            chosen so that the last round uses all the instances.
+
+        eta : int (default 3)
+            The fraction of configurations promoted at each round is 1/eta.
+
+        cv : int (default 5)
+            The number of cross validation folds.
+
+        n_jobs : int (default -1)
+            The number of worker processes; -1 for all the cores, -2 for
+            all but one and so on.
+
+        Returns
+        -------
+        A new EdenEstimator with the best parameters. Its attribute
+        model_selection_stats_ holds for each round the subsample size,
+        the number of trials, the best score and the wall-clock time.
+        """
+        start = time.time()
+        param_distr = {"r": list(range(1, 5)), "d": list(range(0, 10))}
+        order = _stratified_order(targets)
+        if subsample_size:
+            order = order[:subsample_size]
+        n_instances = len(order)
+        configurations = _sample_configurations(param_distr, n_iter)
+        # each fold must contain the classes
+        schedule = _halving_schedule(len(configurations), n_instances, eta,
+                                     min_size=min_size,
+                                     smallest=cv * len(set(targets)))
+
+        pool = mp.Pool(processes=effective_n_jobs(n_jobs),
+                       initializer=_init_selection_worker,
+                       initargs=(graphs, targets, order, cv))
+        rounds = []
+        try:
+            for i, (size, n_trials) in enumerate(schedule):
+                round_start = time.time()
+                configurations = configurations[:n_trials]
+                scores = pool.map(_eval_trial,
+                                  [(params, size)
+                                   for params in configurations])
+                ranked = sorted(zip(scores, range(len(scores))),
+                                reverse=True)
+                ranked = [configurations[j] for score, j in ranked]
+                rounds.append(dict(size=size,
+                                   n_trials=len(configurations),
+                                   best_score=max(scores),
+                                   time=time.time() - round_start))
+                logger.debug('round %d: size=%d trials=%d best=%.4f '
+                             '%2.2f sec' % (i, size, len(configurations),
+                                            max(scores),
+                                            rounds[-1]['time']))
+                configurations = ranked
+        finally:
+            pool.close()
+            pool.join()
+
+        best_params = configurations[0]
+        stats = dict(rounds=rounds,
+                     n_trials=sum(rnd['n_trials'] for rnd in rounds),
+                     best_score=rounds[-1]['best_score'],
+                     best_params=best_params,
+                     time=time.time() - start)
         logger.debug("Best parameters:\n%s" % (best_params))
+        logger.debug('%d trials in %d rounds %2.2f sec' %
+                     (stats['n_trials'], len(rounds), stats['time']))
         self = EdenEstimator(**best_params)
+        self.model_selection_stats_ = stats
         return self
 
     @timeit
@@ -185,19 +414,26 @@ class EdenEstimator(BaseEstimator, ClassifierMixin):
 
 
 class EdenRegressor(BaseEstimator, RegressorMixin):
-    """Build a regressor for graphs."""
+    """Build a regressor for graphs.
+
+    Each call transforms the graphs once and uses no cache unless one is
+    set on the vectorizer, see EdenEstimator; cache_size is kept for
+    symmetry with EdenEstimator.
+    """
 
     def __init__(self, r=3, d=8, nbits=16, discrete=True,
                  normalization=True, inner_normalization=True,
-                 penalty='elasticnet', loss='squared_loss'):
+                 penalty='elasticnet', loss='squared_loss',
+                 cache_size=2 ** 28):
         """construct."""
         self.set_params(r, d, nbits, discrete,
                         normalization, inner_normalization,
-                        penalty, loss)
+                        penalty, loss, cache_size)
 
     def set_params(self, r=3, d=8, nbits=16, discrete=True,
                    normalization=True, inner_normalization=True,
-                   penalty='elasticnet', loss='squared_loss'):
+                   penalty='elasticnet', loss='squared_loss',
+                   cache_size=2 ** 28):
         """setter."""
         self.r = r
         self.d = d
@@ -205,6 +441,7 @@ class EdenRegressor(BaseEstimator, RegressorMixin):
         self.normalization = normalization
         self.inner_normalization = inner_normalization
         self.discrete = discrete
+        self.cache_size = cache_size
         self.model = SGDRegressor(
             loss=loss, penalty=penalty,
             average=True, shuffle=True,
@@ -234,6 +471,27 @@ class EdenRegressor(BaseEstimator, RegressorMixin):
         self.model = self.model.fit(x, targets)
         return self
 
+    def partial_fit(self, graphs, targets):
+        """Update the model with one chunk of instances.
+
+        The feature cache is bypassed, see EdenEstimator.partial_fit.
+        """
+        x = _stream_transform(self.vectorizer, graphs)
+        self.model.partial_fit(x, targets)
+        return self
+
+    @timeit
+    def fit_stream(self, iterable, epochs=1, chunk_size=500,
+                   buffer_size=None):
+        """Fit the model on a stream of (graph, target) pairs.
+
+        See EdenEstimator.fit_stream.
+        """
+        for graphs, targets in _stream_chunks(iterable, epochs, chunk_size,
+                                              buffer_size):
+            self.partial_fit(graphs, targets)
+        return self
+
     def predict(self, graphs):
         """predict."""
         x = self.transform(graphs)
@@ -244,6 +502,90 @@ class EdenRegressor(BaseEstimator, RegressorMixin):
         """decision_function."""
         return self.predict(graphs)
 
+    def scorer(self, sparse=False):
+        """Return a LinearScorer with the coefficients of the fit model."""
+        return _linear_scorer(self.vectorizer, self.model, sparse)
+
+
+def _linear_scorer(vectorizer, model, sparse):
+    coef = np.atleast_2d(model.coef_)
+    if coef.shape[0] != 1:
+        raise Exception('ERROR: a scorer needs a binary or a regression '
+                        'model, got %d classes.' % coef.shape[0])
+    # the scorer computes the features itself
+    vectorizer = copy.copy(vectorizer)
+    vectorizer.cache = None
+    return LinearScorer(vectorizer, coef[0],
+                        intercept=np.ravel(model.intercept_)[0],
+                        sparse=sparse)
+
+
+def _stream_transform(vectorizer, graphs):
+    # transform without looking up or storing the rows in the cache
+    if vectorizer.cache is None:
+        return vectorizer.transform(graphs)
+    return vectorizer._transform_uncached(graphs)
+
+
+def _session_vectorizer(vectorizer, cache_size):
+    # a copy of the vectorizer that keeps the rows of the graphs seen in
+    # one call, keyed by their identity; a cache given to the vectorizer by
+    # the user is used as it is
+    vectorizer = copy.copy(vectorizer)
+    if vectorizer.cache is None:
+        vectorizer.cache = SessionFeatureCache(max_size=cache_size)
+    return vectorizer
+
+
+class _VectorizedModel(object):
+    # the decision_function of a model on the vectors of a vectorizer, as
+    # needed by balance
+
+    def __init__(self, vectorizer, model):
+        self.vectorizer = vectorizer
+        self.model = model
+
+    def decision_function(self, graphs):
+        return self.model.decision_function(self.vectorizer.transform(graphs))
+
+
+def _balanced_sample_weight(targets, class_counts, n_classes):
+    # weights of the 'balanced' heuristic n / (n_classes * count(y))
+    # estimated on the counts of the instances seen so far
+    n = sum(class_counts.values())
+    return np.array([n / (n_classes * class_counts[y]) for y in targets])
+
+
+def _shuffle_buffer(iterable, buffer_size):
+    # approximate shuffling of a stream: each element is stored in a
+    # buffer and a random element of the full buffer is emitted instead
+    buffer = []
+    for item in iterable:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+            continue
+        i = random.randrange(buffer_size)
+        buffer[i], item = item, buffer[i]
+        yield item
+    random.shuffle(buffer)
+    for item in buffer:
+        yield item
+
+
+def _stream_chunks(iterable, epochs, chunk_size, buffer_size):
+    # lists of graphs and of targets of at most chunk_size pairs
+    if epochs > 1 and not callable(iterable) and \
+            iter(iterable) is iterable:
+        raise Exception('ERROR: an iterator can be consumed only once, '
+                        'use a list or a callable for epochs > 1.')
+    for epoch in range(epochs):
+        pairs = iterable() if callable(iterable) else iterable
+        if buffer_size:
+            pairs = _shuffle_buffer(pairs, buffer_size)
+        for chunk in partition_all(chunk_size, pairs):
+            graphs, targets = zip(*chunk)
+            yield list(graphs), list(targets)
+
 
 def _sample_params(param_distr):
     params = dict()
@@ -252,16 +594,81 @@ def _sample_params(param_distr):
     return params
 
 
-def _eval_params(graphs, targets, param_distr):
-    # sample parameters
-    params = _sample_params(param_distr)
-    # create model with those parameters
+def _halving_schedule(n_configurations, n_instances, eta, min_size=None,
+                      smallest=1):
+    """Return the (subsample size, number of trials) of each round.
+
+    The number of rounds is such that the last round, on all the
+    instances, still compares at least eta configurations (or all of them,
+    if they are fewer).
+
+    >>> _halving_schedule(30, 900, 3)
+    [(100, 30), (300, 10), (900, 3)]
+    >>> _halving_schedule(2, 900, 3)
+    [(900, 2)]
+    """
+    n_rounds = 1
+    while n_configurations >= eta ** (n_rounds + 1):
+        n_rounds += 1
+    if min_size is None:
+        min_size = n_instances // eta ** (n_rounds - 1)
+    min_size = max(min_size, smallest)
+    schedule = []
+    n_trials = n_configurations
+    for i in range(n_rounds):
+        size = min(n_instances, min_size * eta ** i)
+        if i == n_rounds - 1:
+            size = n_instances
+        schedule.append((size, n_trials))
+        n_trials = max(1, n_trials // eta)
+    return schedule
+
+
+def _sample_configurations(param_distr, n_iter):
+    # distinct configurations, at most n_iter
+    configurations = []
+    for i in range(n_iter * 10):
+        params = _sample_params(param_distr)
+        if params not in configurations:
+            configurations.append(params)
+        if len(configurations) == n_iter:
+            break
+    return configurations
+
+
+def _stratified_order(targets):
+    # random order of the instances such that any prefix contains the
+    # classes in (about) the same proportion as the whole set
+    targets = np.asarray(targets)
+    rank = np.zeros(len(targets))
+    for y in np.unique(targets):
+        ids = np.flatnonzero(targets == y)
+        rank[np.random.permutation(ids)] = \
+            (np.arange(len(ids)) + np.random.rand(len(ids))) / len(ids)
+    return np.argsort(rank, kind='stable')
+
+
+_selection_state = dict()
+
+
+def _init_selection_worker(graphs, targets, order, cv):
+    _selection_state['graphs'] = graphs
+    _selection_state['targets'] = targets
+    _selection_state['order'] = order
+    _selection_state['cv'] = cv
+
+
+def _eval_trial(data):
+    params, size = data
+    ids = _selection_state['order'][:size]
+    graphs = [_selection_state['graphs'][i] for i in ids]
+    targets = [_selection_state['targets'][i] for i in ids]
     est = EdenEstimator(**params)
-    # run a cross_val_score
-    scores = est.cross_val_score(graphs, targets)
-    # return average
-    return np.mean(scores), params
-
-
-def _eval(data):
-    return _eval_params(*data)
+    try:
+        scores = est.cross_val_score(graphs, targets,
+                                     cv=_selection_state['cv'])
+    except ValueError as e:
+        logger.debug('Failed trial %s: %s' % (params, e))
+        return -np.inf
+    score = float(np.mean(scores))
+    return -np.inf if np.isnan(score) else score
@@ -63,7 +63,7 @@ def subsample(graphs, targets, subsample_size=100):
     subgraphs = []
     subtargets = []
     for y in class_graphs:
-        class_subgraphs = class_graphs[y][:subsample_size / num_classes]
+        class_subgraphs = class_graphs[y][:subsample_size // num_classes]
         class_subgraphs = [second(x) for x in class_subgraphs]
         subgraphs += class_subgraphs
         subtargets += [y] * len(class_subgraphs)
@@ -102,7 +102,8 @@ def balance(graphs, targets, estimator, ratio=2):
         # select at random
         preds = [random.random() for i in range(len(maj_graphs))]
     preds = [abs(pred) for pred in preds]
-    pred_graphs = sorted(zip(preds, maj_graphs))[:desired_size]
+    pred_graphs = sorted(zip(preds, maj_graphs),
+                         key=lambda x: x[0])[:desired_size]
     maj_graphs = [g for p, g in pred_graphs]
 
     bal_graphs = min_graphs + maj_graphs
@@ -5,12 +5,11 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-from collections import defaultdict
 import numpy as np
-import math
-from scipy.sparse import csr_matrix
-from eden import fast_hash_vec, fast_hash_2, fast_hash_4
+from toolz import partition_all
 from eden import AbstractVectorizer
+from eden.hashing import get_hash_functions
+from eden.accumulator import FeatureAccumulator
 
 import logging
 
@@ -66,7 +65,8 @@ class Vectorizer(AbstractVectorizer):
                  nbits=16,
                  normalization=True,
                  inner_normalization=True,
-                 use_only_context=False):
+                 use_only_context=False,
+                 hashing='builtin'):
         """Constructor.
 
         Parameters
@@ -111,6 +111,14 @@ class Vectorizer(AbstractVectorizer):
         use_only_context: bool (default False)
             Flag to deactivate the central part of the information
             and retain only the context.
+
+        hashing : string (default 'builtin')
+            The hash functions used for the features, see eden.hashing.
+            'stable' gives the same feature ids in every run and process;
+            its scalar functions are several times slower than the builtin
+            ones, so transform hashes all the positions of each sequence
+            with the array functions. The other methods, e.g. annotate, pay
+            that cost.
         """
         if complexity is not None:
             self.r = complexity
@@ -127,6 +135,8 @@ class Vectorizer(AbstractVectorizer):
         self.normalization = normalization
         self.inner_normalization = inner_normalization
         self.use_only_context = use_only_context
+        self.hashing = hashing
+        self._hash_functions = get_hash_functions(hashing)
         self.bitmask = pow(2, nbits) - 1
         self.feature_size = self.bitmask + 2
 
@@ -151,6 +161,9 @@ class Vectorizer(AbstractVectorizer):
             self.normalization = args['normalization']
         if args.get('inner_normalization', None) is not None:
             self.inner_normalization = args['inner_normalization']
+        if args.get('hashing', None) is not None:
+            self.hashing = args['hashing']
+            self._hash_functions = get_hash_functions(self.hashing)
 
         if self.min_r > self.r:
             self.min_r = self.r
@@ -188,22 +201,44 @@ class Vectorizer(AbstractVectorizer):
                   list of id, seq tuples or
                   list of id, seq, list of weight tuples
         """
-        feature_rows = []
+        feature_list = FeatureAccumulator()
         for seq in seq_list:
-            feature_rows.append(self._transform(seq))
-        return self._convert_dict_to_sparse_matrix(feature_rows)
+            feature_list.new_row()
+            self._transform(seq, feature_list)
+        return self._feature_matrix(
+            feature_list,
+            inner_normalization=self.inner_normalization,
+            normalization=self.normalization)
+
+    def transform_iter(self, seq_list, block_size=100):
+        """Transform a stream of sequences into a stream of sparse matrices.
+
+        The sequences are consumed lazily and each block of block_size
+        sequences is yielded as soon as it is vectorized.
+
+        Parameters
+        ----------
+        seq_list: iterable over sequence strings or
+                  id, seq tuples or
+                  id, seq, list of weight tuples
+
+        block_size : int (default 100)
+            The number of rows of each block; the last block can be smaller.
+
+        >>> blocks = Vectorizer().transform_iter(iter(['A', 'C', 'G']), 2)
+        >>> [block.shape[0] for block in blocks]
+        [2, 1]
+        """
+        for chunk in partition_all(block_size, seq_list):
+            yield self.transform(chunk)
 
-    def _convert_dict_to_sparse_matrix(self, feature_rows):
-        if len(feature_rows) == 0:
+    def _feature_matrix(self, feature_list,
+                        inner_normalization=False, normalization=False):
+        if feature_list.n_rows == 0:
             raise Exception('ERROR: something went wrong, empty features.')
-        data, row, col = [], [], []
-        for i, feature_row in enumerate(feature_rows):
-            for feature in feature_row:
-                row.append(i)
-                col.append(feature)
-                data.append(feature_row[feature])
-        shape = (max(row) + 1, self.feature_size)
-        return csr_matrix((data, (row, col)), shape=shape)
+        return feature_list.to_csr(self.feature_size,
+                                   inner_normalization=inner_normalization,
+                                   normalization=normalization)
 
     def _get_sequence_and_weights(self, seq):
         if seq is None or len(seq) == 0:
@@ -221,7 +256,10 @@ class Vectorizer(AbstractVectorizer):
             raise Exception('ERROR: something went wrong,\
              unrecognized input type for: %s' % seq)
 
-    def _transform(self, orig_seq):
+    def _transform(self, orig_seq, feature_list):
+        if self.hashing == 'stable':
+            self._transform_arrays(orig_seq, feature_list)
+            return
         seq, weights = self._get_sequence_and_weights(orig_seq)
         # extract kmer hash codes for all kmers up to r in all positions in seq
         seq_len = len(seq)
@@ -236,8 +274,7 @@ class Vectorizer(AbstractVectorizer):
                 [self._compute_neighborhood_weight(weights, pos)
                  for pos in range(seq_len)]
         # construct features as pairs of kmers up to distance d
-        # for all radii up to r
-        feature_list = defaultdict(lambda: defaultdict(float))
+        # for all radii up to r, in the current row
         for pos in range(seq_len):
             for radius in range(self.min_r, self.r + 1):
                 if radius < len(neigh_hash_cache[pos]):
@@ -247,10 +284,6 @@ class Vectorizer(AbstractVectorizer):
                                              seq_len,
                                              neigh_hash_cache,
                                              neighborhood_weight_cache)
-        return self._normalization(
-            feature_list,
-            inner_normalization=self.inner_normalization,
-            normalization=self.normalization)
 
     def _transform_distance(self,
                             feature_list=None,
@@ -274,52 +307,88 @@ class Vectorizer(AbstractVectorizer):
                     else:
                         pfeat = neigh_hash_cache[pos][radius]
                     efeat = neigh_hash_cache[end][radius]
-                    feature_code = fast_hash_4(pfeat,
-                                               efeat,
-                                               radius,
-                                               distance,
-                                               self.bitmask)
-                    key = fast_hash_2(radius, distance, self.bitmask)
+                    hash_functions = self._hash_functions
+                    feature_code = hash_functions.hash_4(pfeat,
+                                                         efeat,
+                                                         radius,
+                                                         distance,
+                                                         self.bitmask)
+                    key = hash_functions.hash_2(radius, distance,
+                                                self.bitmask)
                     if neighborhood_weight_cache:
                         pw = neighborhood_weight_cache[pos][radius]
-                        feature_list[key][feature_code] += pw
+                        feature_list.add(key, feature_code, pw)
                         ew = neighborhood_weight_cache[end][radius]
-                        feature_list[key][feature_code] += ew
+                        feature_list.add(key, feature_code, ew)
                     else:
-                        feature_list[key][feature_code] += 1
-
-    def _normalization(self, feature_list,
-                       inner_normalization=False, normalization=False):
-        # inner normalization per radius-distance
-        feature_vector = {}
-        for features in feature_list.values():
-            norm = 0
-            for count in features.values():
-                norm += count * count
-            sqrt_norm = math.sqrt(norm)
-            for feature, count in features.items():
-                feature_vector_key = feature
-                if inner_normalization:
-                    feature_vector_value = float(count) / sqrt_norm
-                else:
-                    feature_vector_value = count
-                feature_vector[feature_vector_key] = feature_vector_value
-        # global normalization
-        if normalization:
-            normalized_feature_vector = {}
-            total_norm = 0.0
-            for feature, value in feature_vector.items():
-                total_norm += value * value
-            sqrt_total_norm = math.sqrt(float(total_norm))
-            for feature, value in feature_vector.items():
-                normalized_feature_vector[feature] = value / sqrt_total_norm
-            return normalized_feature_vector
+                        feature_list.add(key, feature_code, 1)
+
+    def _transform_arrays(self, orig_seq, feature_list):
+        # array version of _transform: the same records in the same order
+        seq, weights = self._get_sequence_and_weights(orig_seq)
+        seq_len = len(seq)
+        if weights and len(weights) != seq_len:
+            raise Exception('ERROR: sequence and weights \
+                must be same length.')
+        hash_functions = self._hash_functions
+        width = self.r + 1
+        # the hashes of the kmers starting at each position, by radius
+        label_hashes = dict()
+        codes = np.array([label_hashes.setdefault(c, hash_functions.label(c))
+                          for c in seq], dtype=np.uint64).view(np.int64)
+        windows = np.arange(seq_len)[:, None] + np.arange(width)[None, :]
+        sizes = np.minimum(width, seq_len - np.arange(seq_len))
+        rows = np.where(windows < seq_len,
+                        codes[np.minimum(windows, seq_len - 1)], 0)
+        hash_rows = hash_functions.hash_vec_rows(rows, sizes, self.bitmask)
+        # all the (pos, radius, distance) triples in the order of _transform
+        distances = list(range(self.min_d, self.d + 1))
+        distances += list(range(-self.d, -self.min_d))
+        radii = list(range(self.min_r, self.r + 1))
+        pos, radius, distance = [
+            grid.ravel() for grid in np.meshgrid(np.arange(seq_len), radii,
+                                                 distances, indexing='ij')]
+        end = pos + distance
+        distance = np.abs(distance)
+        valid = (radius < sizes[pos]) & (end >= 0) & \
+            (end + radius < seq_len)
+        # the key of each (radius, distance) block is hashed only once
+        keys = np.zeros((self.r + 1, self.d + 1), dtype=np.int64)
+        active = np.zeros((self.r + 1, self.d + 1), dtype=bool)
+        for r in radii:
+            for d in set(abs(d) for d in distances):
+                keys[r, d] = hash_functions.hash_2(r, d, self.bitmask)
+                active[r, d] = self.weights_dict is None or \
+                    self.weights_dict.get((r, d), 0) != 0
+        valid &= active[radius, distance]
+        pos, radius, distance, end = \
+            pos[valid], radius[valid], distance[valid], end[valid]
+        if self.use_only_context:
+            pfeat = np.full(len(pos), 42, dtype=np.int64)
+        else:
+            pfeat = hash_rows[pos, radius]
+        efeat = hash_rows[end, radius]
+        feature_codes = hash_functions.hash_array(pfeat, efeat, radius,
+                                                  distance,
+                                                  bitmask=self.bitmask)
+        block_keys = keys[radius, distance]
+        if weights:
+            weight_rows = np.zeros((seq_len, width))
+            for i in range(seq_len):
+                weight_list = self._compute_neighborhood_weight(weights, i)
+                weight_rows[i, :len(weight_list)] = weight_list
+            # a record for each endpoint, the one of pos first
+            values = np.column_stack([weight_rows[pos, radius],
+                                      weight_rows[end, radius]]).ravel()
+            block_keys = np.repeat(block_keys, 2)
+            feature_codes = np.repeat(feature_codes, 2)
         else:
-            return feature_vector
+            values = np.ones(len(feature_codes))
+        feature_list.add_arrays(block_keys, feature_codes, values)
 
     def _compute_neighborhood_hash(self, seq, pos):
         subseq = seq[pos:pos + self.r + 1]
-        return fast_hash_vec(subseq, self.bitmask)
+        return self._hash_functions.hash_vec(subseq, self.bitmask)
 
     def _compute_neighborhood_weight(self, weights, pos):
         """TODO."""
@@ -340,7 +409,7 @@ class Vectorizer(AbstractVectorizer):
             if len(seq) == 0:
                 raise Exception('ERROR: something went wrong, empty instance.')
             # extract feature vector
-            x = self._convert_dict_to_sparse_matrix(self._transform(seq))
+            x = self.transform([seq])
             margins = estimator.decision_function(x)
             yield margins[0]
 
@@ -350,13 +419,12 @@ class Vectorizer(AbstractVectorizer):
         Takes an iterator over graphs and a reference graph, and returns
         an iterator over similarity evaluations.
         """
-        reference_vec = self._convert_dict_to_sparse_matrix(
-            self._transform(ref_instance))
+        reference_vec = self.transform([ref_instance])
         for seq in seqs:
             if len(seq) == 0:
                 raise Exception('ERROR: something went wrong, empty instance.')
             # extract feature vector
-            x = self._convert_dict_to_sparse_matrix(self._transform(seq))
+            x = self.transform([seq])
             res = reference_vec.dot(x.T).todense()
             yield res[0, 0]
 
@@ -499,7 +567,7 @@ class Vectorizer(AbstractVectorizer):
         if seq is None or len(seq) == 0:
             raise Exception('ERROR: something went wrong, empty instance.')
         # extract kmer hash codes for all kmers up to r in all positions in seq
-        vertex_features = []
+        vertex_features = FeatureAccumulator()
         seq_len = len(seq)
         neighborhood_weight_cache = None
         if weights:
@@ -514,10 +582,10 @@ class Vectorizer(AbstractVectorizer):
         for pos in range(seq_len):
             # construct features as pairs of kmers up to distance d
             # for all radii up to r
-            local_features = defaultdict(lambda: defaultdict(float))
+            vertex_features.new_row()
             for radius in range(self.min_r, self.r + 1):
                 if radius < len(neigh_hash_cache[pos]):
-                    self._transform_distance(local_features,
+                    self._transform_distance(vertex_features,
                                              pos,
                                              radius,
                                              seq_len,
@@ -526,15 +594,12 @@ class Vectorizer(AbstractVectorizer):
                     # Note: we must consider also kmers that are on
                     # the left of pos
                     if pos - radius >= 0:
-                        self._transform_distance(local_features,
+                        self._transform_distance(vertex_features,
                                                  pos - radius,
                                                  radius,
                                                  seq_len,
                                                  neigh_hash_cache,
                                                  neighborhood_weight_cache)
-            vertex_features.append(self._normalization(
-                local_features,
-                inner_normalization=False,
-                normalization=self.normalization))
-        data_matrix = self._convert_dict_to_sparse_matrix(vertex_features)
-        return data_matrix
+        return self._feature_matrix(vertex_features,
+                                    inner_normalization=False,
+                                    normalization=self.normalization)
@@ -191,6 +191,30 @@ def iterator_size(iterable):
         return 0
 
 
+def effective_n_jobs(n_jobs):
+    """Number of workers for n_jobs, as in joblib and sklearn.
+
+    None means 1, a negative value counts back from the number of cores:
+    -1 is all the cores, -2 all but one and so on, at least 1.
+
+    >>> effective_n_jobs(None), effective_n_jobs(3)
+    (1, 3)
+    >>> effective_n_jobs(-1) == mp.cpu_count()
+    True
+    >>> effective_n_jobs(-mp.cpu_count() - 5)
+    1
+    """
+    if n_jobs is None:
+        return 1
+    if n_jobs == 0:
+        raise ValueError('ERROR: n_jobs == 0 has no meaning, use a '
+                         'positive number of workers or -1 for all the '
+                         'cores')
+    if n_jobs < 0:
+        return max(mp.cpu_count() + 1 + n_jobs, 1)
+    return n_jobs
+
+
 def random_bipartition(int_range, relative_size=.7, random_state=None):
     """random_bipartition."""
     if not random_state: